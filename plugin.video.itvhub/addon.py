@@ -5,17 +5,34 @@
 #  This file is part of plugin.video.itvx
 # ---------------------------------------------------------------------------------------------------------------------
 
+import sys
 
 from codequick import support
 from resources.lib import logging
 from resources.lib import main
 from resources.lib import cc_patch
+from resources.lib import fetch
+from resources.lib import metrics
+from resources.lib import tracing
+from resources.lib import capture
+from resources.lib import memprof
 
 
 cc_patch.patch_cc_route()
 cc_patch.patch_label_prop()
+cc_patch.patch_tracing()
 
 
 if __name__ == '__main__':
+    metrics.start_route(sys.argv[0])
+    tracing.start_trace(sys.argv[0])
+    capture.start_capture(sys.argv[0])
+    memprof.start_profile(sys.argv[0])
     main.run()
+    memprof.stop_profile()
+    capture.stop_capture()
+    tracing.stop_trace()
+    # With reuselanguageinvoker the interpreter does not exit, so save cookies, etc. now.
+    fetch.save_state()
+    metrics.write_report()
     logging.shutdown_log()
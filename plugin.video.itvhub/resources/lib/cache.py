@@ -9,58 +9,365 @@
 """
 A very simple key-value store.
 Stores data in volatile memory for the lifetime of the addon or the specified period.
+The memory used is limited to approximately MEM_CACHE_MAX_SIZE bytes; when the cache
+grows larger, expired items are removed first, followed by the least recently used items.
+
+Items are also written to disk in the addon's profile directory, so they survive
+the start of a new interpreter. The disk cache is limited to DISK_CACHE_MAX_SIZE bytes;
+when it grows larger, the least recently used items are removed.
 """
 
 
+import os
+import sys
 import time
+import pickle
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
 
 from codequick.support import logger_id
 
+from . import utils
+from . import metrics
+
 
 logger = logging.getLogger(logger_id + '.itvx')
 # noinspection SpellCheckingInspection
 DFLT_EXPIRE_TIME = 600
 
+MEM_CACHE_MAX_SIZE = 32 * 1024 * 1024
+
+DISK_CACHE_DIR = os.path.join(utils.addon_info['profile'], 'cache')
+DISK_CACHE_MAX_SIZE = 20 * 1024 * 1024
+
+# Each file in the disk cache starts with a fixed width line containing the expiry time,
+# so an item can be renewed without rewriting the whole file.
+_HEADER_FMT = b'%020.3f\n'
+_HEADER_SIZE = 21
 
-__cache__ = {}
+
+__cache__ = OrderedDict()
+_mem_size = 0
+# Items may be set from background threads.
+_lock = threading.RLock()
 
 
 def get_item(key):
     """Return the cached data if present in the cache and not expired, or
 
     """
-    item = __cache__.get(key)
-    if item and item['expires'] > time.monotonic():
-        logger.debug("Data cache: hit")
-        return item['data']
-    else:
-        logger.debug("Data cache: miss")
-        return None
+    with _lock:
+        item = __cache__.get(key)
+        if item and item['expires'] > time.monotonic():
+            __cache__.move_to_end(key)
+            logger.debug("Data cache: hit")
+            metrics.count('cache_hit')
+            return item['data']
+
+    disk_item = _disk_read(key, time.time())
+    if disk_item and disk_item[2] is not None:
+        expires, validators, data = disk_item
+        _mem_store(key, time.monotonic() + expires - time.time(), data, validators)
+        logger.debug("Data cache: disk hit")
+        metrics.count('cache_disk_hit')
+        return data
+
+    logger.debug("Data cache: miss")
+    metrics.count('cache_miss')
+    return None
 
 
-def set_item(key, data, expire_time=DFLT_EXPIRE_TIME):
+def get_stale_item(key, max_stale):
+    """Return the cached data if present in the cache and not expired for longer than
+    `max_stale` seconds, or None.
+
+    """
+    with _lock:
+        item = __cache__.get(key)
+        if item and item['expires'] > time.monotonic() - max_stale:
+            __cache__.move_to_end(key)
+            logger.debug("Data cache: stale hit")
+            metrics.count('cache_stale')
+            return item['data']
+
+    disk_item = _disk_read(key, time.time() - max_stale)
+    if disk_item and disk_item[2] is not None:
+        expires, validators, data = disk_item
+        _mem_store(key, time.monotonic() + expires - time.time(), data, validators)
+        logger.debug("Data cache: stale disk hit")
+        metrics.count('cache_stale')
+        return data
+    return None
+
+
+def set_item(key, data, expire_time=DFLT_EXPIRE_TIME, validators=None):
     """Cache `data` in memory for the lifetime of the addon, to a maximum of CACHE_TIME in seconds
 
+    Optional `validators` are the HTTP cache validators (ETag, Last-Modified) of the
+    document `data` has been obtained from.
+
+    """
+    _mem_store(key, time.monotonic() + expire_time, data, validators)
+    _disk_write(key, time.time() + expire_time, validators, data)
+
+
+def get_validators(key):
+    """Return the HTTP cache validators stored with an item, whether the item has expired or not.
+
+    """
+    with _lock:
+        item = __cache__.get(key)
+        if item:
+            return item['validators']
+    disk_item = _disk_read(key, float('inf'))
+    if disk_item:
+        return disk_item[1]
+    return None
+
+
+def renew(key, expire_time=DFLT_EXPIRE_TIME):
+    """Extend the lifetime of an item, expired or not, by `expire_time` seconds from now.
+    Typically used when the server has confirmed that the cached data is still up to date.
+
+    Return the item's data, or None if the item is not in the cache.
+
+    """
+    with _lock:
+        item = __cache__.get(key)
+    if item is None:
+        disk_item = _disk_read(key, 0)
+        if disk_item is None:
+            return None
+        item = _mem_store(key, 0, disk_item[2], disk_item[1])
+    with _lock:
+        item['expires'] = time.monotonic() + expire_time
+    _disk_renew(key, time.time() + expire_time)
+    logger.debug("Data cache: renewed")
+    metrics.count('cache_revalidated')
+    return item['data']
+
+
+def expires_in(key):
+    """Return the number of seconds until an item expires, which is negative when the
+    item has expired, or None if the item is not in the cache.
+
+    """
+    with _lock:
+        item = __cache__.get(key)
+        if item:
+            return item['expires'] - time.monotonic()
+    disk_item = _disk_read(key, float('inf'))
+    if disk_item:
+        return disk_item[0] - time.time()
+    return None
+
+
+def release(key):
+    """Remove an item from the memory cache only. The item remains available on
+    disk, e.g. to revalidate data with its HTTP cache validators.
+
     """
-    item = dict(expires=time.monotonic() + expire_time,
-                data=data)
-    __cache__[key] = item
+    global _mem_size
+    with _lock:
+        item = __cache__.pop(key, None)
+        if item:
+            _mem_size -= item['size']
 
 
 def clean():
     """Remove expired items form the cache"""
+    global _mem_size
     now = time.monotonic()
-    for key, item in list(__cache__.items()):
-        if item['expires'] < now:
-            logger.debug('Data cache clean removed: %s', key)
-            del __cache__[key]
+    with _lock:
+        for key, item in list(__cache__.items()):
+            if item['expires'] < now:
+                logger.debug('Data cache clean removed: %s', key)
+                del __cache__[key]
+                _mem_size -= item['size']
 
 
 def purge():
     """Empty the cache"""
-    __cache__.clear()
+    global _mem_size
+    with _lock:
+        __cache__.clear()
+        _mem_size = 0
+    try:
+        with os.scandir(DISK_CACHE_DIR) as entries:
+            for entry in entries:
+                _disk_remove(entry.path)
+    except FileNotFoundError:
+        pass
+
+
+def size(in_bytes=False):
+    """Return the number of items in the memory cache, or, if `in_bytes` is True,
+    the estimated amount of memory they use.
+
+    """
+    if in_bytes:
+        return _mem_size
+    return len(__cache__)
+
+
+def estimate_size(obj):
+    """Return an estimate of the number of bytes of memory used by `obj`, including
+    all objects it refers to.
+
+    Only the containers data parsed from JSON consist of, and objects with __slots__,
+    like the items of listings, are traversed.
+    """
+    getsizeof = sys.getsizeof
+    seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple)):
+            stack.extend(o)
+        else:
+            slots = getattr(type(o), '__slots__', None)
+            if slots and not isinstance(slots, str):
+                stack.extend(getattr(o, name, None) for name in slots)
+    return total
+
+
+def _mem_store(key, expires, data, validators):
+    """Store an item in memory and keep the memory cache within its limits.
+    Return the new item.
+
+    """
+    global _mem_size
+    item = dict(expires=expires,
+                data=data,
+                validators=validators,
+                size=estimate_size(data))
+    with _lock:
+        old_item = __cache__.pop(key, None)
+        if old_item:
+            _mem_size -= old_item['size']
+        __cache__[key] = item
+        _mem_size += item['size']
+
+        if _mem_size > MEM_CACHE_MAX_SIZE:
+            clean()
+        while _mem_size > MEM_CACHE_MAX_SIZE and len(__cache__) > 1:
+            lru_key, lru_item = __cache__.popitem(last=False)
+            _mem_size -= lru_item['size']
+            logger.debug("Data cache: evicted %s", lru_key)
+    return item
+
+
+def _disk_path(key):
+    return os.path.join(DISK_CACHE_DIR, hashlib.sha1(key.encode('utf8')).hexdigest())
+
+
+def _disk_remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _disk_read(key, min_expires):
+    """Read an item from the disk cache.
+
+    Return a tuple (expires, validators, data), or None if the item is not on disk.
+    To avoid unpickling data that is not going to be used, data is only loaded when
+    the item expires after `min_expires`, otherwise data is None.
+
+    """
+    path = _disk_path(key)
+    # noinspection PyBroadException
+    try:
+        with open(path, 'rb') as f:
+            expires = float(f.read(_HEADER_SIZE))
+            validators = pickle.load(f)
+            if expires <= min_expires:
+                return expires, validators, None
+            data = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as err:
+        # A file that cannot be read is of no use to anybody.
+        logger.warning("Disk cache: removing unreadable item %s: %r", key, err)
+        _disk_remove(path)
+        return None
+    # Mark the item as recently used. The file may just have been replaced or evicted by another thread.
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return expires, validators, data
+
+
+def _disk_write(key, expires, validators, data):
+    """Write an item to the disk cache."""
+    # noinspection PyBroadException
+    try:
+        os.makedirs(DISK_CACHE_DIR, exist_ok=True)
+        utils.atomic_write(_disk_path(key), b''.join((_HEADER_FMT % expires,
+                                                     pickle.dumps(validators, protocol=pickle.HIGHEST_PROTOCOL),
+                                                     pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))))
+    except Exception as err:
+        logger.warning("Disk cache: failed to write item %s: %r", key, err)
+        return
+    # noinspection PyBroadException
+    try:
+        _disk_evict()
+    except Exception as err:
+        logger.warning("Disk cache: failed to evict items: %r", err)
+
+
+def _disk_renew(key, expires):
+    """Update the expiry time of an item on disk in place."""
+    try:
+        with open(_disk_path(key), 'r+b') as f:
+            f.write(_HEADER_FMT % expires)
+    except OSError:
+        pass
+
+
+def _disk_evict():
+    """Remove the least recently used items until the disk cache is no larger than DISK_CACHE_MAX_SIZE.
+    Temporary files left behind by an interrupted write are removed as well.
+
+    Other threads may write, replace, or remove files at the same time, so files that
+    disappear while the directory is being scanned are skipped.
+
+    """
+    files = []
+    total_size = 0
+    now = time.time()
+    with os.scandir(DISK_CACHE_DIR) as entries:
+        for entry in entries:
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if entry.name.endswith('.tmp'):
+                if stat.st_mtime < now - 60:
+                    _disk_remove(entry.path)
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
 
+    if total_size <= DISK_CACHE_MAX_SIZE:
+        return
 
-def size():
-    return len(__cache__)
\ No newline at end of file
+    files.sort()
+    for _, file_size, path in files:
+        _disk_remove(path)
+        total_size -= file_size
+        logger.debug("Disk cache: evicted %s", path)
+        if total_size <= DISK_CACHE_MAX_SIZE:
+            break
@@ -0,0 +1,321 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022 Dimitri Kroon.
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+"""
+Capture and replay of HTTP traffic.
+
+When enabled in the settings, every request made through fetch.HttpSession during a
+route, and its response, is recorded in a file in HAR format in the directory CAPTURE_DIR
+in the addon's profile. A capture can be attached to a report of a performance problem,
+and be opened in the network panel of a web browser's developer tools.
+
+Authentication tokens, passwords, user names, cookie values and the tokens of signed
+urls are redacted before they are written.
+
+In replay mode, requests are not sent, but answered with the responses of a capture
+file. Requests are matched by method and url. Requests that were made more than once
+get their responses in the order they were recorded. Replay is only used by tests and
+benchmarks, see start_replay().
+"""
+
+import os
+import time
+import json
+import base64
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from codequick.support import logger_id
+
+from . import utils
+
+
+logger = logging.getLogger(logger_id + '.capture')
+
+CAPTURE_DIR = 'captures'
+# The number of capture files kept, older files are removed.
+MAX_CAPTURE_FILES = 10
+
+REDACTED = '[redacted]'
+# Headers, query parameters and json members of which the values are redacted. All in lower case.
+REDACTED_HEADERS = ('authorization', 'cookie', 'set-cookie')
+REDACTED_FIELDS = ('access_token', 'refresh_token', 'id_token', 'token', 'refresh', 'password', 'username',
+                   'itvuserid')
+# Parameters of signed urls, like those of manifests and subtitles, in the query or as
+# a segment of the path. Akamai tokens look like 'hdnea=exp=1669...~acl=/*~hmac=0a1b...'.
+REDACTED_URL_PARAMS = REDACTED_FIELDS + ('hdnea', 'hdntl', 'hdnts', 'hmac', 'sig', 'signature', 'policy',
+                                         'key-pair-id', 'x-amz-signature', 'x-amz-credential',
+                                         'x-amz-security-token')
+# Headers of which the value is a url.
+URL_HEADERS = ('location', 'content-location')
+
+# Entries of the current capture, or None if not capturing.
+_entries = None
+_route = None
+_lock = threading.Lock()
+
+# Recorded responses per (method, url) while replaying, or None if not replaying.
+_replay_entries = None
+
+
+class ReplayError(requests.ConnectionError):
+    """Raised in replay mode when a request has no recorded response.
+    A subclass of ConnectionError, so the addon handles it as if the request failed.
+
+    """
+
+
+def start_capture(url):
+    """Start capturing the HTTP traffic of the route of plugin url `url`, if
+    enabled in the settings.
+
+    """
+    global _entries, _route
+    enabled = utils.setting_enabled('capture-requests')
+    with _lock:
+        if not enabled:
+            _entries = None
+            return
+        _entries = []
+        _route = url
+    logger.info("Capturing HTTP traffic of route %s", url)
+
+
+def is_capturing():
+    return _entries is not None
+
+
+def stop_capture():
+    """Stop capturing and write all entries recorded since start_capture() to a new file
+    in CAPTURE_DIR. Return the path of the file, or None if not capturing.
+
+    """
+    global _entries
+    with _lock:
+        if _entries is None:
+            return None
+        entries = _entries
+        _entries = None
+
+    capture_dir = os.path.join(utils.addon_info['profile'], CAPTURE_DIR)
+    route_name = urlsplit(_route).path.strip('/').replace('/', '.') or 'root'
+    capture_file = os.path.join(capture_dir, 'capture-{}-{}.har'.format(time.strftime('%Y%m%d-%H%M%S'), route_name))
+    har = {'log': {'version': '1.2',
+                   'creator': {'name': utils.addon_info['id'], 'version': utils.addon_info['version']},
+                   'comment': _route,
+                   'entries': sorted(entries, key=lambda e: e['startedDateTime'])}}
+    # noinspection PyBroadException
+    try:
+        os.makedirs(capture_dir, exist_ok=True)
+        utils.atomic_write(capture_file, json.dumps(har, indent=1))
+        utils.remove_old_files(capture_dir, 'capture-', MAX_CAPTURE_FILES)
+    except:
+        logger.error("Failed to write capture file", exc_info=True)
+        return None
+    logger.info("HTTP traffic written to %s", capture_file)
+    return capture_file
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+#   Redaction
+# ---------------------------------------------------------------------------------------------------------------------
+
+def redact_url(url):
+    """Return `url` with the values of the parameters in REDACTED_URL_PARAMS redacted,
+    both in the query and in the path. Urls without such parameters are returned unchanged.
+
+    """
+    parts = urlsplit(url)
+    path = parts.path
+    if '=' in path:
+        path = '/'.join(_redact_path_segment(segment) for segment in path.split('/'))
+    query = parts.query
+    if query:
+        params = parse_qsl(query, keep_blank_values=True)
+        if any(k.lower() in REDACTED_URL_PARAMS for k, _ in params):
+            query = urlencode([(k, REDACTED if k.lower() in REDACTED_URL_PARAMS else v) for k, v in params])
+    if path == parts.path and query == parts.query:
+        return url
+    return urlunsplit((parts.scheme, parts.netloc, path, query, parts.fragment))
+
+
+def _redact_path_segment(segment):
+    name, sep, _ = segment.partition('=')
+    if sep and name.lower() in REDACTED_URL_PARAMS:
+        return name + '=' + REDACTED
+    return segment
+
+
+def redact_headers(headers):
+    redacted = []
+    for name, value in headers.items():
+        lower_name = name.lower()
+        if lower_name in REDACTED_HEADERS:
+            value = REDACTED
+        elif lower_name in URL_HEADERS:
+            value = redact_url(value)
+        redacted.append({'name': name, 'value': value})
+    return redacted
+
+
+def redact_json(data):
+    """Return a copy of `data` with the values of all members named in REDACTED_FIELDS redacted,
+    at any level of nesting. Urls, like those of manifests in a playlist, are redacted by redact_url().
+
+    """
+    if isinstance(data, dict):
+        return {k: REDACTED if k.lower() in REDACTED_FIELDS else redact_json(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [redact_json(item) for item in data]
+    if isinstance(data, str) and data.startswith(('https://', 'http://')):
+        return redact_url(data)
+    return data
+
+
+def _redact_body(body, mime_type):
+    """Return the body of a request or response as text suitable for a HAR entry."""
+    if not body:
+        return {'text': ''}
+    if isinstance(body, str):
+        body = body.encode('utf8')
+    if 'json' in mime_type:
+        try:
+            return {'text': json.dumps(redact_json(json.loads(body)))}
+        except ValueError:
+            pass
+    try:
+        return {'text': body.decode('utf8')}
+    except UnicodeDecodeError:
+        return {'text': base64.b64encode(body).decode('ascii'), 'encoding': 'base64'}
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+#   Recording
+# ---------------------------------------------------------------------------------------------------------------------
+
+def record(resp, start_time, duration):
+    """Record a request and its response `resp`. The request started at `start_time`,
+    a timestamp as returned by time.time(), and took `duration` seconds.
+
+    The body of a streamed response is read in full, so it can be recorded, but it
+    can still be read by the caller afterwards.
+
+    """
+    # noinspection PyBroadException
+    try:
+        read_start = time.monotonic()
+        content = resp.content
+        duration += time.monotonic() - read_start
+        # After redirects, resp.request is the last request, rather than the one that was made.
+        req = resp.history[0].request if resp.history else resp.request
+        req_mime_type = req.headers.get('Content-Type', '')
+        resp_mime_type = resp.headers.get('Content-Type', '')
+        wait = resp.elapsed.total_seconds() * 1000
+        entry = {
+            'startedDateTime': datetime.fromtimestamp(start_time, timezone.utc).isoformat(),
+            'time': round(duration * 1000, 3),
+            'request': {
+                'method': req.method,
+                'url': redact_url(req.url),
+                'httpVersion': 'HTTP/1.1',
+                'headers': redact_headers(req.headers),
+                'queryString': [],
+                'cookies': [],
+                'headersSize': -1,
+                'bodySize': len(req.body or b''),
+            },
+            'response': {
+                'status': resp.status_code,
+                'statusText': resp.reason or '',
+                'httpVersion': 'HTTP/1.1',
+                'headers': redact_headers(resp.headers),
+                'cookies': [],
+                'content': dict(size=len(content), mimeType=resp_mime_type, **_redact_body(content, resp_mime_type)),
+                'redirectURL': redact_url(resp.headers.get('Location', '')),
+                'headersSize': -1,
+                'bodySize': len(content),
+            },
+            'cache': {},
+            'timings': {'send': 0, 'wait': round(wait, 3), 'receive': round(max(0.0, duration * 1000 - wait), 3)},
+        }
+        if req.body:
+            entry['request']['postData'] = dict(mimeType=req_mime_type, **_redact_body(req.body, req_mime_type))
+    except:
+        logger.warning("Failed to capture request", exc_info=True)
+        return
+    with _lock:
+        if _entries is not None:
+            _entries.append(entry)
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+#   Replay
+# ---------------------------------------------------------------------------------------------------------------------
+
+def start_replay(capture_file):
+    """Answer all subsequent requests with the responses recorded in `capture_file`."""
+    global _replay_entries
+    with open(capture_file, 'r') as f:
+        har = json.load(f)
+    replay_entries = {}
+    for entry in har['log']['entries']:
+        key = (entry['request']['method'], entry['request']['url'])
+        replay_entries.setdefault(key, []).append(entry)
+    with _lock:
+        _replay_entries = replay_entries
+    logger.info("Replaying HTTP traffic from %s", capture_file)
+
+
+def stop_replay():
+    global _replay_entries
+    with _lock:
+        _replay_entries = None
+
+
+def is_replaying():
+    return _replay_entries is not None
+
+
+def replay(method, url, params=None):
+    """Return a requests.Response built from the recorded response to the request of
+    `method` to `url` with query parameters `params`.
+
+    Raise ReplayError if the capture has no such request.
+
+    """
+    full_url = requests.Request(method, url, params=params).prepare().url
+    key = (method.upper(), redact_url(full_url))
+    with _lock:
+        entries = _replay_entries.get(key)
+        if not entries:
+            raise ReplayError("No recorded response to {} {}".format(*key))
+        # The last response is repeated when a request is made more often than it was recorded.
+        entry = entries.pop(0) if len(entries) > 1 else entries[0]
+
+    resp_data = entry['response']
+    content = resp_data['content']
+    if content.get('encoding') == 'base64':
+        body = base64.b64decode(content['text'])
+    else:
+        body = content.get('text', '').encode('utf8')
+    resp = requests.Response()
+    resp.status_code = resp_data['status']
+    resp.reason = resp_data['statusText']
+    resp.headers = CaseInsensitiveDict((h['name'], h['value']) for h in resp_data['headers']
+                                       if h['name'].lower() not in REDACTED_HEADERS)
+    # The recorded body has been decoded already.
+    resp.headers.pop('Content-Encoding', None)
+    resp.url = full_url
+    resp._content = body
+    resp._content_consumed = True
+    resp.elapsed = timedelta(milliseconds=max(0, entry['timings']['wait']))
+    resp.request = requests.Request(method, full_url).prepare()
+    return resp
@@ -6,10 +6,12 @@
 #  This file is part of plugin.video.cinetree
 # ---------------------------------------------------------------------------------------------------------------------
 
-from codequick import Route, Listitem
+from codequick import Route, Resolver, Listitem
 # noinspection PyProtectedMember
 from codequick.listing import strip_formatting
 
+from resources.lib import tracing
+
 
 def patch_cc_route():
     """
@@ -55,3 +57,45 @@ def patch_label_prop():
         self.info.setdefault("title", unformatted_label)
 
     Listitem.label = Listitem.label.setter(label_setter)
+
+
+def patch_tracing():
+    """
+    Trace the execution of routes and resolvers, and the creation of listitems
+    by monkey patching ``Route.__call__``, ``Resolver.__call__`` and ``Listitem.from_dict``.
+
+    The span of a route includes codequick's processing of the items the route returns.
+    Nothing is recorded unless tracing has been started; see module tracing.
+
+    Call after ``patch_cc_route()``.
+
+    With reuselanguageinvoker, addon.py runs again on each invocation, while codequick
+    remains imported. Patches are marked, so functions are traced only once, no matter
+    how often this is called.
+
+    """
+    def patch_call(callback_type):
+        original_call = callback_type.__call__
+        if getattr(original_call, 'traced', False):
+            return
+
+        def traced_call(self, route, args, kwargs):
+            with tracing.span(getattr(route, 'path', None) or str(route), callback_type.__name__.lower()):
+                return original_call(self, route, args, kwargs)
+
+        traced_call.traced = True
+        callback_type.__call__ = traced_call
+
+    patch_call(Route)
+    patch_call(Resolver)
+
+    original_from_dict = Listitem.from_dict
+    if getattr(original_from_dict, 'traced', False):
+        return
+
+    @tracing.traced(cat='listitem')
+    def from_dict(_, *args, **kwargs):
+        return original_from_dict(*args, **kwargs)
+
+    from_dict.traced = True
+    Listitem.from_dict = classmethod(from_dict)
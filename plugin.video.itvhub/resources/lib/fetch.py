@@ -10,39 +10,208 @@ import logging
 import requests
 import pickle
 import time
-from requests.cookies import RequestsCookieJar
+import random
+import threading
+import atexit
+from concurrent import futures
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.cookies import RequestsCookieJar, create_cookie
+from urllib.parse import urlsplit
 import json
+import queue
+from collections import deque
 
 from codequick import Script
 from codequick.support import logger_id
 
 from resources.lib.errors import *
 from resources.lib import utils
+from resources.lib import metrics
+from resources.lib import tracing
+from resources.lib import capture
+from resources.lib import parsex
 
 
 WEB_TIMEOUT = (3.5, 7)
 USER_AGENT = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:104.0) Gecko/20100101 Firefox/104.0'
 
+# Connection pooling. POOL_CONNECTIONS is the number of hosts for which a pool is kept,
+# POOL_MAXSIZE the number of connections kept alive per host. Connections to a host that
+# has not been used for POOL_IDLE_TIMEOUT seconds are closed before the next request, so we
+# don't run into connections that have been silently dropped by the server in the meantime.
+POOL_CONNECTIONS = 6
+POOL_MAXSIZE = 4
+POOL_IDLE_TIMEOUT = 50
+
+# Streamed documents are read in chunks of DOC_CHUNK_SIZE bytes. When a streamed response
+# is closed before all data has been read, a remainder of at most MAX_DRAIN_SIZE bytes is
+# read and discarded, so the connection can be reused.
+DOC_CHUNK_SIZE = 65536
+MAX_DRAIN_SIZE = 16384
+
+# The maximum number of requests running concurrently on the thread pool. Should not
+# exceed POOL_MAXSIZE, or requests to the same host would have to wait for a connection.
+MAX_WORKERS = 4
+
+# Retry and circuit breaker policy per host. Hosts not listed use the policy of '*'.
+#   retries:        The maximum number of times a failed idempotent request is retried.
+#   backoff:        Upper limit in seconds of the random delay before the first retry,
+#                   doubled on every subsequent retry.
+#   deadline:       Retries are only made if the request is still expected to complete
+#                   within `deadline` seconds from the first attempt.
+#   fail_threshold: The number of consecutive failures after which the circuit opens and
+#                   requests to the host fail immediately.
+#   open_time:      Seconds the circuit stays open before a trial request is let through.
+HOST_POLICIES = {
+    '*': {'retries': 1, 'backoff': 0.5, 'deadline': 15, 'fail_threshold': 5, 'open_time': 30},
+    'nownext.oasvc.itv.com': {'retries': 2, 'backoff': 0.25},
+    'textsearch.prd.oasvc.itv.com': {'retries': 2, 'backoff': 0.25},
+}
+# Only requests with these methods are retried.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+# Responses with these status codes are retried and count as a failure of the host.
+RETRY_STATUS_CODES = (502, 503, 504)
+
+# The response times of the last LATENCY_WINDOW successful requests are kept per host and
+# endpoint class (see get_endpoint_class()), and saved to LATENCY_FILE between runs.
+LATENCY_WINDOW = 50
+LATENCY_FILE = 'latency.json'
+
+# Adaptive timeouts. Once TIMEOUT_MIN_SAMPLES response times of an endpoint class are known,
+# the read timeout is TIMEOUT_FACTOR times the TIMEOUT_PERCENTILE of those response times,
+# and the connect timeout TIMEOUT_FACTOR times the median response time of the host's
+# fastest endpoint class. Both are kept within their bounds. Until then, WEB_TIMEOUT is used.
+TIMEOUT_MIN_SAMPLES = 10
+TIMEOUT_PERCENTILE = 95
+TIMEOUT_FACTOR = 3
+CONNECT_TIMEOUT_BOUNDS = (2, 7)
+READ_TIMEOUT_BOUNDS = (3, 20)
+
+# Hedged requests. A hedged request sends a second, identical request if no response
+# has been received after the HEDGE_PERCENTILE of the host's response times, provided
+# at least HEDGE_MIN_SAMPLES response times are known. The extra requests are limited to
+# HEDGE_MAX_RATIO of all hedged requests to a host, plus HEDGE_BURST.
+HEDGE_PERCENTILE = 90
+HEDGE_MIN_SAMPLES = 5
+HEDGE_MAX_RATIO = 0.1
+HEDGE_BURST = 2
+
+COOKIE_FILE = 'cookies.json'
+# The pickled cookiejar of previous versions.
+LEGACY_COOKIE_FILE = 'cookies'
+# Changed cookies are written to file at most once every COOKIE_SAVE_INTERVAL seconds.
+COOKIE_SAVE_INTERVAL = 10
+# Attributes of http.cookiejar.Cookie that are saved to file, apart from the non-standard
+# attributes in Cookie._rest.
+COOKIE_ATTRS = ('version', 'name', 'value', 'port', 'domain', 'path', 'secure',
+                'expires', 'discard', 'comment', 'comment_url')
+
+# Lifetime of the cookie consent, and the time before its expiry at which it is renewed.
+CONSENT_MAX_AGE = 3650 * 86400
+CONSENT_RENEW_TIME = 30 * 86400
+# Non-standard cookie attribute that marks the cookies set by the cookie consent.
+CONSENT_ATTR = 'X-Itvx-Consent'
+
 
 logger = logging.getLogger('.'.join((logger_id, __name__.split('.', 2)[-1])))
 session = None
+_session_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+# Requests on multiple threads may want to save cookies at the same time.
+_cookie_save_lock = threading.Lock()
+_consent_future = None
+_consent_lock = threading.Lock()
+_breakers = {}
+_breakers_lock = threading.Lock()
+_latencies = None
+_latencies_changed = False
+_hedge_counts = {}
+_stats_lock = threading.Lock()
 
 
 class PersistentCookieJar(RequestsCookieJar):
+    """A cookiejar that saves its cookies to a file in json format.
+
+    Saving is deferred: changes are written to file at most once every COOKIE_SAVE_INTERVAL
+    seconds, so cookies set by a series of requests result in a single write.
+    Call `flush()` to write pending changes immediately.
+
+    """
     def __init__(self, filename, policy=None):
         RequestsCookieJar.__init__(self, policy)
         self.filename = filename
         self._has_changed = False
+        self._last_saved = 0
+        self._save_timer = None
 
     def save(self):
+        """Save changed cookies, either immediately, or by a deferred write if the
+        cookies have been written less than COOKIE_SAVE_INTERVAL seconds ago.
+
+        """
         if not self._has_changed:
             return
-        self.clear_expired_cookies()
-        self._has_changed = False
-        with open(self.filename, 'wb') as f:
-            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with _cookie_save_lock:
+            if self._save_timer is not None:
+                # A write is already pending.
+                return
+            delay = self._last_saved + COOKIE_SAVE_INTERVAL - time.monotonic()
+            if delay > 0:
+                self._save_timer = threading.Timer(delay, self.flush)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        """Write the cookies to file now, if any has changed."""
+        with _cookie_save_lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if not self._has_changed:
+                return
+            self.clear_expired_cookies()
+            self._has_changed = False
+            cookies = []
+            # Cookies may be set by other threads while the file is being written.
+            # noinspection PyProtectedMember
+            with self._cookies_lock:
+                all_cookies = list(self)
+            for cookie in all_cookies:
+                cookie_data = {attr: getattr(cookie, attr) for attr in COOKIE_ATTRS}
+                # noinspection PyProtectedMember
+                cookie_data['rest'] = cookie._rest
+                cookies.append(cookie_data)
+            # noinspection PyBroadException
+            try:
+                utils.atomic_write(self.filename, json.dumps({'vers': 1, 'cookies': cookies}, separators=(',', ':')))
+            except:
+                logger.error("Failed to save cookies to file %s", self.filename, exc_info=True)
+                return
+            self._last_saved = time.monotonic()
         logger.info("Saved cookies to file %s", self.filename)
 
+    def load(self):
+        """Load cookies from file.
+
+        Raises FileNotFoundError if there is no cookie file, or ValueError if the file's
+        content is not valid.
+
+        """
+        with open(self.filename, 'r') as f:
+            try:
+                cookies = json.load(f)['cookies']
+                for cookie_data in cookies:
+                    super(PersistentCookieJar, self).set_cookie(create_cookie(**cookie_data))
+            except (KeyError, TypeError) as err:
+                raise ValueError("Invalid cookie file: {!r}".format(err))
+
     def set_cookie(self, cookie, *args, **kwargs):
         super(PersistentCookieJar, self).set_cookie(cookie, *args, **kwargs)
         logger.debug("Cookiejar sets cookie %s to %s", cookie.name, cookie.value)
@@ -54,19 +223,104 @@ class PersistentCookieJar(RequestsCookieJar):
         self._has_changed = True
 
 
+class TimedHTTPConnection(HTTPConnection):
+    """A HTTPConnection that records the time it takes to connect. Name resolution
+    is included in the connect time.
+
+    """
+    def connect(self):
+        start = time.perf_counter()
+        super(TimedHTTPConnection, self).connect()
+        metrics.record('connect', (time.perf_counter() - start) * 1000, self.host)
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    """A HTTPSConnection that records the time it takes to connect and the time of
+    the TLS handshake separately. Name resolution is included in the connect time.
+
+    """
+    _connect_time = 0
+
+    def _new_conn(self):
+        start = time.perf_counter()
+        sock = super(TimedHTTPSConnection, self)._new_conn()
+        self._connect_time = time.perf_counter() - start
+        return sock
+
+    def connect(self):
+        self._connect_time = 0
+        start = time.perf_counter()
+        super(TimedHTTPSConnection, self).connect()
+        duration = time.perf_counter() - start
+        metrics.record('connect', self._connect_time * 1000, self.host)
+        metrics.record('tls', (duration - self._connect_time) * 1000, self.host)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """A HTTPAdapter that keeps connections alive between requests and closes
+    a host's connections once they have been idle for too long.
+
+    """
+    def __init__(self, idle_timeout=POOL_IDLE_TIMEOUT, **kwargs):
+        self.idle_timeout = idle_timeout
+        self._last_used = {}
+        super(KeepAliveAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(KeepAliveAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool,
+                                                   'https': TimedHTTPSConnectionPool}
+
+    def send(self, request, *args, **kwargs):
+        url = urlsplit(request.url)
+        host_key = (url.scheme, url.hostname, url.port or (443 if url.scheme == 'https' else 80))
+        now = time.monotonic()
+        last_used = self._last_used.get(host_key)
+        if last_used is not None and now - last_used > self.idle_timeout:
+            self.close_host_pool(*host_key)
+        self._last_used[host_key] = now
+        return super(KeepAliveAdapter, self).send(request, *args, **kwargs)
+
+    def close_host_pool(self, scheme, host, port):
+        """Close all connections to a single host, leaving the pools of other hosts intact."""
+        pools = self.poolmanager.pools
+        for pool_key in list(pools.keys()):
+            if pool_key.key_scheme == scheme and pool_key.key_host == host and pool_key.key_port == port:
+                logger.debug("Closing idle connections to %s", host)
+                pool = pools[pool_key]
+                del pools[pool_key]
+                pool.close()
+
+
 class HttpSession(requests.sessions.Session):
     instance = None
 
     def __new__(cls):
-        if cls.instance is None:
-            cls.instance = super(HttpSession, cls).__new__(cls)
-        return cls.instance
+        # The first requests of an invocation may run concurrently, so the session is
+        # created and fully set up under a lock, before it is made available to other threads.
+        instance = cls.instance
+        if instance is None:
+            with _session_lock:
+                instance = cls.instance
+                if instance is None:
+                    instance = super(HttpSession, cls).__new__(cls)
+                    instance._setup()
+                    cls.instance = instance
+        return instance
 
     def __init__(self):
-        if hasattr(self, 'cookies'):
-            # prevent re-initialization when __new__ returns an existing instance
-            return
+        # All initialisation is done once by _setup(), not each time __new__ returns the existing instance.
+        pass
 
+    def _setup(self):
         super(HttpSession, self).__init__()
         self.headers.update({
             'User-Agent': USER_AGENT,
@@ -75,10 +329,11 @@ class HttpSession(requests.sessions.Session):
             'Sec-Fetch-Dest': 'empty',
             'Sec-Fetch-Mode': 'cors',
             'Sec-Fetch-Site': 'same-site',
-            'Cache-Control': 'no-cache',
-            'Pragma': 'no-cache',
         })
         self.cookies = _create_cookiejar()
+        adapter = KeepAliveAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
 
     # noinspection PyShadowingNames
     def request(
@@ -87,12 +342,18 @@ class HttpSession(requests.sessions.Session):
             auth=None, timeout=None, allow_redirects=True, proxies=None,
             hooks=None, stream=None, verify=None, cert=None, json=None):
 
+        if capture.is_replaying():
+            return capture.replay(method, url, params)
+
+        start_time = time.time()
         resp = super(HttpSession, self).request(
                 method, url,
                 params=params, data=data, headers=headers, cookies=cookies, files=files,
                 auth=auth, timeout=timeout, allow_redirects=allow_redirects, proxies=proxies,
                 hooks=hooks, stream=stream, verify=verify, cert=cert, json=json)
 
+        if capture.is_capturing():
+            capture.record(resp, start_time, time.time() - start_time)
         # noinspection PyUnresolvedReferences
         self.cookies.save()
         return resp
@@ -103,39 +364,107 @@ def _create_cookiejar():
     apply the default cookies.
 
     """
-    cookie_file = os.path.join(utils.addon_info['profile'], 'cookies')
+    cookie_file = os.path.join(utils.addon_info['profile'], COOKIE_FILE)
+    cj = PersistentCookieJar(cookie_file)
 
     try:
-        with open(cookie_file, 'rb') as f:
-            # TODO: handle expired consent cookies
-            cj = pickle.load(f)
-            # The internally stored filename of the saved file may be different to the current filename
-            # if the file has been copied from another system.
-            cj.filename = cookie_file
-            logger.debug("Restored cookies from file")
-    except (FileNotFoundError, pickle.UnpicklingError):
-        cj = set_default_cookies(PersistentCookieJar(cookie_file))
-        logger.debug("Created new cookiejar")
+        cj.load()
+        logger.debug("Restored cookies from file")
+        if consent_needs_renewal(cj):
+            renew_consent(cj)
+        return cj
+    except FileNotFoundError:
+        pass
+    except ValueError as err:
+        logger.warning("Failed to load cookies from file: %r", err)
+        cj = PersistentCookieJar(cookie_file)
+
+    if _convert_legacy_cookiejar(cj):
+        renew_consent(cj)
+        return cj
+
+    # Consent to cookies requires a request to a third party. Don't let the user
+    # wait for that; the first requests to ITV will just go without consent cookies.
+    set_std_cookies(cj)
+    renew_consent(cj)
+    logger.debug("Created new cookiejar")
     return cj
 
 
+def _convert_legacy_cookiejar(cookiejar):
+    """Copy the cookies from a cookiejar pickled by a previous version of the addon
+    to `cookiejar`, save them in the current format and remove the old file.
+
+    Return True on success, or False if there is no usable old cookiejar.
+
+    """
+    legacy_file = os.path.join(utils.addon_info['profile'], LEGACY_COOKIE_FILE)
+    # noinspection PyBroadException
+    try:
+        with open(legacy_file, 'rb') as f:
+            legacy_cj = pickle.load(f)
+    except FileNotFoundError:
+        return False
+    except:
+        logger.warning("Failed to load legacy cookie file", exc_info=True)
+        return False
+
+    for cookie in legacy_cj:
+        cookiejar.set_cookie(cookie)
+    cookiejar.flush()
+    os.remove(legacy_file)
+    logger.info("Converted legacy cookie file")
+    return True
+
+
+def flush_cookies():
+    """Write pending changes of the session's cookies to file."""
+    http_session = HttpSession.instance
+    if http_session is not None and isinstance(http_session.cookies, PersistentCookieJar):
+        http_session.cookies.flush()
+
+
+def save_state():
+    """Save cookies and response times to file."""
+    flush_cookies()
+    save_latencies()
+
+
+atexit.register(save_state)
+
+
 def set_default_cookies(cookiejar: RequestsCookieJar = None):
+    """Set the cookie consent and other default cookies of a new cookiejar.
+
+    This blocks on a request to a third-party service; see `renew_consent()` for a
+    non-blocking alternative.
+
+    Return the cookiejar
+
+    """
+    if cookiejar is None:
+        cookiejar = RequestsCookieJar()
+    elif not isinstance(cookiejar, RequestsCookieJar):
+        raise ValueError("Parameter cookiejar must be an instance of RequestCookiejar")
+    update_consent(cookiejar)
+    set_std_cookies(cookiejar)
+    return cookiejar
+
+
+def update_consent(cookiejar: RequestsCookieJar):
     """Make a request to reject all cookies.
 
     Ironically, the response sets third-party cookies to store that data.
     Because of that they are rejected by requests, so the cookies are added
     manually to the cookiejar.
 
-    Return the cookiejar
+    Return True on success, or False if the consent could not be updated.
 
     """
     # noinspection PyBroadException
     try:
         s = requests.Session()
-        if isinstance(cookiejar, RequestsCookieJar):
-            s.cookies = cookiejar
-        elif cookiejar is not None:
-            raise ValueError("Parameter cookiejar must be an instance of RequestCookiejar")
+        s.cookies = cookiejar
 
         # Make a request to reject all cookies.
         resp = s.get(
@@ -161,30 +490,304 @@ def set_default_cookies(cookiejar: RequestsCookieJar = None):
         resp.raise_for_status()
         consent = resp.json()['CassieConsent']
         cookie_data = json.loads(consent)
-        jar = s.cookies
 
-        std_cookie_args = {'domain': '.itv.com', 'expires': time.time() + 3650 * 86400, 'discard': False}
+        consent_cookie_args = {'domain': '.itv.com', 'expires': time.time() + CONSENT_MAX_AGE, 'discard': False,
+                               'rest': {CONSENT_ATTR: None}}
         for cookie_name, cookie_value in cookie_data.items():
-            jar.set(cookie_name, cookie_value, **std_cookie_args)
+            cookiejar.set(cookie_name, cookie_value, **consent_cookie_args)
         logger.info("updated cookies consent")
-
-        # set other cookies
-        import uuid
-        jar.set('Itv.Cid', str(uuid.uuid4()), **std_cookie_args)
-        jar.set('Itv.Region', 'ITV|null', **std_cookie_args)
-        jar.set("Itv.ParentalControls", '{"active":false,"pin":null,"question":null,"answer":null}', **std_cookie_args)
-        return jar
+        return True
     except:
         logger.error("Unexpected exception while updating cookie consent", exc_info=True)
-        return cookiejar
+        return False
 
 
-def web_request(method, url, headers=None, data=None, **kwargs):
-    http_session = HttpSession()
-    kwargs.setdefault('timeout', WEB_TIMEOUT)
+def set_std_cookies(cookiejar: RequestsCookieJar):
+    """Set the cookies the website sets on a first visit, apart from the cookie consent."""
+    import uuid
+    std_cookie_args = {'domain': '.itv.com', 'expires': time.time() + 3650 * 86400, 'discard': False}
+    cookiejar.set('Itv.Cid', str(uuid.uuid4()), **std_cookie_args)
+    cookiejar.set('Itv.Region', 'ITV|null', **std_cookie_args)
+    cookiejar.set("Itv.ParentalControls", '{"active":false,"pin":null,"question":null,"answer":null}', **std_cookie_args)
+
+
+def consent_needs_renewal(cookiejar: RequestsCookieJar):
+    """Return True if `cookiejar` has no consent cookies, or if they are about to expire."""
+    expires = [cookie.expires or float('inf') for cookie in cookiejar if cookie.has_nonstandard_attr(CONSENT_ATTR)]
+    if not expires:
+        return True
+    return min(expires) < time.time() + CONSENT_RENEW_TIME
+
+
+def renew_consent(cookiejar: PersistentCookieJar):
+    """Update the cookie consent in a background thread and save the cookiejar once done.
+
+    Return a Future, or None if a renewal is already in progress.
+
+    """
+    global _consent_future
+    with _consent_lock:
+        if _consent_future is not None and not _consent_future.done():
+            return None
+        _consent_future = submit(_renew_consent, cookiejar)
+        return _consent_future
+
+
+def _renew_consent(cookiejar):
+    if update_consent(cookiejar):
+        cookiejar.save()
+
+
+def get_validators(resp):
+    """Return the cache validators of a response as a dict, or None if the response
+    has neither an ETag nor a Last-Modified header.
+
+    """
+    validators = {name: resp.headers[name] for name in ('ETag', 'Last-Modified') if name in resp.headers}
+    return validators or None
+
+
+def _cache_headers(validators=None):
+    """Return the cache related headers of a request.
+
+    Without validators, a request is to bypass any cache on the way and always return the
+    full document. With validators, the request is made conditional and the server may
+    respond with 304 - Not Modified.
+
+    """
+    if not validators:
+        return {'Cache-Control': 'no-cache', 'Pragma': 'no-cache'}
+
+    cache_headers = {}
+    if 'ETag' in validators:
+        cache_headers['If-None-Match'] = validators['ETag']
+    if 'Last-Modified' in validators:
+        cache_headers['If-Modified-Since'] = validators['Last-Modified']
+    return cache_headers
+
+
+def single_flight(key, func, *args, **kwargs):
+    """Call `func(*args, **kwargs)` and return the result, unless a call with the same
+    `key` is already in progress on another thread. In that case wait for that call
+    to finish and share its result, or its exception.
+
+    """
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = futures.Future()
+            _in_flight[key] = future
+
+    if not is_leader:
+        logger.debug("Waiting for in-flight call %s", key)
+        return future.result()
+
+    try:
+        result = func(*args, **kwargs)
+    except BaseException as err:
+        with _in_flight_lock:
+            del _in_flight[key]
+        future.set_exception(err)
+        raise
+    with _in_flight_lock:
+        del _in_flight[key]
+    future.set_result(result)
+    return result
+
+
+def web_request(method, url, headers=None, data=None, validators=None, hedge=False, **kwargs):
+    """Make a HTTP request and return the response.
+
+    Pass the `validators` of a previously obtained response to make a conditional request.
+    It is up to the caller to handle a response with status 304 - Not Modified.
+
+    Concurrent identical GET requests are coalesced into a single request, of which
+    all callers receive the same response object. Streamed requests are never shared.
+
+    If `hedge` is True, a second request is sent when the response to the first is slow
+    in coming, and the first response to arrive is returned. Only use this for requests
+    that can safely be made twice.
+
+    """
+    send = _hedged_request if hedge else _web_request
+    if method.upper() == 'GET' and data is None and not kwargs.get('stream'):
+        key = ('GET', url, repr(headers), repr(validators), repr(sorted(kwargs.items())))
+        return single_flight(key, send, method, url, headers, data, validators, **kwargs)
+    return send(method, url, headers, data, validators, **kwargs)
+
+
+def _hedged_request(method, url, headers, *args, **kwargs):
+    """Make a request as `_web_request` does, but send a second request if no response has
+    been received within the usual response time of the host. Return the first successful
+    response, or raise the error of the last failed request.
+
+    Each request runs on its own thread, rather than on the thread pool, since hedged
+    requests may themselves be running on the pool.
+
+    """
+    host = urlsplit(url).hostname
+    delay = get_latency_percentile((host, get_endpoint_class(method, headers)), HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+    results = queue.Queue()
+    _count_hedged(host)
+
+    def run_request():
+        # noinspection PyBroadException
+        try:
+            results.put((True, _web_request(method, url, headers, *args, **kwargs)))
+        except Exception as e:
+            results.put((False, e))
+
+    threading.Thread(target=run_request, daemon=True).start()
+    num_requests = 1
+    try:
+        success, result = results.get(timeout=delay)
+    except queue.Empty:
+        if _acquire_hedge(host):
+            logger.info("No response from %s after %.3f sec, sending hedged request", host, delay)
+            threading.Thread(target=run_request, daemon=True).start()
+            num_requests = 2
+        success, result = results.get()
+
+    if not success and num_requests == 2:
+        success, result = results.get()
+    if success:
+        return result
+    raise result
+
+
+def _count_hedged(host):
+    """Count a hedged request to `host`, whether it will need an extra request or not."""
+    with _stats_lock:
+        num_hedged, num_extra = _hedge_counts.get(host, (0, 0))
+        _hedge_counts[host] = (num_hedged + 1, num_extra)
+
+
+def _acquire_hedge(host):
+    """Return True if an extra request to `host` is allowed within the hedging budget,
+    and count it as sent.
+
+    """
+    with _stats_lock:
+        num_hedged, num_extra = _hedge_counts.get(host, (0, 0))
+        allowed = num_extra < HEDGE_BURST + num_hedged * HEDGE_MAX_RATIO
+        if allowed:
+            _hedge_counts[host] = (num_hedged, num_extra + 1)
+        return allowed
+
+
+def get_endpoint_class(method, headers=None):
+    """Return the class of endpoint a request is made to. Response times are recorded
+    separately for each class, since requests for small JSON objects and big HTML pages
+    take very different amounts of time.
+
+    """
+    accept = (headers or {}).get('Accept', '')
+    if 'json' in accept:
+        return 'json'
+    return 'document' if method.upper() == 'GET' else 'other'
+
+
+def _latency_store():
+    """Return the dict of recorded response times, loading it from file on first use.
+    Must be called with _stats_lock held.
+
+    """
+    global _latencies
+    if _latencies is None:
+        _latencies = {}
+        # noinspection PyBroadException
+        try:
+            with open(os.path.join(utils.addon_info['profile'], LATENCY_FILE), 'r') as f:
+                for host, endpoint_class, samples in json.load(f):
+                    _latencies[(host, endpoint_class)] = deque(samples, maxlen=LATENCY_WINDOW)
+        except FileNotFoundError:
+            pass
+        except:
+            logger.warning("Failed to load response times from file", exc_info=True)
+    return _latencies
+
+
+def save_latencies():
+    """Save the recorded response times to file, if any has been recorded since the last save."""
+    global _latencies_changed
+    with _stats_lock:
+        if not _latencies_changed:
+            return
+        data = [[host, endpoint_class, [round(t, 3) for t in samples]]
+                for (host, endpoint_class), samples in _latencies.items()]
+        _latencies_changed = False
+    # noinspection PyBroadException
+    try:
+        utils.atomic_write(os.path.join(utils.addon_info['profile'], LATENCY_FILE),
+                           json.dumps(data, separators=(',', ':')))
+    except:
+        logger.error("Failed to save response times to file", exc_info=True)
+
+
+def record_latency(key, latency):
+    """Record the time in seconds it took to respond to a request.
+    `key` is a tuple (host, endpoint class).
+
+    """
+    global _latencies_changed
+    with _stats_lock:
+        store = _latency_store()
+        window = store.get(key)
+        if window is None:
+            window = store[key] = deque(maxlen=LATENCY_WINDOW)
+        window.append(latency)
+        _latencies_changed = True
+
+
+def _percentile(samples, percentile):
+    """Return the `percentile` of a sorted list of samples."""
+    return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+
+def get_latency_percentile(key, percentile, min_samples=1):
+    """Return the `percentile` of the recent response times of `key` - a tuple
+    (host, endpoint class) - in seconds, or None if fewer than `min_samples`
+    response times have been recorded.
+
+    """
+    with _stats_lock:
+        samples = sorted(_latency_store().get(key, ()))
+    if not samples or len(samples) < min_samples:
+        return None
+    return _percentile(samples, percentile)
+
+
+def get_timeout(host, endpoint_class):
+    """Return a tuple (connect timeout, read timeout) for a request to an endpoint
+    of class `endpoint_class` on `host`, based on recent response times.
+
+    """
+    with _stats_lock:
+        store = _latency_store()
+        class_samples = sorted(store.get((host, endpoint_class), ()))
+        if len(class_samples) < TIMEOUT_MIN_SAMPLES:
+            return WEB_TIMEOUT
+        # Setting up a connection takes the same time for every endpoint, so the median
+        # response time of the host's fastest endpoint class is the best guide.
+        host_medians = [_percentile(sorted(samples), 50) for (h, _), samples in store.items() if h == host]
+    connect_timeout = TIMEOUT_FACTOR * min(host_medians)
+    read_timeout = TIMEOUT_FACTOR * _percentile(class_samples, TIMEOUT_PERCENTILE)
+    return (min(max(connect_timeout, CONNECT_TIMEOUT_BOUNDS[0]), CONNECT_TIMEOUT_BOUNDS[1]),
+            min(max(read_timeout, READ_TIMEOUT_BOUNDS[0]), READ_TIMEOUT_BOUNDS[1]))
+
+
+def _web_request(method, url, headers, data, validators, **kwargs):
+    latency_key = (urlsplit(url).hostname, get_endpoint_class(method, headers))
+    if 'timeout' not in kwargs:
+        kwargs['timeout'] = get_timeout(*latency_key)
+    req_headers = _cache_headers(validators)
+    if headers:
+        req_headers.update(headers)
     logger.debug("Making %s request to %s", method, url)
     try:
-        resp = http_session.request(method, url, json=data, headers=headers, **kwargs)
+        with tracing.span('web_request', 'fetch', method=method, url=url):
+            resp = _send_request(method, url, latency_key, json=data, headers=req_headers, **kwargs)
         resp.raise_for_status()
         return resp
     except requests.HTTPError as e:
@@ -212,8 +815,214 @@ def web_request(method, url, headers=None, data=None, **kwargs):
     except requests.RequestException as e:
         logger.error('Error connecting to %s: %r', url, e)
         raise FetchError(str(e))
-    finally:
-        http_session.close()
+
+
+class CircuitBreaker:
+    """Keeps track of consecutive failures of requests to a host.
+
+    After `fail_threshold` consecutive failures the circuit opens and requests are refused
+    for `open_time` seconds. After that a single trial request is allowed; the circuit
+    closes if it succeeds, or opens again if it fails.
+
+    """
+    def __init__(self, fail_threshold, open_time):
+        self.fail_threshold = fail_threshold
+        self.open_time = open_time
+        self.failures = 0
+        self.open_until = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.failures < self.fail_threshold:
+                return True
+            if self._trial_running or time.monotonic() < self.open_until:
+                return False
+            self._trial_running = True
+            return True
+
+    def record(self, success):
+        with self._lock:
+            self._trial_running = False
+            if success:
+                self.failures = 0
+            else:
+                self.failures += 1
+                if self.failures >= self.fail_threshold:
+                    self.open_until = time.monotonic() + self.open_time
+
+    def release_trial(self):
+        """End a trial request without a result, so another request can be the trial."""
+        with self._lock:
+            self._trial_running = False
+
+
+def get_host_policy(host):
+    """Return the retry and circuit breaker policy of `host`."""
+    policy = HOST_POLICIES['*'].copy()
+    policy.update(HOST_POLICIES.get(host, {}))
+    return policy
+
+
+def _get_breaker(host, policy):
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(policy['fail_threshold'], policy['open_time'])
+        return breaker
+
+
+def _send_request(method, url, latency_key, **kwargs):
+    """Send a request using the shared HTTP session, retrying idempotent requests
+    according to the policy of the host. Response times are recorded under `latency_key`.
+
+    Return the response, which may have an error status code. Raise FetchError if
+    the host's circuit is open, or requests.RequestException if the request failed.
+
+    """
+    http_session = HttpSession()
+    host = urlsplit(url).hostname
+    policy = get_host_policy(host)
+    breaker = _get_breaker(host, policy)
+    max_tries = policy['retries'] + 1 if method.upper() in IDEMPOTENT_METHODS else 1
+    timeout = kwargs['timeout']
+    max_duration = sum(timeout) if isinstance(timeout, tuple) else timeout
+    deadline = time.monotonic() + policy['deadline']
+    attempt = 1
+
+    while True:
+        if not breaker.allow_request():
+            logger.warning("Refused request to %s: too many failures", host)
+            raise FetchError("Service {} is temporarily unavailable".format(host))
+        try:
+            start_time = time.monotonic()
+            resp = http_session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            breaker.record(False)
+            metrics.count('errors', host)
+            if isinstance(e, requests.ReadTimeout):
+                # The server is alive, but slow. Record the time waited, so the
+                # next request to this endpoint gets a longer timeout.
+                record_latency(latency_key, time.monotonic() - start_time)
+            resp, error = None, e
+        except requests.RequestException:
+            # Other errors, like a broken chunked response, are not retried, but
+            # count as a failure, which also ends a trial request.
+            breaker.record(False)
+            metrics.count('errors', host)
+            raise
+        except:
+            breaker.release_trial()
+            raise
+        else:
+            success = resp.status_code not in RETRY_STATUS_CODES
+            breaker.record(success)
+            if success:
+                duration = time.monotonic() - start_time
+                record_latency(latency_key, duration)
+                _record_response_metrics(resp, host, duration, kwargs.get('stream'))
+                return resp
+            metrics.count('errors', host)
+            error = None
+
+        delay = random.uniform(0, policy['backoff'] * 2 ** (attempt - 1))
+        if attempt >= max_tries or time.monotonic() + delay + max_duration > deadline:
+            if error:
+                raise error
+            return resp
+        if resp is not None:
+            close_stream(resp)
+        logger.info("Retrying %s request to %s in %.2f sec after %s",
+                    method, url, delay, error or resp.status_code)
+        metrics.count('retries', host)
+        time.sleep(delay)
+        attempt += 1
+
+
+def close_stream(resp):
+    """Close a response that has been requested with `stream=True`.
+
+    If only a few bytes remain unread, they are read, so the connection is released
+    to the pool and kept alive, rather than closed.
+
+    """
+    if resp.raw is None:
+        return
+    # noinspection PyBroadException
+    try:
+        resp.raw.read(MAX_DRAIN_SIZE, decode_content=True)
+        metrics.record('wire_bytes', resp.raw.tell(), urlsplit(resp.url).hostname)
+    except:
+        pass
+    resp.close()
+
+
+def _record_response_metrics(resp, host, duration, stream):
+    """Record the time to first byte and, unless the response is streamed, the download
+    time and the size of the body, both as received and decoded.
+
+    """
+    # noinspection PyBroadException
+    try:
+        metrics.count('requests', host)
+        ttfb = resp.elapsed.total_seconds()
+        metrics.record('ttfb', ttfb * 1000, host)
+        if stream:
+            return
+        metrics.record('download', max(0.0, duration - ttfb) * 1000, host)
+        metrics.record('decoded_bytes', len(resp.content), host)
+        if resp.raw is not None:
+            metrics.record('wire_bytes', resp.raw.tell(), host)
+    except:
+        # Metrics must never get in the way of a request.
+        logger.debug("Failed to record metrics of response", exc_info=True)
+
+
+def submit(func, *args, **kwargs):
+    """Schedule `func(*args, **kwargs)` to run on the fetch thread pool and return
+    a concurrent.futures.Future.
+
+    The pool runs no more than MAX_WORKERS calls at the same time, all sharing
+    the connections of HttpSession.
+
+    """
+    global _executor
+    executor = _executor
+    if executor is None:
+        # Calls may be submitted from several threads, but only one pool must be created.
+        with _executor_lock:
+            executor = _executor
+            if executor is None:
+                executor = _executor = futures.ThreadPoolExecutor(max_workers=MAX_WORKERS,
+                                                                  thread_name_prefix='fetch')
+    return executor.submit(func, *args, **kwargs)
+
+
+def get_many(calls, timeout=None):
+    """Run several independent requests concurrently and wait until all have finished.
+
+    `calls` is an iterable of callables that take no arguments, typically functools.partial
+    objects of one of the fetch functions, like `partial(get_json, url, params=query)`.
+    Timeouts of individual requests are passed to the fetch function as usual; `timeout` is
+    the maximum time in seconds to wait for all requests together.
+
+    Return a list of results in the same order as `calls`. Errors are isolated per request:
+    if a call raised an exception, or has not finished within `timeout`, its place in the
+    list holds the exception instead of the result.
+
+    """
+    pending = [submit(call) for call in calls]
+    done, not_done = futures.wait(pending, timeout=timeout)
+    results = []
+    for future in pending:
+        if future in not_done:
+            future.cancel()
+            results.append(FetchError('Request timed out'))
+            continue
+        exc = future.exception()
+        results.append(exc if exc is not None else future.result())
+    return results
 
 
 def post_json(url, data, headers=None, **kwargs):
@@ -223,20 +1032,28 @@ def post_json(url, data, headers=None, **kwargs):
         dflt_headers.update(headers)
     resp = web_request('POST', url, dflt_headers, data, **kwargs)
     try:
-        return resp.json()
+        with metrics.timer('json_parse'):
+            return resp.json()
     except json.JSONDecodeError:
         raise FetchError(Script.localize(30920))
 
 
 def get_json(url, headers=None, **kwargs):
+    """GET JSON data.
+
+    Return None if the response has no content, or, for a conditional request with
+    `validators`, if the data has not been modified since and the caller's copy is
+    still valid.
+    """
     dflt_headers = {'Accept': 'application/json'}
     if headers:
         dflt_headers.update(headers)
     resp = web_request('GET', url, dflt_headers, **kwargs)
-    if resp.status_code == 204:     # No Content
+    if resp.status_code in (204, 304):     # No Content, Not Modified
         return None
     try:
-        return resp.json()
+        with metrics.timer('json_parse'):
+            return resp.json()
     except json.JSONDecodeError:
         raise FetchError(Script.localize(30920))
 
@@ -248,6 +1065,25 @@ def put_json(url, data, headers=None, **kwargs):
     return resp
 
 
+def get_next_data(url, headers=None, **kwargs):
+    """GET an html page and return a tuple of the response and the contents of the
+    page's __NEXT_DATA__ script tag as string, or None if the page does not have that tag.
+
+    The page is streamed and read only up to the end of the script tag. The response is
+    closed before it is returned. If the page has not been modified since a request
+    with `validators`, the response's status is 304 and the data is None.
+
+    """
+    resp = web_request('GET', url, headers, stream=True, **kwargs)
+    try:
+        if resp.status_code == 304:
+            return resp, None
+        with metrics.timer('scrape'):
+            return resp, parsex.extract_next_data(resp.iter_content(DOC_CHUNK_SIZE))
+    finally:
+        close_stream(resp)
+
+
 def get_document(url, headers=None, **kwargs):
     """GET any document. Expects the document to be UTF-8 encoded and returns
     the contents as string.
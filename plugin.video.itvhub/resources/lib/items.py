@@ -0,0 +1,187 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022 Dimitri Kroon.
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+"""
+Compact models of the items of listings.
+
+The parsers return these objects, rather than the nested dicts of label, art, info and
+params that codequick's Listitem.from_dict() takes. An item only keeps its own values, in
+slots. The dict is created by to_dict() just before the Listitem is created, which is also
+the moment art urls are rendered from the item's image template.
+
+Attributes that have no value are None. They are passed to Listitem.from_dict() as
+they are, since codequick ignores info labels and art that are None.
+
+Items are compared by value and can be pickled, so they can be stored in the cache.
+"""
+
+from . import parsex
+
+
+# The version of the item classes. Cached items are only used when they have the
+# current version, so increment it whenever items, or what parsers put in them, change.
+SCHEMA_VERSION = 1
+
+# Art types of items, each rendered from the item's image template.
+ART_THUMB = ('thumb', )
+ART_LANDSCAPE = ('thumb', 'fanart')
+ART_FILM = ('thumb', 'fanart', 'poster')
+
+
+class Item:
+    """Base class of all items. Subclasses define all their attributes in __slots__.
+
+    Items that are listed define to_dict(), which returns the item as a dict that can be
+    passed to Listitem.from_dict(). Others, like LiveProgramme, are only part of an item.
+
+    """
+    __slots__ = ()
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__,
+                               ', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
+class Programme(Item):
+    """A programme, film, or a single episode in a category, collection, or search results.
+
+    Items that are not playable open a listing of the programme's series and episodes.
+
+    """
+    __slots__ = ('playable', 'label', 'url', 'image', 'art_types', 'title', 'plot', 'sort_title', 'duration')
+
+    def __init__(self, playable, label, url, image, art_types=ART_THUMB,
+                 title=None, plot=None, sort_title=None, duration=None):
+        self.playable = playable
+        self.label = label
+        self.url = url
+        self.image = image
+        self.art_types = art_types
+        self.title = title
+        self.plot = plot
+        self.sort_title = sort_title
+        self.duration = duration
+
+    def to_dict(self):
+        return {
+            'label': self.label,
+            'art': parsex.image_art(self.image, self.art_types),
+            'info': {'title': self.title, 'plot': self.plot, 'sorttitle': self.sort_title, 'duration': self.duration},
+            'params': {'url': self.url}
+        }
+
+
+class Episode(Item):
+    """A playable episode of a series."""
+    __slots__ = ('label', 'url', 'image', 'fanart', 'title', 'plot', 'duration', 'date', 'episode', 'season')
+
+    def __init__(self, label, url, image, fanart=None, title=None, plot=None, duration=None, date=None,
+                 episode=None, season=None):
+        self.label = label
+        self.url = url
+        self.image = image
+        self.fanart = fanart
+        self.title = title
+        self.plot = plot
+        self.duration = duration
+        self.date = date
+        self.episode = episode
+        self.season = season
+
+    def to_dict(self):
+        return {
+            'label': self.label,
+            'art': {'thumb': parsex.image_url(self.image, 'thumb'), 'fanart': self.fanart},
+            'info': {'title': self.title, 'plot': self.plot, 'duration': self.duration, 'date': self.date,
+                     'episode': self.episode, 'season': self.season},
+            'params': {'url': self.url, 'name': self.label}
+        }
+
+
+class Series(Item):
+    """A folder of a series of a programme, holding the series' episodes.
+
+    The art of all series of a programme is that of the programme's brand. `episodes`
+    is None as long as the series' episodes have not been parsed.
+
+    """
+    __slots__ = ('label', 'url', 'series_idx', 'image', 'title', 'plot', 'episodes')
+
+    def __init__(self, label, url, series_idx, image, title=None, plot=None, episodes=None):
+        self.label = label
+        self.url = url
+        self.series_idx = series_idx
+        self.image = image
+        self.title = title
+        self.plot = plot
+        self.episodes = episodes
+
+    def to_dict(self):
+        return {
+            'label': self.label,
+            'art': parsex.image_art(self.image, ART_LANDSCAPE),
+            'info': {'title': self.title, 'plot': self.plot},
+            'params': {'url': self.url, 'series_idx': self.series_idx}
+        }
+
+
+class LiveProgramme(Item):
+    """A programme in the schedule of a live channel. It is listed as part of its LiveChannel.
+
+    `start_time` is the local start time as 'HH:MM'. `orig_start` is the start time in UTC
+    as used to play the programme from the start, or None if the channel does not support that.
+
+    """
+    __slots__ = ('title', 'details', 'start_time', 'orig_start')
+
+    def __init__(self, title, start_time, details=None, orig_start=None):
+        self.title = title
+        self.start_time = start_time
+        self.details = details
+        self.orig_start = orig_start
+
+
+class LiveChannel(Item):
+    """A live channel with the programmes it shows now and next."""
+    __slots__ = ('name', 'stream_url', 'logo', 'backdrop', 'programmes')
+
+    def __init__(self, name, stream_url, logo, backdrop, programmes):
+        self.name = name
+        self.stream_url = stream_url
+        self.logo = logo
+        self.backdrop = backdrop
+        self.programmes = programmes
+
+    @property
+    def now_on(self):
+        return self.programmes[0]
+
+    def to_dict(self):
+        now_on = self.now_on
+        schedule = '\n'.join('{} - {}'.format(prog.start_time, prog.details or prog.title)
+                             for prog in self.programmes)
+        label = '{}    [COLOR orange]{}[/COLOR]'.format(self.name, now_on.title)
+        # noinspection SpellCheckingInspection
+        return {
+            'label': label,
+            'art': {'fanart': self.backdrop, 'thumb': self.logo},
+            'info': {'title': label, 'plot': schedule},
+            'params': {'channel': self.name, 'url': self.stream_url, 'title': now_on.title,
+                       'start_time': now_on.orig_start},
+            'properties': {
+                # This causes Kodi not to offer the standard resume dialog
+                'resumetime': '0',
+                'totaltime': 3600
+            }
+        }
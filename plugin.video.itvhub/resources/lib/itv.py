@@ -7,16 +7,15 @@
 
 import os
 import string
-import time
 import logging
 
 from datetime import datetime, timedelta
-import pytz
 
 from codequick import Script
 from codequick.support import logger_id
 
 from . import utils
+from . import timestamps
 from . import fetch
 from . import kodi_utils
 
@@ -32,12 +31,10 @@ def get_live_schedule(hours=4):
     """
 
     # Calculate current british time and the difference between that and local time
-    btz = pytz.timezone('Europe/London')
-    british_now = datetime.now(btz)
-    local_offset = datetime.now() - datetime.utcnow()
-    time_dif = local_offset - british_now.utcoffset()
-    # in the above calculation we lose a few nanoseconds, so we need to convert the difference to round seconds again
-    time_dif = timedelta(time_dif.days, time_dif.seconds + 1)
+    btz = timestamps.get_timezone('Europe/London')
+    utc_now = datetime.utcnow()
+    british_now = timestamps.to_local(utc_now, btz)
+    time_dif = timestamps.utc_offset(utc_now) - timestamps.utc_offset(utc_now, btz)
 
     # Request TV schedules for the specified number of hours from now, in british time
     from_date = british_now.strftime('%Y%m%d%H%M')
@@ -54,9 +51,7 @@ def get_live_schedule(hours=4):
     # convert British start time to local time
     for channel in schedule:
         for program in channel['slot']:
-            time_str = program['startTime'][:16]
-            # datetime.datetime.strptime has a bug in python3 used in kodi 19: https://bugs.python.org/issue27400
-            brit_time = datetime(*(time.strptime(time_str, '%Y-%m-%dT%H:%M')[0:6]))
+            brit_time = timestamps.parse_iso(program['startTime'])
             loc_time = brit_time + time_dif
             program['startTime'] = loc_time.strftime('%H:%M')
             program['orig_start'] = program['onAirTimeUTC'][:19]
@@ -115,10 +110,12 @@ def _request_stream_data(url, stream_type='live', retry_on_error=True):
 
         stream_req_data['variantAvailability']['featureset']['min'] = min_features
 
+        # The user is waiting for playback to start, so don't let a slow server hold it up.
         stream_data = fetch.post_json(
             url, stream_req_data,
             headers={'Accept': accept_type},
-            cookies=session.cookie)
+            cookies=session.cookie,
+            hedge=True)
 
         http_status = stream_data.get('StatusCode', 0)
         if http_status == 401:
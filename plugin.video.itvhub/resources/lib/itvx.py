@@ -8,19 +8,21 @@
 
 import os
 import string
-import time
 import logging
+import threading
 
-from datetime import datetime
-import pytz
+from functools import partial
 import xbmc
 
 from codequick.support import logger_id
 
+from . import errors
 from . import fetch
 from . import parsex
+from . import items
 from . import utils
 from . import cache
+from . import timestamps
 
 from .itv import get_live_schedule
 
@@ -35,84 +37,208 @@ logger.info('meridiem format %s', xbmc.getRegion('meridiem'))
 FEATURE_SET = 'hd,progressive,single-track,mpeg-dash,widevine,widevine-download,inband-ttml,hls,aes,inband-webvtt,outband-webvtt,inband-audio-description'
 PLATFORM_TAG = 'mobile'
 
+# The maximum time in seconds cached page data may be used after it has expired, while
+# up-to-date data is being obtained in the background.
+MAX_STALE_TIME = 86400
 
-def get_page_data(url, cache_time=None):
+# The time in seconds parsed episodes of a series are kept in the cache.
+EPISODES_CACHE_TIME = 3600
+
+_refreshing_pages = set()
+_refresh_lock = threading.Lock()
+
+
+def get_page_data(url, cache_time=None, max_stale=MAX_STALE_TIME, paths=None):
     """Return the json data embedded in a <script> tag on a html page.
 
     Return the data from cache if present and not expired, or request the page by HTTP.
+    Data that has expired less than `max_stale` seconds ago is returned immediately,
+    while the page is refreshed in the background. Data that has expired longer ago
+    is only returned when the page cannot be obtained due to a connection or server error.
+
+    If `paths` is given, the data contains only the parts selected by paths, like
+    ('collection.shows',). See `parsex.select_json()`.
     """
     if not url.startswith('https://'):
         url = 'https://www.itv.com' + url
 
-    if cache_time:
-        cached_data = cache.get_item(url)
-        if cached_data:
-            return cached_data
+    if not cache_time:
+        _, next_data = fetch.get_next_data(url)
+        return parsex.parse_next_data(next_data, paths)
+
+    cache_key = _page_cache_key(url, paths)
+    cached_data = cache.get_item(cache_key)
+    if cached_data:
+        return cached_data
+
+    if max_stale:
+        stale_data = cache.get_stale_item(cache_key, max_stale)
+        if stale_data:
+            refresh_page_data(url, cache_time, paths)
+            return stale_data
+
+    try:
+        return fetch.single_flight(('page', cache_key), _load_page_data, url, cache_time, paths)
+    except errors.FetchError as err:
+        # When ITV's servers fail, cached data of any age is better than nothing.
+        if type(err) is errors.FetchError or (isinstance(err, errors.HttpError) and err.code >= 500):
+            stale_data = cache.get_stale_item(cache_key, float('inf'))
+            if stale_data:
+                logger.warning("Serving stale data of %s after error: %r", url, err)
+                return stale_data
+        raise
+
+
+def _page_cache_key(url, paths):
+    """Return the key of a page's data in the cache. Selections of different parts
+    of the same page are cached separately.
+
+    """
+    if paths:
+        return '#'.join((url, ','.join(sorted(paths))))
+    return url
 
-    html_doc = fetch.get_document(url)
-    data = parsex.scrape_json(html_doc)
-    if cache_time:
-        cache.set_item(url, data, cache_time)
+
+def refresh_page_data(url, cache_time, paths=None):
+    """Update the cached data of a page on a background thread.
+    Only one refresh of a particular page is running at any time.
+
+    """
+    cache_key = _page_cache_key(url, paths)
+    with _refresh_lock:
+        if cache_key in _refreshing_pages:
+            return
+        _refreshing_pages.add(cache_key)
+
+    def refresh():
+        # noinspection PyBroadException
+        try:
+            fetch.single_flight(('page', cache_key), _load_page_data, url, cache_time, paths)
+        except:
+            logger.warning("Failed to refresh page data of %s", url, exc_info=True)
+        finally:
+            with _refresh_lock:
+                _refreshing_pages.discard(cache_key)
+
+    logger.debug("Refreshing stale page data of %s", url)
+    threading.Thread(target=refresh, name='refresh-page-data', daemon=True).start()
+
+
+def _load_page_data(url, cache_time, paths=None):
+    """Obtain page data by HTTP and store it in the cache.
+    If the page has been cached before, only download it if it has been modified since.
+
+    """
+    cache_key = _page_cache_key(url, paths)
+    resp, next_data = fetch.get_next_data(url, validators=cache.get_validators(cache_key))
+    if resp.status_code == 304:
+        data = cache.renew(cache_key, cache_time)
+        if data is not None:
+            logger.debug("Page not modified: %s", url)
+            return data
+        # The cached item has been removed in the meantime.
+        resp, next_data = fetch.get_next_data(url)
+
+    data = parsex.parse_next_data(next_data, paths)
+    cache.set_item(cache_key, data, cache_time, fetch.get_validators(resp))
     return data
 
 
 def get_live_channels():
-    from tzlocal import get_localzone
-    local_tz = get_localzone()
-    utc_tz = pytz.utc
-
-    live_data = fetch.get_json(
-        'https://nownext.oasvc.itv.com/channels',
-        params={
-            'broadcaster': 'itv',
-            'featureSet': FEATURE_SET,
-            'platformTag': PLATFORM_TAG})
+    # Obtain now/next and the full schedule of the main channels concurrently.
+    live_data, main_schedule = fetch.get_many((
+        partial(fetch.get_json,
+                'https://nownext.oasvc.itv.com/channels',
+                params={
+                    'broadcaster': 'itv',
+                    'featureSet': FEATURE_SET,
+                    'platformTag': PLATFORM_TAG}),
+        get_live_schedule))
+
+    if isinstance(live_data, Exception):
+        raise live_data
+    if isinstance(main_schedule, Exception):
+        # Not fatal, the main channels fall back to their now/next data.
+        logger.warning("Failed to get live schedule: %r", main_schedule)
+        main_schedule = []
 
     fanart_url = live_data['images']['backdrop']
 
-    main_schedule = get_live_schedule()
-
-    channels = live_data['channels']
+    # The full schedule of the main channels by channel name
+    main_schedules = {}
+    for main_chan in main_schedule:
+        main_schedules.setdefault(main_chan['channel']['name'], main_chan['slot'])
+    channels = []
 
-    for channel in channels:
-        channel['backdrop'] = fanart_url
-        slots = channel.pop('slots')
+    for channel in live_data['channels']:
+        programmes = None
 
         # The itv main live channels get their schedule from the full live schedule
-        if channel['channelType'] == 'simulcast':
-            chan_id = channel['id']
-            for main_chan in main_schedule:
-                # Caution, might get broken when ITV becomes ITV1 everywhere
-                if main_chan['channel']['name'] == chan_id:
-                    channel['slot'] = main_chan['slot']
-                    break
-            if channel.get('slot'):
-                # On to the next channel if adding full schedule succeeded
-                continue
-
-        programs_list = []
-        for prog in (slots['now'], slots['next']):
-            if prog['detailedDisplayTitle']:
-                details = ': '.join((prog['displayTitle'], prog['detailedDisplayTitle']))
-            else:
-                details = prog['displayTitle']
-
-            start_t = prog['start'][:19]
-            # TODO: check this in DST period
-            utc_start = datetime(*(time.strptime(start_t, '%Y-%m-%dT%H:%M:%S')[0:6])).replace(tzinfo=utc_tz)
-
-            programs_list.append({
-                'programme_details': details,
-                'programmeTitle': prog['displayTitle'],
-                'orig_start': None,          # fast channels do not support play from start
-                'startTime': utc_start.astimezone(local_tz).strftime('%H:%M')
-            })
-        channel['slot'] = programs_list
+        # Caution, might get broken when ITV becomes ITV1 everywhere
+        if channel['channelType'] == 'simulcast' and main_schedules.get(channel['id']):
+            programmes = [items.LiveProgramme(prog['programmeTitle'], prog['startTime'],
+                                              orig_start=prog['orig_start'])
+                          for prog in main_schedules[channel['id']]]
+
+        if not programmes:
+            slots = channel['slots']
+            programmes = []
+            for prog in (slots['now'], slots['next']):
+                if prog['detailedDisplayTitle']:
+                    details = ': '.join((prog['displayTitle'], prog['detailedDisplayTitle']))
+                else:
+                    details = prog['displayTitle']
+
+                start_time = timestamps.to_local(timestamps.parse_iso(prog['start']))
+                # fast channels do not support play from start
+                programmes.append(items.LiveProgramme(prog['displayTitle'],
+                                                      start_time.strftime('%H:%M'),
+                                                      details=details))
+        channels.append(items.LiveChannel(channel['name'], channel['streamUrl'], channel['images']['logo'],
+                                          fanart_url, programmes))
     return channels
 
 
+def get_listing(name, url, cache_time, paths, variant, parse):
+    """Return the list of items parsed from the data of a page by `parse(page_data)`.
+
+    Parsed listings are cached for as long as the page data they have been parsed from
+    is, so they are parsed again when the page has been refreshed. The cache key consists
+    of the listing's `name`, the page, `variant`, which is a tuple of all other values
+    that determine the listing's items, like the setting hide_paid, and the version of
+    the items' classes.
+
+    Once a listing has been parsed, the page data is released from memory. It remains
+    cached on disk, so the page can be revalidated, or parsed into other listings.
+
+    """
+    if not url.startswith('https://'):
+        url = 'https://www.itv.com' + url
+    page_key = _page_cache_key(url, paths)
+    listing_key = '#'.join(('listing', str(items.SCHEMA_VERSION), name, page_key) + tuple(map(str, variant)))
+    listing = cache.get_item(listing_key)
+    if listing is not None:
+        return listing
+
+    listing = list(parse(get_page_data(url, cache_time, paths=paths)))
+    # Stale page data is being refreshed, so listings parsed from it are not cached.
+    expires_in = cache.expires_in(page_key)
+    if expires_in is not None and expires_in > 0:
+        cache.set_item(listing_key, listing, expires_in)
+        cache.release(page_key)
+    return listing
+
+
+def _parse_items(items_list, parse, hide_paid, *args):
+    """Return a list of all items in `items_list` parsed by `parse`, optionally without paid items."""
+    return [parse(item, *args) for item in items_list if not (hide_paid and item.get('isPaid'))]
+
+
 def main_page_items():
-    main_data = get_page_data('https://www.itv.com', cache_time=3600)
+    return get_listing('main_page', 'https://www.itv.com', 3600, None, (), _parse_main_page)
+
+
+def _parse_main_page(main_data):
     for hero_data in main_data['heroContent']:
         yield parsex.parse_hero_content(hero_data)
     if 'trendingSliderContent' in main_data.keys():
@@ -127,55 +253,44 @@ def main_page_items():
 
 def collection_content(url=None, slider=None, hide_paid=False):
     if url:
-        items_list = get_page_data(url, cache_time=43200)['collection']['shows']
-        if hide_paid:
-            return (parsex.parse_collection_item(item)
-                    for item in items_list
-                    if not item.get('isPaid'))
-        else:
-            return (parsex.parse_collection_item(item) for item in items_list)
-    else:
-        page_data = get_page_data('https://www.itv.com', cache_time=3600)
-
-        if slider == 'newsShortformSliderContent':
-            uk_tz = pytz.timezone('Europe/London')
-            time_fmt = ' '.join((xbmc.getRegion('dateshort'), xbmc.getRegion('time')))
-            items_list = page_data['newsShortformSliderContent']['items']
-            if hide_paid:
-                return (parsex.parse_news_collection_item(news_item, uk_tz, time_fmt)
-                        for news_item in items_list
-                        if not news_item.get('isPaid'))
-            else:
-                return (parsex.parse_news_collection_item(news_item, uk_tz, time_fmt) for news_item in items_list)
-
-        if slider == 'trendingSliderContent':
-            items_list = page_data['trendingSliderContent']['items']
-            if hide_paid:
-                return (parsex.parse_trending_collection_item(trending_item)
-                        for trending_item in items_list
-                        if not trending_item.get('isPaid'))
-            else:
-                return (parsex.parse_trending_collection_item(trending_item) for trending_item in items_list)
-
-        else:
-            items_list = page_data['editorialSliders'][slider]['collection']['shows']
-            if hide_paid:
-                return (parsex.parse_collection_item(item) for item in items_list if not item.get('isPaid'))
-            else:
-                return (parsex.parse_collection_item(item) for item in items_list)
-
-
-def episodes(url):
+        return get_listing(
+            'collection', url, 43200, ('collection.shows',), (hide_paid, ),
+            lambda data: _parse_items(data['collection']['shows'], parsex.parse_collection_item, hide_paid))
+
+    if slider == 'newsShortformSliderContent':
+        uk_tz = timestamps.get_timezone('Europe/London')
+        time_fmt = ' '.join((xbmc.getRegion('dateshort'), xbmc.getRegion('time')))
+        return get_listing(
+            'collection', 'https://www.itv.com', 3600, None, (slider, hide_paid, time_fmt),
+            lambda data: _parse_items(data['newsShortformSliderContent']['items'],
+                                      parsex.parse_news_collection_item, hide_paid, uk_tz, time_fmt))
+
+    if slider == 'trendingSliderContent':
+        return get_listing(
+            'collection', 'https://www.itv.com', 3600, None, (slider, hide_paid),
+            lambda data: _parse_items(data['trendingSliderContent']['items'],
+                                      parsex.parse_trending_collection_item, hide_paid))
+
+    return get_listing(
+        'collection', 'https://www.itv.com', 3600, None, (slider, hide_paid),
+        lambda data: _parse_items(data['editorialSliders'][slider]['collection']['shows'],
+                                  parsex.parse_collection_item, hide_paid))
+
+
+def episodes(url, series_idx=None):
     """Get a listing of series and their episodes
 
-    Return a list containing only relevant info in a format that can easily be
-    used by codequick Listitem.from_dict.
+    Return a dict of items.Series by series number. Only the episodes of series
+    `series_idx`, or of the only series of a programme, are parsed. The episodes of
+    all other series are None.
+
+    Parsed episodes are kept in the cache for EPISODES_CACHE_TIME seconds, or until
+    episodes are added to, or removed from the series.
 
     """
-    brand_data = get_page_data(url)['title']['brand']
+    brand_data = get_page_data(url, paths=('title.brand',))['title']['brand']
     brand_title = brand_data['title']
-    brand_thumb = brand_data['title'].format(parsex.IMG_PROPS_THUMB)
-    brand_fanart = brand_data['title'].format(parsex.IMG_PROPS_FANART)
+    brand_image = brand_data['imageUrl']
     brand_description = brand_data['synopses'].get('ninety', '')
     series_data = brand_data['series']
 
@@ -184,41 +299,57 @@ def episodes(url):
 
     # The field seriesNUmber is not guaranteed to be unique - and not guaranteed an integer eiter.
     # Midsummer murder for instance has 2 series with seriesNumber 4
-    # By using this mapping, setdefault() and extend() on the episode list, series with the same
-    # seriesNumber are automatically merged.
+    # By using this mapping and collecting the episode data of all series with the same
+    # seriesNumber, these series are automatically merged.
     series_map = {}
+    episodes_data = {}
     for series in series_data:
         title = series['title']
-        series_idx = series['seriesNumber']
-        series_obj = series_map.setdefault(
-            series_idx, {
-                'series': {
-                    'label': title,
-                    'art': {'thumb': brand_thumb, 'fanart': brand_fanart},
-                    # TODO: add more info, like series number, number of episodes
-                    'info': {'title': '[B]{} - {}[/B]'.format(brand_title, series['title']),
-                             'plot': '{}\n\n{} - {} episodes'.format(
-                                 brand_description, title, series['seriesAvailableEpisodeCount'])},
-
-                    'params': {'url': url, 'series_idx': series_idx}
-                },
-                'episodes': []
-            })
-        series_obj['episodes'].extend(
-            [parsex.parse_episode_title(episode, brand_fanart) for episode in series['episodes']])
+        idx = series['seriesNumber']
+        if idx not in series_map:
+            # TODO: add more info, like series number, number of episodes
+            series_map[idx] = items.Series(
+                title, url, idx, brand_image,
+                title='[B]{} - {}[/B]'.format(brand_title, series['title']),
+                plot='{}\n\n{} - {} episodes'.format(brand_description, title, series['seriesAvailableEpisodeCount']))
+        episodes_data.setdefault(idx, []).extend(series['episodes'])
+
+    if len(series_map) == 1:
+        series_idx = next(iter(series_map))
+    opened_series = series_map.get(series_idx)
+    if opened_series:
+        opened_series.episodes = _series_episodes(url, series_idx, episodes_data[series_idx], brand_image)
     return series_map
 
 
+def _series_episodes(url, series_idx, episodes_data, brand_image):
+    """Return the parsed episodes of a series from the cache, or parse `episodes_data`."""
+    cache_key = '#'.join(('episodes', str(items.SCHEMA_VERSION), url, str(series_idx)))
+    episode_ids = [episode['productionId'] for episode in episodes_data]
+    cached = cache.get_item(cache_key)
+    if cached and cached['ids'] == episode_ids:
+        return cached['episodes']
+
+    brand_fanart = parsex.image_url(brand_image, 'fanart')
+    series_episodes = [parsex.parse_episode_title(episode, brand_fanart) for episode in episodes_data]
+    cache.set_item(cache_key, {'ids': episode_ids, 'episodes': series_episodes}, EPISODES_CACHE_TIME)
+    return series_episodes
+
+
 def categories():
     """Return all available categorie names."""
-    data = get_page_data('https://www.itv.com/watch/categories', cache_time=86400)
+    data = get_page_data('https://www.itv.com/watch/categories', cache_time=86400, paths=('subnav.items',))
     cat_list = data['subnav']['items']
     return ({'label': cat['name'], 'params': {'path': cat['url']}} for cat in cat_list)
 
 
 def category_content(url: str, hide_paid=False):
     """Return all programmes in a category"""
-    cat_data = get_page_data(url, cache_time=3600)
+    return get_listing('category', url, 3600, ('category.pathSegment', 'programmes'), (hide_paid, ),
+                       lambda cat_data: _parse_category(cat_data, hide_paid))
+
+
+def _parse_category(cat_data, hide_paid):
     category = cat_data['category']['pathSegment']
     progr_list = cat_data.get('programmes')
 
@@ -237,27 +368,18 @@ def category_content(url: str, hide_paid=False):
 
         sort_title = title.lower()
 
-        programme_item = {
-            'label': title,
-            'art': {'thumb': prog['imageTemplate'].format(**parsex.IMG_PROPS_THUMB),
-                    'fanart': prog['imageTemplate'].format(**parsex.IMG_PROPS_FANART)},
-            'info': {'title': title if is_playable else '[B]{}[/B] {}'.format(title, content_info),
-                     'plot': plot,
-                     'sorttitle': sort_title[4:] if sort_title.startswith('the ') else sort_title},
-        }
-
-        if category == 'films':
-            programme_item['art']['poster'] = prog['imageTemplate'].format(**parsex.IMG_PROPS_POSTER)
-
         if is_playable:
-            programme_item['info']['duration'] = utils.duration_2_seconds(content_info)
-            programme_item['params'] = {'url': parsex.build_url(title, prog['encodedProgrammeId']['letterA'])}
+            prog_url = parsex.build_url(title, prog['encodedProgrammeId']['letterA'])
         else:
-            programme_item['params'] = {'url': parsex.build_url(title,
-                                                                prog['encodedProgrammeId']['letterA'],
-                                                                prog['encodedEpisodeId']['letterA'])}
-        yield {'playable': is_playable,
-               'show': programme_item}
+            prog_url = parsex.build_url(title, prog['encodedProgrammeId']['letterA'],
+                                        prog['encodedEpisodeId']['letterA'])
+        yield items.Programme(
+            is_playable, title, prog_url, prog['imageTemplate'],
+            art_types=items.ART_FILM if category == 'films' else items.ART_LANDSCAPE,
+            title=title if is_playable else '[B]{}[/B] {}'.format(title, content_info),
+            plot=plot,
+            sort_title=sort_title[4:] if sort_title.startswith('the ') else sort_title,
+            duration=utils.duration_2_seconds(content_info) if is_playable else None)
 
 
 cached_programs = {}
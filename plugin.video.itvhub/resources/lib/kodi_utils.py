@@ -17,6 +17,8 @@ logger = logging.getLogger(logger_id + '.kodi_utils')
 
 
 TXT_LOG_TARGETS = 30112
+TXT_REQUEST_METRICS = 30114
+MSG_METRICS_REPORT_FILE = 30115
 TXT_ITV_ACCOUNT = 30200
 
 TXT_MORE_INFO = 30604
@@ -114,6 +116,12 @@ def ask_log_handler(default):
         return result, ''
 
 
+def show_request_metrics(report, report_file):
+    text = '\n\n'.join((Script.localize(MSG_METRICS_REPORT_FILE).format(report_file), report))
+    dlg = xbmcgui.Dialog()
+    dlg.textviewer(Script.localize(TXT_REQUEST_METRICS), text, usemono=True)
+
+
 def ask_play_from_start(title=None):
     dlg = xbmcgui.Dialog()
 
@@ -18,6 +18,7 @@ from resources.lib import itv, itv_account, itvx
 from resources.lib import utils
 from resources.lib import parsex
 from resources.lib import fetch
+from resources.lib import tracing
 from resources.lib.errors import *
 
 
@@ -101,44 +102,14 @@ def root(_):
 def sub_menu_live(_):
     tv_schedule = itvx.get_live_channels()
 
-    for item in tv_schedule:
-        chan_name = item['name']
-        now_on = item['slot'][0]
-        programs = ('{} - {}'.format(program['startTime'],
-                                     program.get('programme_details') or program['programmeTitle'])
-                    for program in item['slot'])
-        label = '{}    [COLOR orange]{}[/COLOR]'.format(chan_name, now_on['programmeTitle'])
-        program_start_time = now_on['orig_start']
-        callback_kwargs = {
-                'channel': chan_name,
-                'url': item['streamUrl'],
-                'title': now_on['programmeTitle'],
-                'start_time': program_start_time
-                }
-
-        # noinspection SpellCheckingInspection
-        li = Listitem.from_dict(
-            play_stream_live,
-            label=label,
-            art={
-                'fanart': item['backdrop'],
-                'thumb': item['images']['logo']},
-            info={
-                'title': label,
-                'plot': '\n'.join(programs),
-                },
-            params=callback_kwargs,
-            properties={
-                # This causes Kodi not to offer the standard resume dialog
-                'resumetime': '0',
-                'totaltime': 3600
-            }
-        )
+    for channel in tv_schedule:
+        item = channel.to_dict()
+        li = Listitem.from_dict(play_stream_live, **item)
 
         # add 'play from the start' context menu item for channels that support this feature
-        if program_start_time:
+        if channel.now_on.orig_start:
             cmd = 'PlayMedia({}, noresume)'.format(
-                build_path(play_stream_live, play_from_start=True, **callback_kwargs))
+                build_path(play_stream_live, play_from_start=True, **item['params']))
             li.context.append((Script.localize(TXT_PLAY_FROM_START), cmd))
         yield li
 
@@ -154,12 +125,8 @@ def list_collections(_):
 @dynamic_listing
 def list_collection_content(addon, url=None, slider=None):
     shows_list = itvx.collection_content(url, slider, addon.setting.get_boolean('hide_paid'))
-    return [
-        Listitem.from_dict(play_title, **show['show'])
-        if show['playable'] else
-        Listitem.from_dict(list_productions, **show['show'])
-        for show in shows_list
-    ]
+    return [Listitem.from_dict(play_title if show.playable else list_productions, **show.to_dict())
+            for show in shows_list]
 
 
 # FIXME: Cache throws error - list_category is not pickable
@@ -183,12 +150,8 @@ def list_category(addon, path, filter_char=None):
         addon.content_type = 'movies'
 
     shows_list = itvx.category_content(path, addon.setting.get_boolean('hide_paid'))
-    return [
-        Listitem.from_dict(play_title, **show['show'])
-        if show['playable'] else
-        Listitem.from_dict(list_productions, **show['show'])
-        for show in shows_list
-    ]
+    return [Listitem.from_dict(play_title if show.playable else list_productions, **show.to_dict())
+            for show in shows_list]
 
 
 @Route.register(cache_ttl=-1)
@@ -202,7 +165,7 @@ def list_productions(plugin, url, series_idx=0):
                             xbmcplugin.SORT_METHOD_DATE,
                             disable_autosort=True)
 
-    series_map = itvx.episodes(url)
+    series_map = itvx.episodes(url, series_idx)
     if not series_map:
         return
 
@@ -214,17 +177,15 @@ def list_productions(plugin, url, series_idx=0):
 
         # First create folders for series
         for series in series_map.values():
-            li = Listitem.from_dict(list_productions, **series['series'])
+            li = Listitem.from_dict(list_productions, **series.to_dict())
             yield li
 
     # Now create episode items for the opened series folder
     if opened_series:
-        episodes = opened_series['episodes']
-        for episode in episodes:
-            li = Listitem.from_dict(play_stream_catchup, **episode)
-            date = episode['info'].get('date')
-            if date:
-                li.info.date(date, '%Y-%m-%dT%H:%M:%SZ')
+        for episode in opened_series.episodes:
+            li = Listitem.from_dict(play_stream_catchup, **episode.to_dict())
+            if episode.date:
+                li.info.date(episode.date, '%Y-%m-%dT%H:%M:%SZ')
             yield li
 
 
@@ -243,12 +204,8 @@ def do_search(addon, search_query):
     if not search_results:
         return
 
-    items = [
-        Listitem.from_dict(play_title, **result['show'])
-        if result['playable']
-        else Listitem.from_dict(list_productions, **result['show'])
-        for result in search_results if result is not None
-    ]
+    items = [Listitem.from_dict(play_title if result.playable else list_productions, **result.to_dict())
+             for result in search_results if result is not None]
     return items
 
 
@@ -265,7 +222,8 @@ def create_dash_stream_item(name, manifest_url, key_service_url, resume_time=Non
         # response a hdntl cookie is set that is required for all subsequent requests to media data.
         # Since we loose that cookie using the proxy, we make a single request to obtain the cookie
         # before handling it over to inputstream helper.
-        resp = itv_account.fetch_authenticated(fetch.web_request, manifest_url, method='GET', allow_redirects=False)
+        resp = itv_account.fetch_authenticated(fetch.web_request, manifest_url, method='GET',
+                                              allow_redirects=False, hedge=True)
         hdntl_cookie = resp.cookies.get('hdntl', '')
     except FetchError as err:
         logger.error('Error retrieving dash manifest - url: %r' % err)
@@ -275,9 +233,10 @@ def create_dash_stream_item(name, manifest_url, key_service_url, resume_time=Non
     PROTOCOL = 'mpd'
     DRM = 'com.widevine.alpha'
 
-    is_helper = inputstreamhelper.Helper(PROTOCOL, drm=DRM)
-    if not is_helper.check_inputstream():
-        return False
+    with tracing.span('inputstreamhelper'):
+        is_helper = inputstreamhelper.Helper(PROTOCOL, drm=DRM)
+        if not is_helper.check_inputstream():
+            return False
 
     play_item = Listitem()
     play_item.label = name
@@ -367,9 +326,11 @@ def play_stream_catchup(_, url, name):
         logger.error('Error retrieving episode stream urls:', exc_info=True)
         return False
 
+    # Download subtitles while the stream item is being created.
+    subtitles = fetch.submit(itv.get_vtt_subtitles, subtitle_url)
     list_item = create_dash_stream_item(name, manifest_url, key_service_url)
     if list_item:
-        list_item.subtitles = itv.get_vtt_subtitles(subtitle_url)
+        list_item.subtitles = subtitles.result()
     return list_item
 
 
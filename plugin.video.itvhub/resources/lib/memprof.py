@@ -0,0 +1,166 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022 Dimitri Kroon.
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+"""
+Opt-in memory profiling of routes.
+
+When enabled in the settings, memory allocations are traced with tracemalloc while a
+route runs. Afterwards, the peak memory use during the route, the memory the route has
+retained and the modules that allocated it are written to the log and added to REPORT_FILE
+in the addon's profile.
+
+With reuselanguageinvoker, the interpreter and all module level data, like the cache,
+live on between routes. Tracing is kept running as long as profiling is enabled, so the
+total of traced memory in successive reports shows whether memory keeps growing.
+
+Tracing memory allocations slows the addon down considerably.
+"""
+
+import os
+import time
+import json
+import logging
+import tracemalloc
+
+from codequick.support import logger_id
+
+from . import utils
+
+
+logger = logging.getLogger(logger_id + '.memprof')
+
+REPORT_FILE = 'memory_profile.json'
+# The number of route reports kept in REPORT_FILE.
+MAX_REPORTS = 50
+# The number of frames stored per allocation, needed to attribute allocations in
+# libraries, like json, to the addon's module that called them.
+TRACE_FRAMES = 12
+# The number of modules and allocation sites in a report.
+TOP_MODULES = 10
+TOP_SITES = 10
+
+_route = None
+_start_snapshot = None
+_start_memory = 0
+_start_time = 0
+
+
+def module_of(filename):
+    """Return the name of the module `filename` belongs to, like 'resources.lib.parsex',
+    'codequick.listing', or 'requests'.
+
+    """
+    path = filename.replace('\\', '/')
+    if path.endswith('.py'):
+        path = path[:-3]
+    pos = path.rfind('/resources/lib/')
+    if pos >= 0:
+        return 'resources.lib.' + path[pos + 15:].replace('/', '.')
+    pos = path.rfind('/codequick/')
+    if pos >= 0:
+        return 'codequick.' + path[pos + 11:].split('/')[0]
+    for packages_dir in ('/site-packages/', '/dist-packages/', '/addons/'):
+        pos = path.rfind(packages_dir)
+        if pos >= 0:
+            parts = path[pos + len(packages_dir):].split('/')
+            # Kodi's script.module.* addons keep their package in lib/.
+            if parts[0].startswith('script.module.') and len(parts) > 2 and parts[1] == 'lib':
+                return parts[2]
+            return parts[0]
+    return os.path.basename(path)
+
+
+def _owner(traceback):
+    """Return the module to which an allocation is attributed. That is the innermost
+    frame in the addon, or in codequick, or else the module in which the allocation was made.
+
+    """
+    for frame in reversed(traceback):
+        module = module_of(frame.filename)
+        if module.startswith(('resources.lib.', 'codequick.')):
+            return module
+    return module_of(traceback[-1].filename)
+
+
+def start_profile(url):
+    """Start profiling the memory use of the route of plugin url `url`, if enabled in the settings."""
+    global _route, _start_snapshot, _start_memory, _start_time
+    if not utils.setting_enabled('profile-memory'):
+        _start_snapshot = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACE_FRAMES)
+    elif hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    _route = url
+    _start_time = time.time()
+    _start_memory = tracemalloc.get_traced_memory()[0]
+    _start_snapshot = tracemalloc.take_snapshot()
+    logger.info("Profiling memory of route %s", url)
+
+
+def stop_profile():
+    """Stop profiling the current route, log a summary of its memory use and add the
+    full report to REPORT_FILE.
+
+    Return the report, or None if memory profiling is not enabled.
+
+    """
+    global _start_snapshot
+    if _start_snapshot is None or not tracemalloc.is_tracing():
+        return None
+    current, peak = tracemalloc.get_traced_memory()
+    end_snapshot = tracemalloc.take_snapshot()
+    start_snapshot = _start_snapshot
+    _start_snapshot = None
+
+    filters = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    stats = end_snapshot.filter_traces(filters).compare_to(start_snapshot.filter_traces(filters), 'traceback')
+    modules = {}
+    for stat in stats:
+        if stat.size_diff:
+            owner = _owner(stat.traceback)
+            modules[owner] = modules.get(owner, 0) + stat.size_diff
+    top_sites = sorted(stats, key=lambda s: s.size_diff, reverse=True)[:TOP_SITES]
+
+    report = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(_start_time)),
+        'route': _route,
+        # Without tracemalloc.reset_peak() (python < 3.9), the peak is the highest since tracing started.
+        'peak': peak - _start_memory,
+        'retained': current - _start_memory,
+        'traced_total': current,
+        'modules': dict(sorted(modules.items(), key=lambda item: item[1], reverse=True)[:TOP_MODULES]),
+        'sites': [{'site': '{}:{}'.format(module_of(s.traceback[-1].filename), s.traceback[-1].lineno),
+                   'owner': _owner(s.traceback),
+                   'size': s.size_diff,
+                   'count': s.count_diff}
+                  for s in top_sites if s.size_diff > 0],
+    }
+    logger.info("Memory of route %s: peak %.1f kB, retained %.1f kB, total traced %.1f kB",
+                _route, report['peak'] / 1024, report['retained'] / 1024, current / 1024)
+    logger.info("Memory retained by module: %s",
+                ', '.join('{} {:.1f} kB'.format(module, size / 1024) for module, size in report['modules'].items()))
+    _write_report(report)
+    return report
+
+
+def _write_report(report):
+    report_file = os.path.join(utils.addon_info['profile'], REPORT_FILE)
+    # noinspection PyBroadException
+    try:
+        try:
+            with open(report_file, 'r') as f:
+                reports = json.load(f)
+        except (FileNotFoundError, ValueError):
+            reports = []
+        reports.append(report)
+        utils.atomic_write(report_file, json.dumps(reports[-MAX_REPORTS:], indent=1))
+    except:
+        logger.error("Failed to write memory profile", exc_info=True)
@@ -0,0 +1,263 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022 Dimitri Kroon.
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+"""
+Request timing metrics.
+
+Timings, sizes and counts are aggregated into histograms per host and per route. The
+aggregated metrics are kept across runs of the addon in REPORT_FILE in the addon's
+profile directory, which can be inspected, or copied to share with others.
+
+Metrics are only collected when enabled in the settings. When disabled, recording a
+metric costs only a global check and the report file is neither read nor written.
+
+Time metrics are in milliseconds, metrics with a name ending in '_bytes' in bytes.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from codequick.support import logger_id
+
+from . import utils
+
+
+logger = logging.getLogger(logger_id + '.metrics')
+
+REPORT_FILE = 'request_metrics.json'
+
+# Upper bounds of the histogram buckets.
+TIME_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Scopes metrics are aggregated in.
+SCOPE_HOST = 'hosts'
+SCOPE_ROUTE = 'routes'
+
+
+class Histogram:
+    """Counts values in buckets of which the upper bounds are given by `bounds`.
+    The last bucket counts all values larger than the last bound.
+
+    """
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        idx = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            idx += 1
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        """Return an estimate of the `percentile` of all values, i.e. the upper bound of the
+        bucket it is in, or the maximum value if that is less.
+
+        """
+        if not self.count:
+            return None
+        threshold = self.count * percentile / 100
+        cumulative = 0
+        for idx, bucket_count in enumerate(self.counts):
+            cumulative += bucket_count
+            if cumulative >= threshold:
+                if idx < len(self.bounds):
+                    return min(self.bounds[idx], self.max)
+                break
+        return self.max
+
+    def to_dict(self):
+        return {'bounds': list(self.bounds), 'counts': self.counts, 'count': self.count,
+                'sum': self.total, 'min': self.min, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        hist = cls(tuple(data['bounds']))
+        hist.counts = list(data['counts'])
+        hist.count = data['count']
+        hist.total = data['sum']
+        hist.min = data['min']
+        hist.max = data['max']
+        return hist
+
+
+enabled = False
+_metrics = None
+_changed = False
+_lock = threading.Lock()
+current_route = None
+
+
+def _get_metrics():
+    """Return the aggregated metrics, loading them from file on first use.
+    Must be called with _lock held.
+
+    """
+    global _metrics
+    if _metrics is None:
+        _metrics = {SCOPE_HOST: {}, SCOPE_ROUTE: {}}
+        # noinspection PyBroadException
+        try:
+            with open(os.path.join(utils.addon_info['profile'], REPORT_FILE), 'r') as f:
+                data = json.load(f)
+            for scope in (SCOPE_HOST, SCOPE_ROUTE):
+                for name, entry in data[scope].items():
+                    _metrics[scope][name] = {
+                        'histograms': {metric: Histogram.from_dict(hist)
+                                       for metric, hist in entry['histograms'].items()},
+                        'counters': dict(entry['counters'])}
+        except FileNotFoundError:
+            pass
+        except:
+            logger.warning("Failed to load metrics from file", exc_info=True)
+            _metrics = {SCOPE_HOST: {}, SCOPE_ROUTE: {}}
+    return _metrics
+
+
+def _entries(host):
+    """Return the metrics entries of the current route and of `host`, if any.
+    Must be called with _lock held.
+
+    """
+    all_metrics = _get_metrics()
+    names = ((SCOPE_ROUTE, current_route), (SCOPE_HOST, host))
+    return [all_metrics[scope].setdefault(name, {'histograms': {}, 'counters': {}})
+            for scope, name in names if name]
+
+
+def start_route(url):
+    """Set the route to which subsequent metrics are attributed, and enable or disable
+    the collection of metrics according to the settings.
+    `url` is the plugin url of the route, like plugin://plugin.video.itvhub/resources/lib/main/sub_menu_live/
+
+    """
+    global current_route, enabled
+    enabled = utils.setting_enabled('collect-metrics')
+    path = urlsplit(url).path.strip('/')
+    if path.startswith('resources/lib/'):
+        path = path[14:]
+    current_route = path or 'root'
+
+
+def record(metric, value, host=None):
+    """Add `value` to the histogram of `metric` of the current route and of `host`."""
+    global _changed
+    if not enabled:
+        return
+    with _lock:
+        for entry in _entries(host):
+            hist = entry['histograms'].get(metric)
+            if hist is None:
+                hist = entry['histograms'][metric] = Histogram(
+                    SIZE_BUCKETS if metric.endswith('_bytes') else TIME_BUCKETS)
+            hist.add(value)
+        _changed = True
+
+
+def count(counter, host=None):
+    """Increment a counter of the current route and of `host`."""
+    global _changed
+    if not enabled:
+        return
+    with _lock:
+        for entry in _entries(host):
+            counters = entry['counters']
+            counters[counter] = counters.get(counter, 0) + 1
+        _changed = True
+
+
+@contextmanager
+def timer(metric, host=None):
+    """Context manager that records the time spent in its block as `metric`."""
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(metric, (time.perf_counter() - start) * 1000, host)
+
+
+def get_report():
+    """Return all metrics as a dict of the same structure as REPORT_FILE."""
+    with _lock:
+        all_metrics = _get_metrics()
+        return {
+            scope: {name: {'histograms': {metric: hist.to_dict() for metric, hist in entry['histograms'].items()},
+                           'counters': dict(entry['counters'])}
+                    for name, entry in all_metrics[scope].items()}
+            for scope in (SCOPE_HOST, SCOPE_ROUTE)}
+
+
+def format_report():
+    """Return a human readable summary of all metrics."""
+    with _lock:
+        all_metrics = _get_metrics()
+        lines = []
+        for scope in (SCOPE_HOST, SCOPE_ROUTE):
+            lines.append(scope.upper())
+            for name, entry in sorted(all_metrics[scope].items()):
+                lines.append('')
+                lines.append(name)
+                lines.append('    {:<16}{:>7}{:>10}{:>10}{:>10}{:>10}'.format(
+                    'metric', 'count', 'mean', 'p50', 'p90', 'max'))
+                for metric, hist in sorted(entry['histograms'].items()):
+                    lines.append('    {:<16}{:>7}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+                        metric, hist.count, hist.total / hist.count,
+                        hist.percentile(50), hist.percentile(90), hist.max))
+                if entry['counters']:
+                    lines.append('    ' + ', '.join('{}: {}'.format(counter, value)
+                                                    for counter, value in sorted(entry['counters'].items())))
+            lines.append('')
+    return '\n'.join(lines)
+
+
+def write_report():
+    """Write all metrics to REPORT_FILE if any has changed since the last write.
+    Return the full path of the report file.
+
+    """
+    global _changed
+    report_file = os.path.join(utils.addon_info['profile'], REPORT_FILE)
+    if not _changed:
+        return report_file
+    _changed = False
+    # noinspection PyBroadException
+    try:
+        utils.atomic_write(report_file, json.dumps(get_report(), indent=1))
+    except:
+        logger.error("Failed to write metrics report", exc_info=True)
+    return report_file
+
+
+def reset():
+    """Discard all metrics."""
+    global _metrics, _changed
+    with _lock:
+        _metrics = {SCOPE_HOST: {}, SCOPE_ROUTE: {}}
+        _changed = True
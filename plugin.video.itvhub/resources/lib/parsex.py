@@ -6,18 +6,27 @@
 #  This file is part of plugin.video.itvx
 # ---------------------------------------------------------------------------------------------------------------------
 
+import re
 import json
+import functools
 import logging
-import pytz
+from json.decoder import scanstring
 
 from codequick.support import logger_id
 
 from . import utils
+from . import items
+from . import metrics
+from . import tracing
+from . import timestamps
 from .errors import ParseError
 
 
 logger = logging.getLogger(logger_id + '.parse')
 
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_json_decoder = json.JSONDecoder()
+
 # NOTE: The resolutions below are those specified by Kodi for their respective usage. There is no guarantee that
 #       the image returned by itvX is of that exact resolution.
 IMG_PROPS_THUMB = {'treatment': 'title', 'aspect_ratio': '16x9', 'class': '04_DesktopCTV_RailTileLandscape',
@@ -30,6 +39,42 @@ IMG_PROPS_FANART = {'treatment': '', 'aspect_ratio': '16x9', 'class': '01_Hero_D
                     'distributionPartner': '', 'fallback': 'standard', 'width': '1920', 'height': '1080',
                     'quality': '80', 'blur': 0, 'bg': 'false', 'image_format': 'jpg'}
 
+IMG_PROFILES = {'thumb': IMG_PROPS_THUMB, 'poster': IMG_PROPS_POSTER, 'fanart': IMG_PROPS_FANART}
+# The maximum number of distinct rendered template parts kept in memory.
+IMG_CACHE_SIZE = 256
+
+
+def image_url(template, profile):
+    """Return the url of an image of `template` with the properties of IMG_PROFILES[`profile`].
+
+    Image templates only differ in the part before the first placeholder, which identifies
+    the image. The rest, with all the placeholders, is the same for all images, so it is
+    rendered only once per profile and the image's own part is simply prefixed.
+
+    """
+    pos = template.find('{')
+    if pos < 0:
+        return template
+    return template[:pos] + _render_template_tail(template[pos:], profile)
+
+
+def image_art(template, profiles):
+    """Return a dict of the urls of images of `template` for each profile in `profiles`,
+    like the art of a listitem.
+
+    """
+    pos = template.find('{')
+    if pos < 0:
+        return dict.fromkeys(profiles, template)
+    prefix = template[:pos]
+    tail = template[pos:]
+    return {profile: prefix + _render_template_tail(tail, profile) for profile in profiles}
+
+
+@functools.lru_cache(maxsize=IMG_CACHE_SIZE)
+def _render_template_tail(tail, profile):
+    return tail.format_map(IMG_PROFILES[profile])
+
 
 def build_url(programme, programme_id, episode_id=None):
     base_url = ('https://www.itv.com/watch/' + programme.lower()
@@ -49,15 +94,83 @@ def premium_plot(plot: str):
     return '\n'.join(('[COLOR yellow]itvX premium[/COLOR]', plot))
 
 
-def scrape_json(html_page):
+NEXT_DATA_START_TAG = '<script id="__NEXT_DATA__" type="application/json">'
+SCRIPT_END_TAG = '</script>'
+
+
+def extract_next_data(page):
+    """Return the contents of the __NEXT_DATA__ script tag on an html page, or None if
+    the page does not have that tag.
+
+    `page` is either a string, or an iterable of chunks of bytes, like the content of a
+    streamed HTTP response. Chunks are only consumed until the end of the script tag has
+    been found and only the tag's content is decoded.
+
+    """
+    if isinstance(page, str):
+        chunks = (page, )
+        start_tag = NEXT_DATA_START_TAG
+        end_tag = SCRIPT_END_TAG
+        buffer = ''
+    else:
+        chunks = (page, ) if isinstance(page, bytes) else page
+        start_tag = NEXT_DATA_START_TAG.encode('utf8')
+        end_tag = SCRIPT_END_TAG.encode('utf8')
+        buffer = b''
+
+    data_start = -1
+    for chunk in chunks:
+        if data_start < 0:
+            # Tags may be split over two chunks, so also search the tail of the previous chunk.
+            buffer = buffer[-len(start_tag):] + chunk
+            tag_pos = buffer.find(start_tag)
+            if tag_pos < 0:
+                continue
+            buffer = buffer[tag_pos + len(start_tag):]
+            data_start = 0
+            search_pos = 0
+        else:
+            search_pos = max(0, len(buffer) - len(end_tag))
+            buffer += chunk
+
+        end_pos = buffer.find(end_tag, search_pos)
+        if end_pos >= 0:
+            data = buffer[:end_pos]
+            return data if isinstance(data, str) else data.decode('utf8')
+    return None
+
+
+@tracing.traced(cat='parse')
+def scrape_json(html_page, paths=None):
     # noinspection GrazieInspection
-    """Return the json data embedded in a script tag on an html page"""
-    import re
-    result = re.search(r'<script id="__NEXT_DATA__" type="application/json">(.+?)</script>', html_page, flags=re.DOTALL)
-    if result:
-        json_str = result[1]
+    """Return the json data embedded in a script tag on an html page
+
+    `html_page` is either the page as string, or an iterable of chunks of bytes.
+    See `extract_next_data()`.
+
+    If `paths` is given, only the members of pageProps selected by paths are decoded.
+    See `select_json()`.
+    """
+    with metrics.timer('scrape'):
+        json_str = extract_next_data(html_page)
+    return parse_next_data(json_str, paths)
+
+
+@tracing.traced(cat='parse')
+def parse_next_data(json_str, paths=None):
+    """Return the pageProps of the json data scraped from the __NEXT_DATA__ script tag of
+    an html page. `json_str` is None if the page did not have that tag.
+
+    If `paths` is given, only the members of pageProps selected by paths are decoded.
+    See `select_json()`.
+    """
+    if json_str:
         try:
-            data = json.loads(json_str)
+            with metrics.timer('json_parse'):
+                if paths:
+                    data = select_json(json_str, ['props.pageProps.' + path for path in paths])
+                else:
+                    data = json.loads(json_str)
             return data['props']['pageProps']
         except (json.JSONDecodeError, KeyError, TypeError) as e:
             logger.warning("__NEXT_DATA__ in HTML page has unexpected format: %r", e)
@@ -65,19 +178,94 @@ def scrape_json(html_page):
     raise ParseError('No data available')
 
 
+def select_json(json_str, paths):
+    """Decode only the parts of a json document that are selected by `paths`.
+
+    `paths` is an iterable of dotted paths to members of json objects, like 'title.brand'.
+    The result has the same structure as the full document, but contains only the
+    selected members and their parent objects. Selected members that are not present
+    in the document are absent from the result.
+
+    All other members are skipped without being kept in memory, so the memory used by the
+    result scales with the size of the selected parts, rather than the size of the document.
+
+    """
+    tree = {}
+    for path in paths:
+        node = tree
+        keys = path.split('.')
+        for key in keys[:-1]:
+            child = node.setdefault(key, {})
+            if child is None:
+                # The parent has been selected as a whole.
+                break
+            node = child
+        else:
+            node[keys[-1]] = None
+
+    try:
+        return _select_members(json_str, _WHITESPACE.match(json_str, 0).end(), tree)[0]
+    except IndexError:
+        raise json.JSONDecodeError('Unexpected end of data', json_str, len(json_str))
+
+
+def _select_members(doc, pos, tree):
+    """Decode the object at position `pos` of json string `doc`, but only the members
+    present in `tree`. Return a tuple of the decoded object and the position in `doc`
+    after the object.
+
+    """
+    if doc[pos] != '{':
+        # Not an object, so no members to select; just return the whole value.
+        return _json_decoder.raw_decode(doc, pos)
+
+    result = {}
+    pos = _WHITESPACE.match(doc, pos + 1).end()
+    if doc[pos] == '}':
+        return result, pos + 1
+
+    while True:
+        if doc[pos] != '"':
+            raise json.JSONDecodeError('Expecting property name enclosed in double quotes', doc, pos)
+        key, pos = scanstring(doc, pos + 1)
+        pos = _WHITESPACE.match(doc, pos).end()
+        if doc[pos] != ':':
+            raise json.JSONDecodeError("Expecting ':' delimiter", doc, pos)
+        pos = _WHITESPACE.match(doc, pos + 1).end()
+
+        if key in tree:
+            subtree = tree[key]
+            if subtree is None:
+                result[key], pos = _json_decoder.raw_decode(doc, pos)
+            else:
+                result[key], pos = _select_members(doc, pos, subtree)
+        else:
+            # Decoding by the C decoder and discarding the result is much faster than
+            # skipping the value in python.
+            pos = _json_decoder.raw_decode(doc, pos)[1]
+
+        pos = _WHITESPACE.match(doc, pos).end()
+        if doc[pos] == '}':
+            return result, pos + 1
+        if doc[pos] != ',':
+            raise json.JSONDecodeError("Expecting ',' delimiter", doc, pos)
+        pos = _WHITESPACE.match(doc, pos + 1).end()
+
+
+@tracing.traced(cat='parse')
 def parse_hero_content(hero_data):
     item_type = hero_data['type']
     item = {
         'label': hero_data['title'],
-        'art': {'thumb': hero_data['imageTemplate'].format(**IMG_PROPS_THUMB),
-                'fanart': hero_data['imageTemplate'].format(**IMG_PROPS_FANART)},
+        'art': {'thumb': image_url(hero_data['imageTemplate'], 'thumb'),
+                'fanart': image_url(hero_data['imageTemplate'], 'fanart')},
         'info': {'title': '[B][COLOR orange]{}[/COLOR][/B]'.format(hero_data['title'])}
 
     }
     brand_img = item.get('brandImageTemplate')
 
     if brand_img:
-        item['art']['fanart'] = brand_img.format(**IMG_PROPS_FANART)
+        item['art']['fanart'] = image_url(brand_img, 'fanart')
 
     if item_type == 'simulcastspot':
         item['params'] = {'channel': hero_data['channel'], 'url': None}
@@ -96,6 +284,7 @@ def parse_hero_content(hero_data):
     return {'type': item_type, 'show': item}
 
 
+@tracing.traced(cat='parse')
 def parse_slider(slider_name, slider_data):
     coll_data = slider_data['collection']
     page_link = coll_data.get('headingLink')
@@ -111,6 +300,7 @@ def parse_slider(slider_name, slider_data):
             'show': {'label': coll_data['headingTitle'], 'params': params}}
 
 
+@tracing.traced(cat='parse')
 def parse_collection_item(show_data):
     """Parse a show item from a collection page
 
@@ -127,70 +317,49 @@ def parse_collection_item(show_data):
     else:
         plot = show_data['description']
 
-    programme_item = {
-        'label': title,
-        'art': {'thumb': show_data['imageTemplate'].format(**IMG_PROPS_THUMB),
-                'fanart': show_data['imageTemplate'].format(**IMG_PROPS_FANART)},
-        'info': {'title': title if is_playable else '[B]{}[/B] {}'.format(title, content_info),
-                 'plot': plot,
-                 'sorttitle': sort_title[4:] if sort_title.startswith('the ') else sort_title},
-    }
-
-    if 'FILMS' in show_data['categories']:
-        programme_item['art']['poster'] = show_data['imageTemplate'].format(**IMG_PROPS_POSTER)
-
     if is_playable:
-        programme_item['info']['duration'] = utils.duration_2_seconds(content_info)
-        programme_item['params'] = {'url': build_url(show_data['titleSlug'],
-                                                     show_data['encodedProgrammeId']['letterA'])}
+        url = build_url(show_data['titleSlug'], show_data['encodedProgrammeId']['letterA'])
     else:
-        programme_item['params'] = {'url': build_url(show_data['titleSlug'],
-                                                     show_data['encodedProgrammeId']['letterA'],
-                                                     show_data['encodedEpisodeId']['letterA'])}
-    return {'playable': is_playable,
-            'show': programme_item}
-
-
+        url = build_url(show_data['titleSlug'],
+                        show_data['encodedProgrammeId']['letterA'],
+                        show_data['encodedEpisodeId']['letterA'])
+    return items.Programme(
+        is_playable, title, url, show_data['imageTemplate'],
+        art_types=items.ART_FILM if 'FILMS' in show_data['categories'] else items.ART_LANDSCAPE,
+        title=title if is_playable else '[B]{}[/B] {}'.format(title, content_info),
+        plot=plot,
+        sort_title=sort_title[4:] if sort_title.startswith('the ') else sort_title,
+        duration=utils.duration_2_seconds(content_info) if is_playable else None)
+
+
+@tracing.traced(cat='parse')
 def parse_news_collection_item(news_item, time_zone, time_fmt):
     # dateTime field occasionally has milliseconds
-    item_time = pytz.UTC.localize(utils.strptime(news_item['dateTime'][:19], '%Y-%m-%dT%H:%M:%S'))
-    loc_time = item_time.astimezone(time_zone)
+    loc_time = timestamps.to_local(timestamps.parse_iso(news_item['dateTime']), time_zone)
     base_url = 'https://www.itv.com/watch/news/'
     plot = '\n'.join((loc_time.strftime(time_fmt), news_item['synopsis']))
 
     if news_item.get('isPaid'):
         plot = premium_plot(plot)
 
-    return {
-        'playable': True,
-        'show': {
-            'label': news_item['episodeTitle'],
-            'art': {'thumb': news_item['imageUrl'].format(**IMG_PROPS_THUMB)},
-            'info': {'plot': plot},
-            'params': {'url': base_url + news_item['href']}
-        }
-    }
+    return items.Programme(True, news_item['episodeTitle'], base_url + news_item['href'], news_item['imageUrl'],
+                           plot=plot)
 
 
+@tracing.traced(cat='parse')
 def parse_trending_collection_item(trending_item):
     # No idea if premium content can be trending, but just to be sure.
     plot = '\n'.join((trending_item['description'], trending_item['contentInfo']))
     if trending_item.get('isPaid'):
         plot = premium_plot(plot)
 
-    return{
-        'playable': True,
-        'show': {
-            'label': trending_item['title'],
-            'art': {'thumb': trending_item['imageUrl'].format(**IMG_PROPS_THUMB)},
-            'info': {'plot': plot},
-            'params': {'url': build_url(trending_item['titleSlug'],
-                                        trending_item['encodedProgrammeId']['letterA'],
-                                        trending_item['encodedEpisodeId']['letterA'])}
-        }
-    }
+    url = build_url(trending_item['titleSlug'],
+                    trending_item['encodedProgrammeId']['letterA'],
+                    trending_item['encodedEpisodeId']['letterA'])
+    return items.Programme(True, trending_item['title'], url, trending_item['imageUrl'], plot=plot)
 
 
+@tracing.traced(cat='parse')
 def parse_episode_title(title_data, brand_fanart=None):
     """Parse a title from episodes listing"""
     # Note: episodeTitle may be None
@@ -200,31 +369,25 @@ def parse_episode_title(title_data, brand_fanart=None):
     if 'PAID' in title_data.get('tier', []):
         plot = premium_plot(plot)
 
-    title_obj = {
-        'label': title,
-        'art': {'thumb': img_url.format(**IMG_PROPS_THUMB),
-                'fanart': brand_fanart,
-                # 'poster': img_url.format(**IMG_PROPS_POSTER)
-                },
-        'info': {'title': title_data['numberedEpisodeTitle'],
-                 'plot': plot,
-                 'duration': utils.duration_2_seconds(title_data['duration']),
-                 'date': title_data['broadcastDateTime']},
-        'params': {'url': title_data['playlistUrl'], 'name': title}
-    }
+    title_obj = items.Episode(
+        title, title_data['playlistUrl'], img_url, brand_fanart,
+        title=title_data['numberedEpisodeTitle'],
+        plot=plot,
+        duration=utils.duration_2_seconds(title_data['duration']),
+        date=title_data['broadcastDateTime'])
     if title_data['titleType'] == 'EPISODE':
         try:
-            episode_nr = int(title_data['episodeNumber'])
+            title_obj.episode = int(title_data['episodeNumber'])
         except ValueError:
-            episode_nr = None
+            pass
         try:
-            series_nr = int(title_data['seriesNumber'])
+            title_obj.season = int(title_data['seriesNumber'])
         except ValueError:
-            series_nr = None
-        title_obj['info'].update(episode=episode_nr, season=series_nr)
+            pass
     return title_obj
 
 
+@tracing.traced(cat='parse')
 def parse_search_result(search_data):
     entity_type = search_data['entityType']
     result_data = search_data['data']
@@ -264,13 +427,6 @@ def parse_search_result(search_data):
         logger.warning("Unknown search result item entityType %s", entity_type)
         return None
 
-    return {
-        'playable': entity_type != 'programme',
-        'show':{
-            'label': prog_name,
-            'art': {'thumb': img_url.format(**IMG_PROPS_THUMB)},
-            'info': {'plot': plot,
-                     'title': title},
-            'params': {'url': build_url(prog_name, api_prod_id.replace('/', 'a'), api_episode_id.replace('/', 'a'))}
-        }
-    }
+    return items.Programme(entity_type != 'programme', prog_name,
+                           build_url(prog_name, api_prod_id.replace('/', 'a'), api_episode_id.replace('/', 'a')),
+                           img_url, title=title, plot=plot)
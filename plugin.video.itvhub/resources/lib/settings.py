@@ -14,6 +14,7 @@ from codequick.support import addon_data, logger_id
 from resources.lib import itv_account
 from resources.lib import kodi_utils
 from resources.lib import logging as itv_logging
+from resources.lib import metrics
 
 logger = logging.getLogger('.'.join((logger_id, __name__)))
 
@@ -51,3 +52,14 @@ def change_logger(_):
 
     itv_logging.set_log_handler(handler_type)
     addon_data.setSettingString('log-handler', handler_name)
+
+
+@Script.register()
+def show_request_metrics(_):
+    """Callback for settings->generic->request metrics.
+    Show a summary of the timings of web requests, parsing, etc. and write the
+    full report to file.
+
+    """
+    report_file = metrics.write_report()
+    kodi_utils.show_request_metrics(metrics.format_report(), report_file)
@@ -0,0 +1,97 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022 Dimitri Kroon.
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+"""
+Fast parsing and conversion of the timestamps in ITV's data.
+
+ITV's timestamps have a few fixed ISO 8601 formats, like '2022-11-24T19:30Z' and
+'2022-11-24T22:30:00.123Z'. They are parsed by datetime.fromisoformat(), which is many
+times faster than time.strptime() and does not suffer from the bug in datetime.strptime()
+in Kodi's embedded interpreter (https://bugs.python.org/issue27400).
+
+Timestamps are converted to other timezones by adding the zone's utc offset. Offsets are
+cached per quarter of an hour, since changes to and from daylight saving time always
+take place on a quarter of an hour in UTC.
+"""
+
+import time
+import functools
+from datetime import datetime, timedelta
+
+import pytz
+
+
+# Formats of time.strptime() that are parsed by datetime.fromisoformat(). Values are the
+# length of the timestamp and the number of characters passed to fromisoformat().
+FIXED_FORMATS = {
+    '%Y-%m-%dT%H:%M:%S': (19, 19),
+    '%Y-%m-%dT%H:%M:%SZ': (20, 19),
+    '%Y-%m-%dT%H:%M': (16, 16),
+    '%Y-%m-%dT%H:%MZ': (17, 16),
+}
+# The number of timezone offsets cached; enough for all quarters in a few days of schedules.
+OFFSET_CACHE_SIZE = 512
+
+_EPOCH = datetime(1970, 1, 1)
+_QUARTER_HOUR = timedelta(minutes=15)
+
+
+def parse_iso(dt_str):
+    """Return a naive datetime from an ISO 8601 timestamp with or without seconds, like
+    '2022-11-24T19:30Z', or '2022-11-24T22:30:00.123Z'.
+
+    Fractions of seconds and the zone designator are ignored.
+
+    """
+    if dt_str[16:17] == ':':
+        return datetime.fromisoformat(dt_str[:19])
+    else:
+        return datetime.fromisoformat(dt_str[:16])
+
+
+def strptime(dt_str, fmt):
+    """Return a naive datetime from string `dt_str` in format `fmt`, like time.strptime().
+
+    Timestamps in one of the FIXED_FORMATS are parsed directly, all others by time.strptime().
+
+    """
+    fixed = FIXED_FORMATS.get(fmt)
+    if fixed and len(dt_str) == fixed[0] and dt_str[10] == 'T' and dt_str[13] == ':' \
+            and (fixed[0] == fixed[1] or dt_str[-1] == 'Z'):
+        return datetime.fromisoformat(dt_str[:fixed[1]])
+    return datetime(*(time.strptime(dt_str, fmt)[0:6]))
+
+
+@functools.lru_cache()
+def get_timezone(name):
+    """Return the pytz timezone `name`, like 'Europe/London'."""
+    return pytz.timezone(name)
+
+
+def utc_offset(utc_dt, tz=None):
+    """Return the utc offset of timezone `tz` at naive utc datetime `utc_dt` as timedelta.
+    Timezone None is the local timezone of the system.
+
+    """
+    return _quarter_offset(tz, (utc_dt - _EPOCH) // _QUARTER_HOUR)
+
+
+@functools.lru_cache(maxsize=OFFSET_CACHE_SIZE)
+def _quarter_offset(tz, quarter):
+    timestamp = quarter * 900
+    if tz is None:
+        return timedelta(seconds=time.localtime(timestamp).tm_gmtoff)
+    else:
+        return datetime.fromtimestamp(timestamp, tz).utcoffset()
+
+
+def to_local(utc_dt, tz=None):
+    """Return naive utc datetime `utc_dt` as naive datetime in timezone `tz`, or in the
+    local timezone of the system if `tz` is None.
+
+    """
+    return utc_dt + utc_offset(utc_dt, tz)
@@ -0,0 +1,142 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022 Dimitri Kroon.
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+"""
+Opt-in tracing of routes.
+
+When enabled in the settings, the time spent in a route and in the functions called from
+it is recorded and written to a file in Chrome's trace event format in the directory
+TRACE_DIR in the addon's profile. Open the file in chrome://tracing, or at
+https://ui.perfetto.dev to view a timeline of the route.
+
+When tracing is disabled, spans and traced functions only cost a check of a global variable.
+"""
+
+import os
+import time
+import json
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from codequick.support import logger_id
+
+from . import utils
+
+
+logger = logging.getLogger(logger_id + '.tracing')
+
+TRACE_DIR = 'traces'
+# The number of trace files kept, older files are removed.
+MAX_TRACE_FILES = 20
+
+# Events of the current trace, or None if tracing is disabled.
+_events = None
+_thread_names = {}
+_trace_start = 0
+_route = None
+_lock = threading.Lock()
+
+
+def _add_event(name, cat, start, end, args):
+    thread = threading.current_thread()
+    event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+             'ts': round((start - _trace_start) * 1e6, 1), 'dur': round((end - start) * 1e6, 1)}
+    if args:
+        event['args'] = args
+    with _lock:
+        if _events is not None:
+            _events.append(event)
+            _thread_names[thread.ident] = thread.name
+
+
+@contextmanager
+def span(name, cat='function', **args):
+    """Context manager that records the time spent in its block as an event named `name`.
+    Keyword arguments are shown with the event in the trace viewer.
+
+    """
+    if _events is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_event(name, cat, start, time.perf_counter(), args)
+
+
+def traced(func=None, cat='function'):
+    """Decorator that records each call of the decorated function as an event.
+    Can be used with or without arguments.
+
+    """
+    if func is None:
+        return lambda f: traced(f, cat)
+
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if _events is None:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _add_event(name, cat, start, time.perf_counter(), None)
+    return wrapper
+
+
+def start_trace(url):
+    """Start tracing the route of plugin url `url`, if tracing is enabled in the settings."""
+    global _events, _trace_start, _route
+    enabled = utils.setting_enabled('trace-routes')
+    with _lock:
+        _thread_names.clear()
+        if not enabled:
+            _events = None
+            return
+        _events = []
+        _route = url
+        _trace_start = time.perf_counter()
+    logger.info("Tracing route %s", url)
+
+
+def stop_trace():
+    """Stop tracing and write all events recorded since start_trace() to a new file
+    in TRACE_DIR. Return the path of the file, or None if tracing is not enabled.
+
+    """
+    global _events
+    with _lock:
+        if _events is None:
+            return None
+        events = _events
+        _events = None
+        events.insert(0, {'name': _route, 'cat': 'invocation', 'ph': 'X', 'pid': os.getpid(),
+                          'tid': threading.main_thread().ident,
+                          'ts': 0, 'dur': round((time.perf_counter() - _trace_start) * 1e6, 1)})
+        events.extend({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+                      for tid, name in _thread_names.items())
+
+    trace_dir = os.path.join(utils.addon_info['profile'], TRACE_DIR)
+    route_name = urlsplit(_route).path.strip('/').replace('/', '.') or 'root'
+    trace_file = os.path.join(trace_dir, 'trace-{}-{}.json'.format(time.strftime('%Y%m%d-%H%M%S'), route_name))
+    # noinspection PyBroadException
+    try:
+        os.makedirs(trace_dir, exist_ok=True)
+        utils.atomic_write(trace_file, json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms',
+                                                   'otherData': {'route': _route}}))
+        utils.remove_old_files(trace_dir, 'trace-', MAX_TRACE_FILES)
+    except:
+        logger.error("Failed to write trace file", exc_info=True)
+        return None
+    logger.info("Trace written to %s", trace_file)
+    return trace_file
@@ -5,15 +5,18 @@
 #  This file is part of plugin.video.itvx
 # ---------------------------------------------------------------------------------------------------------------------
 
+import os
 import logging
 import time
+import tempfile
 from datetime import datetime
 
 from xbmcvfs import translatePath
 import xbmcaddon
 
-from codequick.support import logger_id
+from codequick.support import addon_data, logger_id
 from . errors import *
+from . import timestamps
 
 
 def create_addon_info(addon_id=None):
@@ -51,6 +54,46 @@ def random_string(length):
     return result
 
 
+def setting_enabled(setting_id):
+    """Return the value of boolean setting `setting_id`, or False if the setting cannot be read."""
+    # noinspection PyBroadException
+    try:
+        return addon_data.getSettingBool(setting_id)
+    except:
+        return False
+
+
+def atomic_write(path, data):
+    """Write `data`, either str or bytes, to file `path`.
+
+    The data is first written to a temporary file in the same directory, which then
+    replaces `path`, so a crash halfway, or a reader on another thread, never finds
+    a partially written file. Raises OSError if the file cannot be written.
+
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def remove_old_files(directory, prefix, keep):
+    """Remove all but the last `keep` files in `directory` of which the name starts
+    with `prefix`, in order of their names.
+
+    """
+    file_paths = sorted(entry.path for entry in os.scandir(directory) if entry.name.startswith(prefix))
+    for path in file_paths[:-keep]:
+        os.remove(path)
+
+
 def get_json_from_html(page):
     """Extract JSON data from the end of an HTML page and return it as a python object.
 
@@ -59,19 +102,12 @@ def get_json_from_html(page):
 
     """
     import json
+    from .parsex import extract_next_data
 
-    script_start_tag = '<script id="__NEXT_DATA__" type="application/json">'
-    pos_start = page.find(script_start_tag) + len(script_start_tag)
-    if pos_start < len(script_start_tag):
-        logger.error('Failed to parse page shows: script tag not found')
-        raise ParseError
-
-    pos_end = page.find('</script>', pos_start)
-    if pos_end < pos_start:
-        logger.error('Failed to parse page shows: cannot find </script> tag')
+    script = extract_next_data(page)
+    if script is None:
+        logger.error('Failed to parse page shows: __NEXT_DATA__ script not found')
         raise ParseError
-
-    script = page[pos_start:pos_end]
     return json.loads(script)
 
 
@@ -275,4 +311,4 @@ def reformat_date(date_string, old_format, new_format):
 
 def strptime(dt_str, format):
     """A bug free alternative to `datetime.datetime.strptime(...)`"""
-    return datetime(*(time.strptime(dt_str, format)[0:6]))
\ No newline at end of file
+    return timestamps.strptime(dt_str, format)
\ No newline at end of file
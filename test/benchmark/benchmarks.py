@@ -0,0 +1,233 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022. Dimitri Kroon
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+"""
+Benchmark cases.
+
+Each case is a function registered with @benchmark that performs any preparation and
+returns a callable without arguments, which is the code to be measured. Patches that
+need to be active while the callable runs are entered on the ExitStack passed to the
+case; they are removed when the benchmark has finished.
+
+All network access is mocked out, data comes from the documents in test_docs.
+"""
+
+from test.support import fixtures
+fixtures.global_setup()
+
+import json
+from unittest.mock import patch
+
+from resources.lib import itv
+from resources.lib import itvx
+from resources.lib import cache
+from resources.lib import parsex
+from resources.lib import utils
+from resources.lib import timestamps
+
+from test.support.testutils import doc_path, open_doc, open_json
+
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def decorator(case):
+        BENCHMARKS[name] = case
+        return case
+    return decorator
+
+
+def _read_bytes(doc):
+    with open(doc_path(doc), 'rb') as f:
+        return f.read()
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+#   Scraping
+# ---------------------------------------------------------------------------------------------------------------------
+
+@benchmark('scrape_json.index')
+def scrape_index(stack):
+    page = open_doc('html/index.html')()
+    return lambda: parsex.scrape_json(page)
+
+
+@benchmark('scrape_json.index_selected')
+def scrape_index_selected(stack):
+    page = open_doc('html/index.html')()
+    return lambda: parsex.scrape_json(page, ('heroContent', 'editorialSliders'))
+
+
+@benchmark('scrape_json.index_chunked')
+def scrape_index_chunked(stack):
+    """Scrape from chunks of bytes, as is done with streamed HTTP responses."""
+    from resources.lib.fetch import DOC_CHUNK_SIZE
+    page = _read_bytes('html/index.html')
+    chunks = [page[i:i + DOC_CHUNK_SIZE] for i in range(0, len(page), DOC_CHUNK_SIZE)]
+    return lambda: parsex.scrape_json(iter(chunks))
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+#   Parsers
+#   Each benchmark parses all items of a document.
+# ---------------------------------------------------------------------------------------------------------------------
+
+@benchmark('parsex.image_url.films')
+def image_url_films(stack):
+    templates = [prog['imageTemplate'] for prog in open_json('html/category_films.json')['programmes']]
+    return lambda: [parsex.image_url(template, profile)
+                    for template in templates for profile in ('thumb', 'fanart', 'poster')]
+
+
+@benchmark('parse_hero_content')
+def parse_hero_content(stack):
+    hero_items = open_json('html/index-data.json')['heroContent']
+    return lambda: [parsex.parse_hero_content(item) for item in hero_items]
+
+
+@benchmark('parse_slider')
+def parse_slider(stack):
+    sliders = list(open_json('html/index-data.json')['editorialSliders'].items())
+    return lambda: [parsex.parse_slider(*slider) for slider in sliders]
+
+
+@benchmark('parse_collection_item')
+def parse_collection_item(stack):
+    shows = open_json('html/collection_just-in_data.json')['collection']['shows']
+    return lambda: [parsex.parse_collection_item(show) for show in shows]
+
+
+@benchmark('parse_news_collection_item')
+def parse_news_collection_item(stack):
+    import pytz
+    news_items = open_json('html/index-data.json')['newsShortformSliderContent']['items']
+    tz = pytz.timezone('Europe/London')
+    return lambda: [parsex.parse_news_collection_item(item, tz, '%d-%m-%Y %H:%M') for item in news_items]
+
+
+@benchmark('parse_trending_collection_item')
+def parse_trending_collection_item(stack):
+    trending_items = open_json('html/index-data.json')['trendingSliderContent']['items']
+    return lambda: [parsex.parse_trending_collection_item(item) for item in trending_items]
+
+
+@benchmark('parse_episode_title')
+def parse_episode_title(stack):
+    series_list = open_json('html/series_midsummer-murders.json')['title']['brand']['series']
+    episodes = [episode for series in series_list for episode in series['episodes']]
+    return lambda: [parsex.parse_episode_title(episode, 'fanart') for episode in episodes]
+
+
+@benchmark('parse_search_result')
+def parse_search_result(stack):
+    results = open_json('search/the_chase.json')['results']
+    return lambda: [parsex.parse_search_result(result) for result in results]
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+#   Listings
+#   Page data is returned by a mocked get_page_data, so only the creation of the listing is measured, up to
+#   the dicts that are passed to Listitem.from_dict().
+# ---------------------------------------------------------------------------------------------------------------------
+
+def _to_dicts(listing):
+    return [item.to_dict() for item in listing]
+
+
+@benchmark('itvx.category_content.films')
+def category_films(stack):
+    stack.enter_context(patch('resources.lib.itvx.get_page_data',
+                              return_value=open_json('html/category_films.json')))
+    return lambda: _to_dicts(itvx.category_content('https://www.itv.com/watch/categories/films'))
+
+
+@benchmark('itvx.episodes.midsummer_murders')
+def episodes_midsummer_murders(stack):
+    stack.enter_context(patch('resources.lib.itvx.get_page_data',
+                              return_value=open_json('html/series_midsummer-murders.json')))
+    # Measure parsing, rather than getting episodes from the cache.
+    stack.enter_context(patch('resources.lib.cache.get_item', return_value=None))
+    stack.enter_context(patch('resources.lib.cache.set_item'))
+
+    def list_episodes():
+        # Like the listing of series folders and the episodes of one opened series.
+        series_map = itvx.episodes('https://www.itv.com/watch/midsomer-murders/Ya1096', 4)
+        return _to_dicts(series_map.values()) + _to_dicts(series_map[4].episodes)
+    return list_episodes
+
+
+@benchmark('itvx.collection_content.collection_page')
+def collection_page(stack):
+    stack.enter_context(patch('resources.lib.itvx.get_page_data',
+                              return_value=open_json('html/collection_just-in_data.json')))
+    return lambda: _to_dicts(itvx.collection_content(url='https://www.itv.com/watch/collections/just-in'))
+
+
+@benchmark('itvx.collection_content.news')
+def collection_news(stack):
+    stack.enter_context(patch('resources.lib.itvx.get_page_data',
+                              return_value=open_json('html/index-data.json')))
+    return lambda: _to_dicts(itvx.collection_content(slider='newsShortformSliderContent'))
+
+
+@benchmark('itvx.collection_content.news_revisited')
+def collection_news_revisited(stack):
+    # The main page is in the cache, so the listing is parsed once and reused on all later runs.
+    cache.purge()
+    stack.callback(cache.purge)
+    cache.set_item('https://www.itv.com', open_json('html/index-data.json'), 3600)
+    return lambda: _to_dicts(itvx.collection_content(slider='newsShortformSliderContent'))
+
+
+@benchmark('itvx.get_live_channels')
+def get_live_channels(stack):
+    # The data is modified in place, so every request gets a freshly decoded copy, like
+    # a real get_json() would return.
+    now_next = open_doc('schedule/now_next.json')()
+    schedule = open_doc('schedule/live_4hrs.json')()
+
+    def get_json(url, *args, **kwargs):
+        return json.loads(now_next if 'nownext' in url else schedule)
+
+    stack.enter_context(patch('resources.lib.fetch.get_json', new=get_json))
+    return lambda: _to_dicts(itvx.get_live_channels())
+
+
+@benchmark('timestamps.live_4hrs')
+def timestamps_live_4hrs(stack):
+    slots = [slot for channel in open_json('schedule/live_4hrs.json')['_embedded']['schedule']
+             for slot in channel['_embedded']['slot']]
+
+    def parse_schedule():
+        return [(timestamps.parse_iso(slot['startTime']),
+                 timestamps.to_local(timestamps.parse_iso(slot['onAirTimeUTC'])).strftime('%H:%M'))
+                for slot in slots]
+    return parse_schedule
+
+
+@benchmark('itv.get_live_schedule')
+def get_live_schedule(stack):
+    schedule = open_doc('schedule/live_4hrs.json')()
+    stack.enter_context(patch('resources.lib.fetch.get_json', new=lambda *args, **kwargs: json.loads(schedule)))
+    return lambda: itv.get_live_schedule()
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+#   Subtitles
+# ---------------------------------------------------------------------------------------------------------------------
+
+@benchmark('vtt_to_srt.doc_martin')
+def vtt_doc_martin(stack):
+    vtt_doc = open_doc('vtt/subtitles_doc_martin.vtt')()
+    return lambda: utils.vtt_to_srt(vtt_doc)
+
+
+@benchmark('vtt_to_srt.ruth_rendell')
+def vtt_ruth_rendell(stack):
+    vtt_doc = open_doc('vtt/subtitles_ruth_rendell.vtt')()
+    return lambda: utils.vtt_to_srt(vtt_doc)
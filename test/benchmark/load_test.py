@@ -0,0 +1,177 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022. Dimitri Kroon
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+"""
+Load test of the addon's routes against the local stand-in of the ITV web services.
+
+Usage, from the project's root directory, with the same python path as the tests:
+
+    python -m test.benchmark.load_test [-n ITERATIONS] [--threads N] [--no-cache]
+                                       [--latency SEC] [--jitter SEC] [--bandwidth BYTES_PER_SEC]
+                                       [--error-rate FRACTION] [--reset-rate FRACTION]
+                                       [--profile FILE] [--replay CAPTURE_FILE]
+
+Each iteration runs all routes in ROUTES, like Kodi would call them, through the addon's
+complete HTTP stack. With --threads, iterations run concurrently, as with several
+invocations of the addon sharing one python interpreter. Response times of the routes
+are reported per route.
+
+With --replay, requests are not sent to the stand-in server, but answered from a capture
+file recorded by the addon, see resources.lib.capture. Routes of which the requests are
+not in the capture fail.
+
+With --profile, cProfile statistics of the run are written to FILE. As cProfile only
+profiles the thread it runs in, --profile cannot be combined with --threads.
+"""
+
+from test.support import fixtures
+fixtures.global_setup()
+
+import sys
+import time
+import argparse
+import cProfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+from resources.lib import main as routes
+from resources.lib import cache
+from resources.lib import fetch
+from resources.lib import capture
+
+from test.support.stand_in_server import StandInServer, Faults
+
+
+ROUTES = (
+    ('root', routes.root, {}),
+    ('sub_menu_live', routes.sub_menu_live, {}),
+    ('list_collections', routes.list_collections, {}),
+    ('list_collection_content.trending', routes.list_collection_content, {'slider': 'trendingSliderContent'}),
+    ('list_collection_content.just-in', routes.list_collection_content,
+     {'url': 'https://www.itv.com/watch/collections/just-in/2RQpkypwh3w8m6738sUHQH'}),
+    ('list_categories', routes.list_categories, {}),
+    ('list_category.films', routes.list_category, {'path': '/watch/categories/films'}),
+    ('list_productions.midsomer', routes.list_productions,
+     {'url': 'https://www.itv.com/watch/midsomer-murders/Ya1096', 'series_idx': 4}),
+    ('do_search', routes.do_search, {'search_query': 'the chase'}),
+)
+
+
+def _has_episodes(items):
+    """Return whether a listing of productions holds episodes, besides the folders of series."""
+    return any('series_idx' not in item.params for item in items)
+
+
+# Checks of the results of routes; a route of which the result fails its check counts as an error.
+CHECKS = {
+    'list_productions.midsomer': _has_episodes,
+}
+
+
+def run_route(name, route, kwargs):
+    """Run a route and return its duration in seconds, or None if it failed."""
+    addon = MagicMock()
+    addon.setting.get_boolean.return_value = False
+    start = time.perf_counter()
+    # noinspection PyBroadException
+    try:
+        result = route(addon, **kwargs)
+        result = list(result) if result else []
+    except Exception as e:
+        print("Route {} failed: {!r}".format(name, e))
+        return None
+    duration = time.perf_counter() - start
+    check = CHECKS.get(name)
+    if check and not check(result):
+        print("Route {} failed: unexpected result of {} items".format(name, len(result)))
+        return None
+    return duration
+
+
+def run_iteration(no_cache):
+    if no_cache:
+        cache.purge()
+    return [(name, run_route(name, route, kwargs)) for name, route, kwargs in ROUTES]
+
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+def report(durations, total_time, server):
+    print('\n{:<36}{:>7}{:>8}{:>10}{:>10}{:>10}'.format('route', 'runs', 'errors', 'p50 ms', 'p90 ms', 'max ms'))
+    for name, _, _ in ROUTES:
+        times = [d for d in durations[name] if d is not None]
+        errors = len(durations[name]) - len(times)
+        if times:
+            print('{:<36}{:>7}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+                name, len(times), errors,
+                _percentile(times, 50) * 1000, _percentile(times, 90) * 1000, max(times) * 1000))
+        else:
+            print('{:<36}{:>7}{:>8}'.format(name, 0, errors))
+    statuses = {}
+    for req in server.requests:
+        statuses[req['status']] = statuses.get(req['status'], 0) + 1
+    print('\nTotal time: {:.2f} s, HTTP requests: {}, by status: {}'.format(
+        total_time, len(server.requests), ', '.join('{}: {}'.format(k, v) for k, v in statuses.items())))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Load test the addon's routes against a local stand-in server.")
+    parser.add_argument('-n', '--iterations', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=1, help="number of iterations running concurrently")
+    parser.add_argument('--no-cache', action='store_true', help="purge the cache before each iteration")
+    parser.add_argument('--latency', type=float, default=0, help="seconds before each response")
+    parser.add_argument('--jitter', type=float, default=0, help="maximum random seconds added to latency")
+    parser.add_argument('--bandwidth', type=int, default=None, help="bytes per second")
+    parser.add_argument('--error-rate', type=float, default=0, help="fraction of requests that fail")
+    parser.add_argument('--reset-rate', type=float, default=0, help="fraction of connections reset")
+    parser.add_argument('--profile', metavar='FILE', help="write cProfile statistics to FILE")
+    parser.add_argument('--replay', metavar='CAPTURE_FILE', help="answer requests from a capture file")
+    opts = parser.parse_args(args)
+    if opts.profile and opts.threads > 1:
+        parser.error("--profile cannot be used with --threads")
+
+    faults = Faults(latency=opts.latency, jitter=opts.jitter, bandwidth=opts.bandwidth,
+                    error_rate=opts.error_rate, reset_rate=opts.reset_rate)
+    profiler = cProfile.Profile() if opts.profile else None
+    durations = {name: [] for name, _, _ in ROUTES}
+
+    with StandInServer(faults) as server:
+        if opts.replay:
+            capture.start_replay(opts.replay)
+        else:
+            server.install()
+        cache.purge()
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        if opts.threads > 1:
+            with ThreadPoolExecutor(opts.threads) as executor:
+                all_results = list(executor.map(run_iteration, [opts.no_cache] * opts.iterations))
+        else:
+            all_results = [run_iteration(opts.no_cache) for _ in range(opts.iterations)]
+        if profiler:
+            profiler.disable()
+        total_time = time.perf_counter() - start
+        for results in all_results:
+            for name, duration in results:
+                durations[name].append(duration)
+        report(durations, total_time, server)
+        capture.stop_replay()
+
+    cache.purge()
+    fetch.save_state()
+    if profiler:
+        profiler.dump_stats(opts.profile)
+        print("Profile written to", opts.profile)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022. Dimitri Kroon
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+"""
+Run the benchmarks and compare the results with a stored baseline.
+
+Usage, from the project's root directory, with the same python path as the tests:
+
+    python -m test.benchmark.run_benchmarks [-k PATTERN] [--tolerance FRACTION] [--save-baseline]
+
+For each benchmark the number of operations per second and the peak memory allocated
+during a single operation are reported. The process exits with status 1 when any
+benchmark is slower, or uses more memory, than its baseline by more than the tolerance.
+It also fails when a benchmark is much faster than its baseline, since a baseline that
+no longer reflects the code would hide any later regressions; save a new baseline then.
+
+Speed depends on the machine and on its load at the time of the run. To make results
+comparable, each benchmark is alternated with a fixed calibration workload and speed is
+compared as the ratio of both. Still, a baseline is best created on the machine it is used
+on. Use --save-baseline to store the results of a run as the new baseline.
+"""
+
+from test.support import fixtures
+fixtures.global_setup()
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import tracemalloc
+from contextlib import ExitStack
+
+from test.benchmark.benchmarks import BENCHMARKS
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# The number of timing rounds of which the fastest is used.
+REPEAT = 5
+# Allowed relative difference of the peak memory use, which hardly varies between runs.
+MEMORY_TOLERANCE = 0.1
+# A benchmark with a speed of more than STALE_FACTOR times its baseline has a stale baseline.
+STALE_FACTOR = 2
+
+
+def _calibration():
+    """A fixed workload of the same nature as the code under test."""
+    data = json.loads(CALIBRATION_DOC)
+    return ['{}: {}'.format(k, v).lower() for item in data for k, v in item.items()]
+
+
+CALIBRATION_DOC = json.dumps([{'title': 'Title {}'.format(i), 'id': i, 'tier': ['FREE']} for i in range(200)])
+
+
+def measure(case):
+    """Run a single benchmark case and return a dict with its operations per second,
+    its speed relative to the calibration workload and its peak memory use in bytes.
+
+    """
+    with ExitStack() as stack:
+        func = case(stack)
+        timer = timeit.Timer(func)
+        calibration_timer = timeit.Timer(_calibration)
+        number, _ = timer.autorange()
+        calibration_number, _ = calibration_timer.autorange()
+        best = calibration_best = float('inf')
+        # Alternate rounds, so both are affected alike by changes in the machine's speed.
+        for _ in range(REPEAT):
+            best = min(best, timer.timeit(number) / number)
+            calibration_best = min(calibration_best, calibration_timer.timeit(calibration_number) / calibration_number)
+
+        tracemalloc.start()
+        try:
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return {'ops': round(1 / best, 1), 'score': round(calibration_best / best, 5), 'peak_mem': peak}
+
+
+def load_baseline():
+    try:
+        with open(BASELINE_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(results):
+    baseline = load_baseline()
+    baseline.update(results)
+    with open(BASELINE_FILE, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+def compare(result, base, tolerance):
+    """Return a list of the regressions of `result` relative to `base`."""
+    regressions = []
+    if result['score'] < base['score'] * (1 - tolerance):
+        regressions.append('speed')
+    if result['peak_mem'] > base['peak_mem'] * (1 + MEMORY_TOLERANCE):
+        regressions.append('memory')
+    if result['score'] > base['score'] * STALE_FACTOR:
+        regressions.append('stale baseline')
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Run benchmarks on the documents in test_docs.")
+    parser.add_argument('-k', dest='pattern', default='',
+                        help="only run benchmarks of which the name contains PATTERN")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed relative decrease of speed (default: 0.25)")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store the results as the new baseline")
+    opts = parser.parse_args(args)
+
+    baseline = load_baseline()
+    results = {}
+    failed = []
+    fixtures.setup_local_tests()
+    try:
+        print('{:<44}{:>12}{:>10}{:>9}{:>12}{:>9}  {}'.format(
+            'benchmark', 'ops/s', 'score', 'change', 'peak KiB', 'change', 'status'))
+        for name, case in BENCHMARKS.items():
+            if opts.pattern not in name:
+                continue
+            result = results[name] = measure(case)
+            base = baseline.get(name)
+            if base:
+                regressions = compare(result, base, opts.tolerance)
+                if regressions:
+                    failed.append(name)
+                print('{:<44}{:>12.1f}{:>10.4f}{:>+8.1f}%{:>12.1f}{:>+8.1f}%  {}'.format(
+                    name, result['ops'], result['score'], (result['score'] / base['score'] - 1) * 100,
+                    result['peak_mem'] / 1024, (result['peak_mem'] / base['peak_mem'] - 1) * 100,
+                    'REGRESSION ({})'.format(', '.join(regressions)) if regressions else 'ok'))
+            else:
+                print('{:<44}{:>12.1f}{:>10.4f}{:>9}{:>12.1f}{:>9}  {}'.format(
+                    name, result['ops'], result['score'], '-', result['peak_mem'] / 1024, '-', 'no baseline'))
+    finally:
+        fixtures.tear_down_local_tests()
+
+    if opts.save_baseline:
+        save_baseline(results)
+        print("\nBaseline saved to", BASELINE_FILE)
+        return 0
+    if failed:
+        print("\n{} benchmark(s) failed the comparison with their baseline: {}".format(
+            len(failed), ', '.join(failed)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
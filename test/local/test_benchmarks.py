@@ -0,0 +1,42 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022. Dimitri Kroon
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+from test.support import fixtures
+fixtures.global_setup()
+
+from contextlib import ExitStack
+from unittest import TestCase
+
+from test.benchmark import run_benchmarks
+from test.benchmark.benchmarks import BENCHMARKS
+
+
+setUpModule = fixtures.setup_local_tests
+tearDownModule = fixtures.tear_down_local_tests
+
+
+class Benchmarks(TestCase):
+    def test_all_benchmarks_run(self):
+        """Ensure the benchmarks keep working when the code under test changes."""
+        for name, case in BENCHMARKS.items():
+            with self.subTest(name):
+                with ExitStack() as stack:
+                    case(stack)()
+
+    def test_all_benchmarks_have_a_baseline(self):
+        self.assertSetEqual(set(BENCHMARKS), set(run_benchmarks.load_baseline()))
+
+    def test_compare(self):
+        base = {'ops': 100, 'score': 1.0, 'peak_mem': 1000}
+        compare = run_benchmarks.compare
+        # Speed is compared by score, not by operations per second.
+        self.assertListEqual([], compare({'ops': 50, 'score': 0.8, 'peak_mem': 1050}, base, 0.25))
+        self.assertListEqual(['speed'], compare({'ops': 100, 'score': 0.7, 'peak_mem': 1000}, base, 0.25))
+        self.assertListEqual(['memory'], compare({'ops': 100, 'score': 1.2, 'peak_mem': 1200}, base, 0.25))
+        # A much faster benchmark means the baseline is out of date.
+        self.assertListEqual([], compare({'ops': 190, 'score': 1.9, 'peak_mem': 1000}, base, 0.25))
+        self.assertListEqual(['stale baseline'], compare({'ops': 300, 'score': 3.0, 'peak_mem': 1000}, base, 0.25))
@@ -9,9 +9,12 @@
 from test.support import fixtures
 fixtures.global_setup()
 
+import os
 import time
+import shutil
+import tempfile
 import unittest
-from unittest.mock import patch, mock_open
+from unittest.mock import patch
 
 from resources.lib import cache
 
@@ -20,11 +23,26 @@ setUpModule = fixtures.setup_local_tests
 tearDownModule = fixtures.tear_down_local_tests
 
 
+def clear_memory():
+    """Simulate the start of a new interpreter"""
+    cache.__cache__.clear()
+    cache._mem_size = 0
+
+
 class TestCache(unittest.TestCase):
     my_str = '1234'
     my_list = [1, 2, 3, 4]
     my_dict = {1: '1', '2': 2}
 
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.patch_dir = patch('resources.lib.cache.DISK_CACHE_DIR', new=self.cache_dir)
+        self.patch_dir.start()
+
+    def tearDown(self):
+        self.patch_dir.stop()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
     def test_cache_set_get(self):
         cache.purge()
         cache.set_item('1', self.my_str,  10)
@@ -52,3 +70,186 @@ class TestCache(unittest.TestCase):
         cache.purge()
         self.assertEqual(0, cache.size())
         self.assertIsNone(cache.get_item('1'))
+
+    def test_validators(self):
+        cache.purge()
+        cache.set_item('1', self.my_str, 10, {'ETag': '"abc"'})
+        cache.set_item('2', self.my_list, -10, {'ETag': '"def"'})
+        cache.set_item('3', self.my_dict, 10)
+        self.assertDictEqual({'ETag': '"abc"'}, cache.get_validators('1'))
+        # validators are available after an item has expired
+        self.assertDictEqual({'ETag': '"def"'}, cache.get_validators('2'))
+        self.assertIsNone(cache.get_validators('3'))
+        self.assertIsNone(cache.get_validators('4'))
+
+    def test_get_stale_item(self):
+        cache.purge()
+        cache.set_item('1', self.my_list, -10)
+        self.assertIsNone(cache.get_item('1'))
+        self.assertListEqual(self.my_list, cache.get_stale_item('1', 60))
+        self.assertIsNone(cache.get_stale_item('1', 5))
+        clear_memory()
+        # from disk
+        self.assertListEqual(self.my_list, cache.get_stale_item('1', 60))
+        self.assertIsNone(cache.get_stale_item('2', 60))
+
+    def test_renew(self):
+        cache.purge()
+        cache.set_item('1', self.my_list, -10)
+        self.assertIsNone(cache.get_item('1'))
+        self.assertListEqual(self.my_list, cache.renew('1', 10))
+        self.assertListEqual(self.my_list, cache.get_item('1'))
+        self.assertIsNone(cache.renew('2', 10))
+
+    def test_expires_in(self):
+        cache.purge()
+        cache.set_item('1', self.my_list, 10)
+        cache.set_item('2', self.my_list, -10)
+        self.assertAlmostEqual(10, cache.expires_in('1'), delta=1)
+        self.assertAlmostEqual(-10, cache.expires_in('2'), delta=1)
+        self.assertIsNone(cache.expires_in('3'))
+        clear_memory()
+        # from disk
+        self.assertAlmostEqual(10, cache.expires_in('1'), delta=1)
+        self.assertAlmostEqual(-10, cache.expires_in('2'), delta=1)
+
+    def test_release(self):
+        cache.purge()
+        cache.set_item('1', self.my_dict, 10)
+        cache.set_item('2', self.my_list, 10)
+        cache.release('1')
+        cache.release('3')
+        self.assertListEqual(['2'], list(cache.__cache__.keys()))
+        self.assertEqual(cache.estimate_size(self.my_list), cache.size(in_bytes=True))
+        # Released items are still on disk
+        self.assertDictEqual(self.my_dict, cache.get_item('1'))
+
+    def test_size_in_bytes(self):
+        cache.purge()
+        self.assertEqual(0, cache.size(in_bytes=True))
+        cache.set_item('1', self.my_dict, 10)
+        dict_size = cache.size(in_bytes=True)
+        self.assertGreater(dict_size, 0)
+        cache.set_item('2', [self.my_dict, self.my_dict], 10)
+        self.assertGreater(cache.size(in_bytes=True), dict_size)
+        cache.set_item('2', self.my_str, 10)
+        self.assertEqual(dict_size + cache.estimate_size(self.my_str), cache.size(in_bytes=True))
+        cache.purge()
+        self.assertEqual(0, cache.size(in_bytes=True))
+
+    def test_estimate_size(self):
+        small = cache.estimate_size({'a': [1, 2, 3]})
+        large = cache.estimate_size({'a': [{'b': str(i) * 1000} for i in range(10)]})
+        self.assertGreater(large, 10000)
+        self.assertGreater(large, small)
+
+    def test_memory_lru_eviction(self):
+        cache.purge()
+        data = ['x' * 1000]
+        item_size = cache.estimate_size(data)
+        with patch('resources.lib.cache.MEM_CACHE_MAX_SIZE', new=int(item_size * 2.5)):
+            cache.set_item('1', data, 10)
+            cache.set_item('2', data, 10)
+            # Make '1' the most recently used item
+            cache.get_item('1')
+            cache.set_item('3', data, 10)
+            self.assertEqual(2, cache.size())
+            self.assertListEqual(['1', '3'], list(cache.__cache__.keys()))
+            self.assertLessEqual(cache.size(in_bytes=True), cache.MEM_CACHE_MAX_SIZE)
+
+    def test_expired_items_are_cleaned_first(self):
+        cache.purge()
+        data = ['x' * 1000]
+        item_size = cache.estimate_size(data)
+        with patch('resources.lib.cache.MEM_CACHE_MAX_SIZE', new=int(item_size * 2.5)):
+            cache.set_item('1', data, 10)
+            cache.set_item('2', data, -10)
+            cache.set_item('3', data, 10)
+            self.assertListEqual(['1', '3'], list(cache.__cache__.keys()))
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.patch_dir = patch('resources.lib.cache.DISK_CACHE_DIR', new=self.cache_dir)
+        self.patch_dir.start()
+        cache.purge()
+
+    def tearDown(self):
+        self.patch_dir.stop()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_get_item_from_disk(self):
+        cache.set_item('1', {'a': [1, 2]}, 10, {'ETag': '"abc"'})
+        cache.set_item('2', {'b': [1, 2]}, -10, {'ETag': '"def"'})
+        self.assertEqual(2, len(os.listdir(self.cache_dir)))
+        clear_memory()
+        self.assertDictEqual({'a': [1, 2]}, cache.get_item('1'))
+        self.assertEqual(1, cache.size())
+        # Expired items are not returned, but their validators are.
+        self.assertIsNone(cache.get_item('2'))
+        self.assertDictEqual({'ETag': '"def"'}, cache.get_validators('2'))
+
+    def test_renew_item_on_disk(self):
+        cache.set_item('1', {'a': [1, 2]}, -10)
+        clear_memory()
+        self.assertDictEqual({'a': [1, 2]}, cache.renew('1', 10))
+        clear_memory()
+        self.assertDictEqual({'a': [1, 2]}, cache.get_item('1'))
+
+    def test_purge_removes_files(self):
+        cache.set_item('1', {'a': [1, 2]}, 10)
+        cache.purge()
+        self.assertListEqual([], os.listdir(self.cache_dir))
+        self.assertIsNone(cache.get_item('1'))
+
+    def test_unreadable_file(self):
+        cache.set_item('1', {'a': [1, 2]}, 10)
+        clear_memory()
+        file_name = os.listdir(self.cache_dir)[0]
+        with open(os.path.join(self.cache_dir, file_name), 'wb') as f:
+            f.write(b'garbage')
+        self.assertIsNone(cache.get_item('1'))
+        self.assertListEqual([], os.listdir(self.cache_dir))
+
+    def test_lru_eviction(self):
+        data = 'x' * 1000
+        with patch('resources.lib.cache.DISK_CACHE_MAX_SIZE', new=2500):
+            cache.set_item('1', data, 10)
+            os.utime(os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0]), (time.time() - 20, time.time() - 20))
+            cache.set_item('2', data, 10)
+            os.utime(cache._disk_path('2'), (time.time() - 10, time.time() - 10))
+            # Reading '1' makes it the most recently used item
+            clear_memory()
+            cache.get_item('1')
+            cache.set_item('3', data, 10)
+        self.assertTrue(os.path.isfile(cache._disk_path('1')))
+        self.assertFalse(os.path.isfile(cache._disk_path('2')))
+        self.assertTrue(os.path.isfile(cache._disk_path('3')))
+        # No temporary files left behind
+        self.assertEqual(2, len(os.listdir(self.cache_dir)))
+
+    def test_concurrent_writers(self):
+        import threading
+        data = 'x' * 1000
+        errors = []
+
+        def write_and_read(thread_nr):
+            try:
+                for i in range(300):
+                    key = str(i % 7)
+                    cache.set_item(key, data, 10)
+                    if thread_nr % 2:
+                        # Read from disk
+                        cache.release(key)
+                        cache.get_item(key)
+            except Exception as err:
+                errors.append(err)
+
+        with patch('resources.lib.cache.DISK_CACHE_MAX_SIZE', new=2500):
+            threads = [threading.Thread(target=write_and_read, args=(nr,)) for nr in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertListEqual([], errors)
@@ -0,0 +1,201 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022. Dimitri Kroon
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+from test.support import fixtures
+fixtures.global_setup()
+
+import os
+import json
+import time
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+import requests
+
+from resources.lib import capture
+from resources.lib import fetch
+from resources.lib import itvx
+from resources.lib import cache
+from resources.lib import errors
+from resources.lib import utils
+
+from test.support.stand_in_server import StandInServer
+
+
+ROUTE_URL = 'plugin://plugin.video.itvhub/resources/lib/main/sub_menu_live/'
+
+
+class CaptureTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        patcher = patch.dict(capture.utils.addon_info, {'profile': self.tmp_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.purge()
+        fetch._latencies = {}
+        fetch._breakers.clear()
+
+    def tearDown(self):
+        capture._entries = None
+        capture.stop_replay()
+        cache.purge()
+        shutil.rmtree(self.tmp_dir)
+
+    def start_capture(self, enabled=True):
+        with patch.object(utils.addon_data, 'getSettingBool', create=True, return_value=enabled):
+            capture.start_capture(ROUTE_URL)
+
+    def record(self):
+        """Record the requests of live channels and a sign in at the stand-in server."""
+        self.start_capture()
+        with StandInServer() as server:
+            server.install()
+            channels = itvx.get_live_channels()
+            fetch.post_json('https://auth.prd.user.itv.com/auth', {'username': 'me', 'password': 'secret'},
+                            cookies={'Itv.Session': 'secret'})
+        return channels, capture.stop_capture()
+
+
+class Redaction(TestCase):
+    def test_redact_url(self):
+        url = capture.redact_url('https://auth.prd.user.itv.com/token?grant_type=refresh_token&refresh=abc')
+        self.assertEqual('https://auth.prd.user.itv.com/token?grant_type=refresh_token&refresh=%5Bredacted%5D', url)
+        self.assertEqual('https://www.itv.com/watch', capture.redact_url('https://www.itv.com/watch'))
+
+    def test_redact_signed_manifest_url(self):
+        # Akamai token in the query
+        url = capture.redact_url('https://itvpnpdotcom.cdn1.content.itv.com/10-1234-0001-001/18/1/VAR028/'
+                                 '10-1234-0001-001_18_1_VAR028.ism/.mpd?hdnea=exp=1669312345~acl=/*~hmac=0a1b2c&a=1')
+        self.assertEqual('https://itvpnpdotcom.cdn1.content.itv.com/10-1234-0001-001/18/1/VAR028/'
+                         '10-1234-0001-001_18_1_VAR028.ism/.mpd?hdnea=%5Bredacted%5D&a=1', url)
+        # Akamai token in the path
+        url = capture.redact_url('https://itvpnp.live.cdn.itv.com/hdntl=exp=1669312345~acl=%2f*~hmac=0a1b2c/'
+                                 'itv1/manifest.mpd')
+        self.assertEqual('https://itvpnp.live.cdn.itv.com/hdntl=[redacted]/itv1/manifest.mpd', url)
+        # Signed urls in json bodies, like those in a playlist
+        data = {'Playlist': {'Video': {'MediaFiles': [{'Href': 'https://cdn.itv.com/a.mpd?hdnts=st=1~hmac=ab'}]}}}
+        self.assertEqual('https://cdn.itv.com/a.mpd?hdnts=%5Bredacted%5D',
+                         capture.redact_json(data)['Playlist']['Video']['MediaFiles'][0]['Href'])
+        # Urls without tokens are left as they are
+        url = 'https://www.itv.com/watch?q=a%20b&page=2'
+        self.assertEqual(url, capture.redact_url(url))
+
+    def test_redact_headers(self):
+        headers = capture.redact_headers({'Accept': 'application/json', 'Cookie': 'Itv.Session=abc',
+                                          'Location': 'https://cdn.itv.com/a.mpd?hdnea=exp=1~hmac=ab'})
+        self.assertListEqual([{'name': 'Accept', 'value': 'application/json'},
+                              {'name': 'Cookie', 'value': capture.REDACTED},
+                              {'name': 'Location', 'value': 'https://cdn.itv.com/a.mpd?hdnea=%5Bredacted%5D'}],
+                             headers)
+
+    def test_redact_json(self):
+        data = {'user': {'token': 'abc', 'itvUserId': '123'}, 'items': [{'access_token': 'def', 'title': 'a'}]}
+        self.assertDictEqual({'user': {'token': capture.REDACTED, 'itvUserId': capture.REDACTED},
+                              'items': [{'access_token': capture.REDACTED, 'title': 'a'}]},
+                             capture.redact_json(data))
+
+
+class Record(CaptureTest):
+    def test_disabled(self):
+        self.start_capture(False)
+        self.assertFalse(capture.is_capturing())
+        self.assertIsNone(capture.stop_capture())
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, capture.CAPTURE_DIR)))
+
+    def test_record(self):
+        _, capture_file = self.record()
+        self.assertFalse(capture.is_capturing())
+        self.assertEqual(os.path.join(self.tmp_dir, capture.CAPTURE_DIR), os.path.dirname(capture_file))
+        self.assertTrue(capture_file.endswith('main.sub_menu_live.har'))
+        with open(capture_file) as f:
+            har = json.load(f)
+        entries = har['log']['entries']
+        self.assertEqual(3, len(entries))
+        for entry in entries:
+            self.assertEqual(200, entry['response']['status'])
+            self.assertGreater(entry['time'], 0)
+        auth_entry = entries[-1]
+        headers = {h['name']: h['value'] for h in auth_entry['request']['headers']}
+        self.assertEqual(capture.REDACTED, headers['Cookie'])
+        self.assertEqual('POST', auth_entry['request']['method'])
+        self.assertDictEqual({'username': capture.REDACTED, 'password': capture.REDACTED},
+                             json.loads(auth_entry['request']['postData']['text']))
+        tokens = json.loads(auth_entry['response']['content']['text'])
+        self.assertEqual(capture.REDACTED, tokens['access_token'])
+        self.assertEqual('bearer', tokens['token_type'])
+
+    def test_record_redirect_to_signed_url(self):
+        signed_url = 'https://cdn.itv.com/10-1234-0001-001.ism/.mpd?hdnea=exp=1669312345~acl=/*~hmac=0a1b2c'
+        req = requests.Request('GET', 'https://simulcast.itv.com/playlist/itvonline/ITV?hdnts=st=1~hmac=ab').prepare()
+        resp = requests.Response()
+        resp.status_code = 302
+        resp.reason = 'Found'
+        resp.headers['Location'] = signed_url
+        resp._content = b''
+        resp.request = req
+        resp.elapsed = timedelta(milliseconds=10)
+        self.start_capture()
+        capture.record(resp, time.time(), 0.01)
+        entry = capture._entries[0]
+        capture.stop_capture()
+        har_text = json.dumps(entry)
+        self.assertNotIn('hmac', har_text)
+        self.assertEqual('https://cdn.itv.com/10-1234-0001-001.ism/.mpd?hdnea=%5Bredacted%5D',
+                         entry['response']['redirectURL'])
+        self.assertEqual('https://simulcast.itv.com/playlist/itvonline/ITV?hdnts=%5Bredacted%5D',
+                         entry['request']['url'])
+
+    def test_streamed_response_can_be_read_after_capture(self):
+        self.start_capture()
+        with StandInServer() as server:
+            server.install()
+            data = itvx.get_page_data('https://www.itv.com/watch/categories/films', cache_time=3600)
+        capture.stop_capture()
+        self.assertGreater(len(data['programmes']), 100)
+
+    def test_old_captures_are_removed(self):
+        capture_dir = os.path.join(self.tmp_dir, capture.CAPTURE_DIR)
+        os.makedirs(capture_dir)
+        for i in range(capture.MAX_CAPTURE_FILES):
+            open(os.path.join(capture_dir, 'capture-2022010{}-000000-root.har'.format(i)), 'w').close()
+        self.start_capture()
+        capture_file = capture.stop_capture()
+        capture_files = os.listdir(capture_dir)
+        self.assertEqual(capture.MAX_CAPTURE_FILES, len(capture_files))
+        self.assertIn(os.path.basename(capture_file), capture_files)
+
+
+class Replay(CaptureTest):
+    def setUp(self):
+        super().setUp()
+        fixtures.setup_local_tests()
+
+    def tearDown(self):
+        fixtures.tear_down_local_tests()
+        super().tearDown()
+
+    def test_replay(self):
+        fixtures.tear_down_local_tests()
+        recorded_channels, capture_file = self.record()
+        fixtures.setup_local_tests()
+        # No requests can be made, all responses come from the capture.
+        capture.start_replay(capture_file)
+        self.assertTrue(capture.is_replaying())
+        self.assertListEqual(recorded_channels, itvx.get_live_channels())
+        # Repeated requests get the last recorded response
+        self.assertListEqual(recorded_channels, itvx.get_live_channels())
+
+    @patch.dict(fetch.HOST_POLICIES['*'], backoff=0)
+    def test_replay_unknown_request(self):
+        capture_file = os.path.join(self.tmp_dir, 'empty.har')
+        with open(capture_file, 'w') as f:
+            json.dump({'log': {'entries': []}}, f)
+        capture.start_replay(capture_file)
+        self.assertRaises(errors.FetchError, fetch.get_json, 'https://nownext.oasvc.itv.com/channels')
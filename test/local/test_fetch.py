@@ -12,21 +12,41 @@ fixtures.global_setup()
 from test.support.testutils import HttpResponse
 from test.support.object_checks import has_keys
 
+import os
+import json
+import pickle
+import tempfile
+import shutil
+import time
+import threading
+
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 
 import requests
+from requests.cookies import create_cookie
 
 from resources.lib import fetch
 from resources.lib import errors
 
 
-setUpModule = fixtures.setup_local_tests
-tearDownModule = fixtures.tear_down_local_tests
+# A new HttpSession may update the cookie consent in the background, which must not
+# interfere with the tests' mocked requests.
+consent_patch = patch('resources.lib.fetch.update_consent', return_value=False)
+
+
+def setUpModule():
+    fixtures.setup_local_tests()
+    consent_patch.start()
+
+
+def tearDownModule():
+    consent_patch.stop()
+    fixtures.tear_down_local_tests()
 
 URL = 'https://mydoc'
 STD_HEADERS = ['User-Agent', 'Referer', 'Origin', 'Sec-Fetch-Dest', 'Sec-Fetch-Mode',
-               'Sec-Fetch-Site', 'Cache-Control', 'Pragma']
+               'Sec-Fetch-Site']
 
 
 class HttpSession(TestCase):
@@ -42,12 +62,210 @@ class HttpSession(TestCase):
         del ss
         new_s = fetch.HttpSession()
         self.assertEqual(s_id, id(new_s))
-        # The session's __init__() creates a cookiejar, assert that it has happend only once.
+        # Setting up the session creates a cookiejar, assert that it has happend only once.
         p_create.assert_called_once()
         # Remove the created instance so subsequent (web) requests don't end up with a
         # session with a patched cookiejar.
         fetch.HttpSession.instance = None
 
+    def test_http_session_concurrent_creation(self):
+        fetch.HttpSession.instance = None
+        barrier = threading.Barrier(8)
+        sessions = []
+
+        def create_cookiejar():
+            # Give other threads the opportunity to get a half-built session.
+            time.sleep(0.05)
+            return fetch.PersistentCookieJar(os.path.join(tempfile.gettempdir(), 'cookies.json'))
+
+        def get_session():
+            barrier.wait()
+            session = fetch.HttpSession()
+            sessions.append((session, session.cookies, session.get_adapter('https://www.itv.com')))
+
+        with patch('resources.lib.fetch._create_cookiejar', side_effect=create_cookiejar) as p_create:
+            threads = [threading.Thread(target=get_session) for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            p_create.assert_called_once()
+        fetch.HttpSession.instance = None
+        self.assertEqual(8, len(sessions))
+        for session, cookies, adapter in sessions:
+            self.assertIs(sessions[0][0], session)
+            self.assertIsInstance(cookies, fetch.PersistentCookieJar)
+            self.assertIsInstance(adapter, fetch.KeepAliveAdapter)
+
+    @patch('resources.lib.fetch._create_cookiejar')
+    def test_http_session_uses_keep_alive_adapter(self, _):
+        fetch.HttpSession.instance = None
+        s = fetch.HttpSession()
+        self.assertIsInstance(s.get_adapter('https://www.itv.com'), fetch.KeepAliveAdapter)
+        self.assertIsInstance(s.get_adapter('http://www.itv.com'), fetch.KeepAliveAdapter)
+        fetch.HttpSession.instance = None
+
+
+class KeepAlive(TestCase):
+    @patch('requests.adapters.HTTPAdapter.send')
+    def test_idle_pool_is_closed(self, _):
+        adapter = fetch.KeepAliveAdapter(idle_timeout=10)
+        pool = adapter.poolmanager.connection_from_host('www.itv.com', 443, 'https')
+        adapter.poolmanager.connection_from_host('simulcast.itv.com', 443, 'https')
+        req = requests.Request('GET', 'https://www.itv.com/watch').prepare()
+        with patch('time.monotonic', return_value=100):
+            adapter.send(req)
+        self.assertEqual(2, len(adapter.poolmanager.pools))
+        # Not yet idle long enough
+        with patch('time.monotonic', return_value=105):
+            adapter.send(req)
+        self.assertEqual(2, len(adapter.poolmanager.pools))
+        with patch('time.monotonic', return_value=120):
+            adapter.send(req)
+        # Only the pool of the idle host has been removed
+        self.assertEqual(1, len(adapter.poolmanager.pools))
+        self.assertIsNone(pool.pool)
+
+    @patch('resources.lib.fetch._create_cookiejar')
+    @patch('requests.sessions.Session.request', return_value=HttpResponse(status_code=200))
+    def test_web_request_does_not_close_session(self, _, __):
+        fetch.HttpSession.instance = None
+        with patch('requests.sessions.Session.close') as p_close:
+            fetch.web_request('get', URL)
+            fetch.web_request('get', URL)
+            p_close.assert_not_called()
+        fetch.HttpSession.instance = None
+
+
+class CookieJar(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cookie_file = os.path.join(self.tmp_dir, fetch.COOKIE_FILE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_save_is_deferred(self):
+        cj = fetch.PersistentCookieJar(self.cookie_file)
+        cj.set_cookie(create_cookie('name1', 'value1', domain='.itv.com'))
+        cj.save()
+        self.assertTrue(os.path.isfile(self.cookie_file))
+        # Changes shortly after a save are written later.
+        cj.set_cookie(create_cookie('name2', 'value2', domain='.itv.com'))
+        with patch('resources.lib.fetch.COOKIE_SAVE_INTERVAL', 0.2):
+            cj.save()
+            cj.save()
+        with open(self.cookie_file) as f:
+            self.assertEqual(1, len(json.load(f)['cookies']))
+        time.sleep(0.3)
+        with open(self.cookie_file) as f:
+            self.assertEqual(2, len(json.load(f)['cookies']))
+
+    def test_flush_writes_pending_changes(self):
+        cj = fetch.PersistentCookieJar(self.cookie_file)
+        cj._last_saved = time.monotonic()
+        cj.set_cookie(create_cookie('name1', 'value1', domain='.itv.com'))
+        cj.save()
+        self.assertFalse(os.path.isfile(self.cookie_file))
+        cj.flush()
+        self.assertTrue(os.path.isfile(self.cookie_file))
+        self.assertIsNone(cj._save_timer)
+        # No temporary files are left behind
+        self.assertListEqual([fetch.COOKIE_FILE], os.listdir(self.tmp_dir))
+
+    def test_save_and_load(self):
+        cj = fetch.PersistentCookieJar(self.cookie_file)
+        cj.set_cookie(create_cookie('name1', 'value1', domain='.itv.com', expires=int(time.time() + 3600),
+                                    rest={'HttpOnly': None}))
+        cj.set_cookie(create_cookie('name2', 'value2', domain='www.itv.com', path='/watch', secure=True))
+        cj.flush()
+        new_cj = fetch.PersistentCookieJar(self.cookie_file)
+        new_cj.load()
+        self.assertEqual(2, len(new_cj))
+        self.assertFalse(new_cj._has_changed)
+        for name in ('name1', 'name2'):
+            cookie, new_cookie = cj._find_no_duplicates(name), new_cj._find_no_duplicates(name)
+            self.assertEqual(cookie, new_cookie)
+        c1 = next(c for c in new_cj if c.name == 'name1')
+        self.assertTrue(c1.has_nonstandard_attr('HttpOnly'))
+        c2 = next(c for c in new_cj if c.name == 'name2')
+        self.assertTrue(c2.secure)
+        self.assertEqual('/watch', c2.path)
+
+    def test_load_invalid_file(self):
+        with open(self.cookie_file, 'w') as f:
+            f.write('{"cookies": [{"nam')
+        self.assertRaises(ValueError, fetch.PersistentCookieJar(self.cookie_file).load)
+        with open(self.cookie_file, 'w') as f:
+            f.write('[]')
+        self.assertRaises(ValueError, fetch.PersistentCookieJar(self.cookie_file).load)
+
+    def test_create_cookiejar_converts_legacy_file(self):
+        legacy_file = os.path.join(self.tmp_dir, fetch.LEGACY_COOKIE_FILE)
+        legacy_cj = requests.cookies.RequestsCookieJar()
+        legacy_cj.set_cookie(create_cookie('name1', 'value1', domain='.itv.com'))
+        with open(legacy_file, 'wb') as f:
+            pickle.dump(legacy_cj, f)
+        with patch.dict(fetch.utils.addon_info, {'profile': self.tmp_dir}), \
+                patch('resources.lib.fetch.renew_consent') as p_renew:
+            cj = fetch._create_cookiejar()
+        p_renew.assert_called_once_with(cj)
+        self.assertIsInstance(cj, fetch.PersistentCookieJar)
+        self.assertEqual('value1', cj['name1'])
+        self.assertFalse(os.path.exists(legacy_file))
+        self.assertTrue(os.path.isfile(self.cookie_file))
+
+    @patch('resources.lib.fetch.renew_consent')
+    def test_create_cookiejar_restores_from_file(self, p_renew):
+        cj = fetch.PersistentCookieJar(self.cookie_file)
+        cj.set_cookie(create_cookie('name1', 'value1', domain='.itv.com',
+                                    expires=time.time() + fetch.CONSENT_MAX_AGE, rest={fetch.CONSENT_ATTR: None}))
+        cj.flush()
+        with patch.dict(fetch.utils.addon_info, {'profile': self.tmp_dir}):
+            new_cj = fetch._create_cookiejar()
+        self.assertEqual('value1', new_cj['name1'])
+        p_renew.assert_not_called()
+        # A corrupt file results in a new cookiejar with default cookies
+        with open(self.cookie_file, 'w') as f:
+            f.write('not json')
+        with patch.dict(fetch.utils.addon_info, {'profile': self.tmp_dir}):
+            new_cj = fetch._create_cookiejar()
+        self.assertEqual(3, len(new_cj))
+        p_renew.assert_called_once_with(new_cj)
+
+    @patch('resources.lib.fetch.renew_consent')
+    def test_create_cookiejar_renews_expiring_consent(self, p_renew):
+        cj = fetch.PersistentCookieJar(self.cookie_file)
+        cj.set_cookie(create_cookie('name1', 'value1', domain='.itv.com',
+                                    expires=time.time() + 86400, rest={fetch.CONSENT_ATTR: None}))
+        cj.flush()
+        with patch.dict(fetch.utils.addon_info, {'profile': self.tmp_dir}):
+            new_cj = fetch._create_cookiejar()
+        p_renew.assert_called_once_with(new_cj)
+
+    def test_new_cookiejar_does_not_wait_for_consent(self):
+        consent_evt = threading.Event()
+
+        def update_consent(jar):
+            consent_evt.wait(2)
+            jar.set('consent', 'rejected', domain='.itv.com', rest={fetch.CONSENT_ATTR: None})
+            return True
+
+        with patch.dict(fetch.utils.addon_info, {'profile': self.tmp_dir}), \
+                patch('resources.lib.fetch.update_consent', side_effect=update_consent):
+            cj = fetch._create_cookiejar()
+            # Default cookies are set immediately, consent cookies in the background.
+            has_keys(cj.get_dict(), 'Itv.Cid', 'Itv.Region', 'Itv.ParentalControls')
+            self.assertNotIn('consent', cj)
+            self.assertTrue(fetch.consent_needs_renewal(cj))
+            # Only one renewal at a time
+            self.assertIsNone(fetch.renew_consent(cj))
+            consent_evt.set()
+            fetch._consent_future.result(timeout=2)
+        self.assertEqual('rejected', cj['consent'])
+        self.assertFalse(fetch.consent_needs_renewal(cj))
+        cj.flush()
+        self.assertTrue(os.path.isfile(self.cookie_file))
 
 class WebRequest(TestCase):
     @patch('requests.sessions.Session.request', return_value=HttpResponse(status_code=200))
@@ -79,6 +297,31 @@ class WebRequest(TestCase):
         fetch.web_request('get', URL,  data=[1, 2, 3, 4])
         self.assertListEqual([1, 2, 3, 4], mocked_req.call_args[1]['json'])
 
+    @patch('requests.sessions.Session.request', return_value=HttpResponse(status_code=200))
+    def test_web_request_cache_policy(self, mocked_req):
+        # Without validators the request must bypass caches
+        fetch.web_request('get', URL)
+        req_headers = mocked_req.call_args[1]['headers']
+        self.assertEqual('no-cache', req_headers['Cache-Control'])
+        self.assertNotIn('If-None-Match', req_headers)
+        # With validators the request is conditional
+        fetch.web_request('get', URL, validators={'ETag': '"abc"', 'Last-Modified': 'Mon, 02 Jan 2023 10:00:00 GMT'})
+        req_headers = mocked_req.call_args[1]['headers']
+        self.assertEqual('"abc"', req_headers['If-None-Match'])
+        self.assertEqual('Mon, 02 Jan 2023 10:00:00 GMT', req_headers['If-Modified-Since'])
+        self.assertNotIn('Cache-Control', req_headers)
+        self.assertNotIn('validators', mocked_req.call_args[1])
+
+    @patch('requests.sessions.Session.request', return_value=HttpResponse(status_code=304))
+    def test_web_request_not_modified(self, _):
+        resp = fetch.web_request('get', URL, validators={'ETag': '"abc"'})
+        self.assertEqual(304, resp.status_code)
+
+    def test_get_validators(self):
+        resp = HttpResponse(status_code=200, headers={'ETag': '"abc"', 'Content-Type': 'text/html'})
+        self.assertDictEqual({'ETag': '"abc"'}, fetch.get_validators(resp))
+        self.assertIsNone(fetch.get_validators(HttpResponse(status_code=200)))
+
     @patch('requests.sessions.Session.request', return_value=HttpResponse(status_code=200))
     def test_web_request_extra_kwargs_are_passed_through(self, mocked_req):
         fetch.web_request('get', URL, proxies='some_value')
@@ -102,6 +345,436 @@ class WebRequest(TestCase):
         self.assertRaises(errors.FetchError, fetch.web_request, 'get', URL)
 
 
+class RetryPolicy(TestCase):
+    def setUp(self):
+        fetch._breakers.clear()
+        # Ensure the default timeouts are used.
+        fetch._latencies = {}
+        # Prevent a background request for cookie consent from interfering with the mocked requests.
+        fetch.HttpSession.instance = None
+        patcher = patch('resources.lib.fetch._create_cookiejar', return_value=MagicMock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        fetch._breakers.clear()
+        fetch.HttpSession.instance = None
+
+    @patch('time.sleep')
+    @patch('requests.sessions.Session.request',
+           side_effect=(requests.ConnectTimeout, HttpResponse(status_code=503), HttpResponse(status_code=200)))
+    def test_get_is_retried(self, p_req, p_sleep):
+        with patch.dict(fetch.HOST_POLICIES, {'mydoc': {'retries': 2}}):
+            resp = fetch.web_request('get', URL)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(3, p_req.call_count)
+        self.assertEqual(2, p_sleep.call_count)
+        # Backoff delays are limited by the policy and grow with each retry.
+        self.assertLessEqual(p_sleep.call_args_list[0].args[0], 0.5)
+        self.assertLessEqual(p_sleep.call_args_list[1].args[0], 1.0)
+
+    @patch('time.sleep')
+    @patch('requests.sessions.Session.request', side_effect=requests.ReadTimeout)
+    def test_retries_are_limited(self, p_req, p_sleep):
+        self.assertRaises(errors.FetchError, fetch.web_request, 'get', URL)
+        self.assertEqual(2, p_req.call_count)
+        p_req.reset_mock()
+        with patch('requests.sessions.Session.request', return_value=HttpResponse(status_code=504)) as p_req:
+            self.assertRaises(errors.HttpError, fetch.web_request, 'get', URL)
+            self.assertEqual(2, p_req.call_count)
+
+    @patch('time.sleep')
+    @patch('requests.sessions.Session.request', side_effect=requests.ConnectionError)
+    def test_post_is_not_retried(self, p_req, p_sleep):
+        self.assertRaises(errors.FetchError, fetch.web_request, 'post', URL, data={'a': 1})
+        p_req.assert_called_once()
+        p_sleep.assert_not_called()
+
+    @patch('time.sleep')
+    @patch('requests.sessions.Session.request', return_value=HttpResponse(status_code=404))
+    def test_client_errors_are_not_retried(self, p_req, _):
+        self.assertRaises(errors.HttpError, fetch.web_request, 'get', URL)
+        p_req.assert_called_once()
+
+    @patch('time.sleep')
+    @patch('requests.sessions.Session.request', side_effect=requests.ConnectTimeout)
+    def test_no_retry_beyond_deadline(self, p_req, _):
+        with patch.dict(fetch.HOST_POLICIES, {'mydoc': {'retries': 3, 'deadline': 5}}):
+            self.assertRaises(errors.FetchError, fetch.web_request, 'get', URL)
+            p_req.assert_called_once()
+            p_req.reset_mock()
+            # A short timeout fits within the deadline
+            self.assertRaises(errors.FetchError, fetch.web_request, 'get', URL, timeout=1)
+            self.assertEqual(4, p_req.call_count)
+
+    @patch('time.sleep')
+    @patch('requests.sessions.Session.request', side_effect=requests.ConnectTimeout)
+    def test_circuit_breaker(self, p_req, _):
+        policy = {'retries': 0, 'fail_threshold': 2, 'open_time': 30}
+        with patch.dict(fetch.HOST_POLICIES, {'mydoc': policy, 'otherhost': policy}):
+            self.assertRaises(errors.FetchError, fetch.web_request, 'get', URL)
+            self.assertRaises(errors.FetchError, fetch.web_request, 'get', URL)
+            self.assertEqual(2, p_req.call_count)
+            # Open circuit fails fast
+            self.assertRaises(errors.FetchError, fetch.web_request, 'get', URL)
+            self.assertEqual(2, p_req.call_count)
+            # Other hosts are not affected
+            self.assertRaises(errors.FetchError, fetch.web_request, 'get', 'https://otherhost')
+            self.assertEqual(3, p_req.call_count)
+            # After the open time a trial request is let through, which closes the circuit on success.
+            fetch._breakers['mydoc'].open_until = 0
+            p_req.side_effect = None
+            p_req.return_value = HttpResponse(status_code=200)
+            fetch.web_request('get', URL)
+            fetch.web_request('get', URL)
+            self.assertEqual(5, p_req.call_count)
+
+    @patch('time.sleep')
+    @patch('requests.sessions.Session.request', side_effect=requests.ConnectTimeout)
+    def test_failed_trial_request_ends_trial(self, p_req, _):
+        policy = {'retries': 0, 'fail_threshold': 1, 'open_time': 30}
+        with patch.dict(fetch.HOST_POLICIES, {'mydoc': policy}):
+            self.assertRaises(errors.FetchError, fetch.web_request, 'get', URL)
+            breaker = fetch._breakers['mydoc']
+            breaker.open_until = 0
+            # The trial request fails with an error that is not retried.
+            p_req.side_effect = requests.exceptions.ChunkedEncodingError
+            self.assertRaises(errors.FetchError, fetch.web_request, 'get', URL)
+            self.assertEqual(2, p_req.call_count)
+            self.assertFalse(breaker.allow_request())
+            # After the open time another trial request is let through.
+            breaker.open_until = 0
+            p_req.side_effect = None
+            p_req.return_value = HttpResponse(status_code=200)
+            fetch.web_request('get', URL)
+            self.assertEqual(3, p_req.call_count)
+            # Unexpected errors end a trial request as well.
+            breaker.record(False)
+            breaker.open_until = 0
+            p_req.side_effect = ValueError
+            self.assertRaises(ValueError, fetch.web_request, 'get', URL)
+            self.assertTrue(breaker.allow_request())
+
+    def test_breaker_allows_single_trial_request(self):
+        breaker = fetch.CircuitBreaker(1, 30)
+        breaker.record(False)
+        self.assertFalse(breaker.allow_request())
+        breaker.open_until = 0
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        breaker.record(False)
+        self.assertFalse(breaker.allow_request())
+
+
+class Hedging(TestCase):
+    def setUp(self):
+        fetch._latencies = {}
+        fetch._hedge_counts.clear()
+        fetch.HttpSession.instance = None
+        patcher = patch('resources.lib.fetch._create_cookiejar', return_value=MagicMock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        fetch._latencies = {}
+        fetch._hedge_counts.clear()
+        fetch.HttpSession.instance = None
+
+    def test_latency_percentile(self):
+        key = ('mydoc', 'json')
+        self.assertIsNone(fetch.get_latency_percentile(key, 90))
+        for i in range(1, 11):
+            fetch.record_latency(key, i / 10)
+        self.assertEqual(1.0, fetch.get_latency_percentile(key, 90))
+        self.assertEqual(0.6, fetch.get_latency_percentile(key, 50))
+        self.assertIsNone(fetch.get_latency_percentile(key, 90, min_samples=11))
+        self.assertIsNone(fetch.get_latency_percentile(('mydoc', 'document'), 90))
+
+    @patch('requests.sessions.Session.request', return_value=HttpResponse(status_code=200))
+    def test_latency_is_recorded(self, _):
+        fetch.web_request('get', URL)
+        self.assertEqual(1, len(fetch._latencies[('mydoc', 'document')]))
+
+    @patch('requests.sessions.Session.request', return_value=HttpResponse(status_code=200))
+    def test_no_hedge_without_latency_data(self, p_req):
+        resp = fetch.web_request('post', URL, data={'a': 1}, hedge=True)
+        self.assertEqual(200, resp.status_code)
+        p_req.assert_called_once()
+        self.assertNotIn('hedge', p_req.call_args.kwargs)
+
+    def test_slow_request_is_hedged(self):
+        for _ in range(10):
+            fetch.record_latency(('mydoc', 'other'), 0.05)
+        calls = []
+
+        def request(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return HttpResponse(status_code=200, reason='slow')
+            return HttpResponse(status_code=200, reason='fast')
+
+        with patch('requests.sessions.Session.request', side_effect=request):
+            start = time.monotonic()
+            resp = fetch.web_request('post', URL, data={'a': 1}, hedge=True)
+            self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual('fast', resp.reason)
+        self.assertEqual(2, len(calls))
+
+    def test_hedged_request_failure(self):
+        for _ in range(10):
+            fetch.record_latency(('mydoc', 'other'), 0.01)
+
+        def request(*args, **kwargs):
+            time.sleep(0.05)
+            return HttpResponse(status_code=404)
+
+        with patch('requests.sessions.Session.request', side_effect=request) as p_req:
+            self.assertRaises(errors.HttpError, fetch.web_request, 'post', URL, data={'a': 1}, hedge=True)
+            self.assertEqual(2, p_req.call_count)
+
+    def test_extra_requests_are_limited(self):
+        for _ in range(20):
+            fetch._count_hedged('mydoc')
+        allowed = [fetch._acquire_hedge('mydoc') for _ in range(20)]
+        self.assertListEqual([True, True, True, True, False], allowed[:5])
+        # 10% of hedged requests, plus the burst
+        self.assertEqual(4, allowed.count(True))
+        self.assertEqual((20, 4), fetch._hedge_counts['mydoc'])
+
+    @patch('requests.sessions.Session.request', return_value=HttpResponse(status_code=200))
+    def test_all_hedged_requests_count_towards_the_budget(self, p_req):
+        """Requests that are fast enough to need no extra request count as hedged requests
+        too, while only requests actually sent count as extra."""
+        for _ in range(10):
+            fetch.record_latency(('mydoc', 'other'), 0.5)
+        for _ in range(20):
+            fetch.web_request('post', URL, data={'a': 1}, hedge=True)
+        self.assertEqual(20, p_req.call_count)
+        self.assertEqual((20, 0), fetch._hedge_counts['mydoc'])
+        # Slow requests without fast ones only get the burst.
+        allowed = [fetch._acquire_hedge('otherdoc') for _ in range(10)]
+        self.assertEqual(fetch.HEDGE_BURST, allowed.count(True))
+
+
+class AdaptiveTimeout(TestCase):
+    def setUp(self):
+        fetch._latencies = {}
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        fetch._latencies = {}
+        shutil.rmtree(self.tmp_dir)
+
+    def test_endpoint_class(self):
+        self.assertEqual('json', fetch.get_endpoint_class('GET', {'Accept': 'application/json'}))
+        self.assertEqual('json', fetch.get_endpoint_class('POST', {'Accept': 'application/vnd.itv.vod.playlist.v2+json'}))
+        self.assertEqual('document', fetch.get_endpoint_class('GET'))
+        self.assertEqual('document', fetch.get_endpoint_class('GET', {'Accept': 'text/html'}))
+        self.assertEqual('other', fetch.get_endpoint_class('PUT'))
+
+    def test_default_timeout_without_data(self):
+        self.assertEqual(fetch.WEB_TIMEOUT, fetch.get_timeout('mydoc', 'json'))
+        for _ in range(fetch.TIMEOUT_MIN_SAMPLES - 1):
+            fetch.record_latency(('mydoc', 'json'), 0.1)
+        self.assertEqual(fetch.WEB_TIMEOUT, fetch.get_timeout('mydoc', 'json'))
+
+    def test_timeouts_follow_latency(self):
+        for _ in range(20):
+            fetch.record_latency(('mydoc', 'json'), 0.1)
+            fetch.record_latency(('mydoc', 'document'), 2.0)
+        # Fast endpoints get the minimum timeouts
+        self.assertEqual((fetch.CONNECT_TIMEOUT_BOUNDS[0], fetch.READ_TIMEOUT_BOUNDS[0]),
+                         fetch.get_timeout('mydoc', 'json'))
+        # Slow endpoints get a longer read timeout
+        connect_timeout, read_timeout = fetch.get_timeout('mydoc', 'document')
+        self.assertAlmostEqual(6.0, read_timeout)
+        self.assertEqual(fetch.CONNECT_TIMEOUT_BOUNDS[0], connect_timeout)
+        # But never longer than the upper bound
+        for _ in range(20):
+            fetch.record_latency(('mydoc', 'document'), 30.0)
+        self.assertEqual(fetch.READ_TIMEOUT_BOUNDS[1], fetch.get_timeout('mydoc', 'document')[1])
+
+    @patch('resources.lib.fetch._send_request', return_value=HttpResponse(status_code=200))
+    def test_web_request_uses_adaptive_timeout(self, p_send):
+        with patch('resources.lib.fetch.get_timeout', return_value=(2, 4)) as p_timeout:
+            fetch.web_request('get', URL, headers={'Accept': 'application/json'})
+            p_timeout.assert_called_once_with('mydoc', 'json')
+            self.assertEqual((2, 4), p_send.call_args.kwargs['timeout'])
+            self.assertEqual(('mydoc', 'json'), p_send.call_args.args[2])
+            # An explicit timeout takes precedence
+            fetch.web_request('get', URL, timeout=12)
+            self.assertEqual(12, p_send.call_args.kwargs['timeout'])
+            p_timeout.assert_called_once()
+
+    @patch('time.sleep')
+    @patch('requests.sessions.Session.request', side_effect=requests.ReadTimeout)
+    def test_read_timeouts_are_recorded(self, _, __):
+        fetch.HttpSession.instance = None
+        with patch('resources.lib.fetch._create_cookiejar', return_value=MagicMock()):
+            self.assertRaises(errors.FetchError, fetch.web_request, 'get', 'https://slowhost')
+        fetch.HttpSession.instance = None
+        fetch._breakers.clear()
+        self.assertEqual(2, len(fetch._latencies[('slowhost', 'document')]))
+
+    def test_save_and_load_latencies(self):
+        fetch._latencies = None
+        with patch.dict(fetch.utils.addon_info, {'profile': self.tmp_dir}):
+            fetch.record_latency(('mydoc', 'json'), 0.1234)
+            fetch.record_latency(('mydoc', 'json'), 0.2)
+            fetch.save_latencies()
+            self.assertListEqual([fetch.LATENCY_FILE], os.listdir(self.tmp_dir))
+            fetch._latencies = None
+            self.assertEqual(0.123, fetch.get_latency_percentile(('mydoc', 'json'), 0))
+            self.assertEqual(2, len(fetch._latencies[('mydoc', 'json')]))
+            # A corrupt file is ignored
+            with open(os.path.join(self.tmp_dir, fetch.LATENCY_FILE), 'w') as f:
+                f.write('[["mydoc", ')
+            fetch._latencies = None
+            self.assertIsNone(fetch.get_latency_percentile(('mydoc', 'json'), 50))
+
+
+class CloseStream(TestCase):
+    def test_close_stream(self):
+        resp = HttpResponse(status_code=200)
+        resp.raw = MagicMock()
+        fetch.close_stream(resp)
+        resp.raw.read.assert_called_once_with(fetch.MAX_DRAIN_SIZE, decode_content=True)
+        resp.raw.close.assert_called_once()
+
+    def test_close_stream_without_raw_data(self):
+        fetch.close_stream(HttpResponse(status_code=304))
+
+
+class SingleFlight(TestCase):
+    def run_concurrent(self, func, key='key'):
+        """Call single_flight(key, func) on 2 threads while the first call is in progress."""
+        import threading
+        evt = threading.Event()
+        results = []
+
+        def call():
+            try:
+                results.append(fetch.single_flight(key, func, evt))
+            except Exception as e:
+                results.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        while key not in fetch._in_flight:
+            pass
+        follower = threading.Thread(target=call)
+        follower.start()
+        # Give the follower some time to start waiting
+        follower.join(0.1)
+        evt.set()
+        leader.join(2)
+        follower.join(2)
+        return results
+
+    def test_concurrent_calls_share_result(self):
+        func = MagicMock(side_effect=lambda evt: evt.wait(2) and {'a': 1})
+        results = self.run_concurrent(func)
+        func.assert_called_once()
+        self.assertEqual(2, len(results))
+        self.assertIs(results[0], results[1])
+        self.assertNotIn('key', fetch._in_flight)
+
+    def test_concurrent_calls_share_exception(self):
+        def fail(evt):
+            evt.wait(2)
+            raise errors.FetchError('failed')
+        func = MagicMock(side_effect=fail)
+        results = self.run_concurrent(func)
+        func.assert_called_once()
+        self.assertIsInstance(results[0], errors.FetchError)
+        self.assertIs(results[0], results[1])
+
+    def test_consecutive_calls_are_not_shared(self):
+        func = MagicMock(return_value=1)
+        fetch.single_flight('key', func)
+        fetch.single_flight('key', func)
+        self.assertEqual(2, func.call_count)
+
+    @patch('resources.lib.fetch.single_flight')
+    @patch('resources.lib.fetch._web_request')
+    def test_web_request_coalesces_get_requests(self, p_req, p_single):
+        fetch.web_request('GET', URL)
+        p_single.assert_called_once()
+        p_req.assert_not_called()
+        p_single.reset_mock()
+        # other methods, or streamed requests are not coalesced
+        fetch.web_request('POST', URL, data={'a': 1})
+        fetch.web_request('GET', URL, stream=True)
+        p_single.assert_not_called()
+        self.assertEqual(2, p_req.call_count)
+
+
+class GetMany(TestCase):
+    def test_get_many(self):
+        from functools import partial
+        results = fetch.get_many((partial(pow, 2, 3), lambda: 'abc', partial(sorted, [3, 1, 2])))
+        self.assertListEqual([8, 'abc', [1, 2, 3]], results)
+
+    def test_get_many_isolates_errors(self):
+        def fail():
+            raise errors.FetchError('failed')
+        results = fetch.get_many((lambda: 1, fail, lambda: 3))
+        self.assertEqual(1, results[0])
+        self.assertIsInstance(results[1], errors.FetchError)
+        self.assertEqual(3, results[2])
+
+    def test_get_many_timeout(self):
+        import threading
+        evt = threading.Event()
+        results = fetch.get_many((lambda: 1, lambda: evt.wait(2)), timeout=0.1)
+        evt.set()
+        self.assertEqual(1, results[0])
+        self.assertIsInstance(results[1], errors.FetchError)
+
+    @patch("resources.lib.fetch.web_request", return_value=HttpResponse(content=b'{"a": 1}'))
+    def test_get_many_requests(self, mocked_req):
+        from functools import partial
+        results = fetch.get_many(partial(fetch.get_json, URL + str(i)) for i in range(6))
+        self.assertListEqual([{'a': 1}] * 6, results)
+        self.assertEqual(6, mocked_req.call_count)
+
+    def test_submit(self):
+        future = fetch.submit(pow, 2, exp=3)
+        self.assertEqual(8, future.result(1))
+
+    def test_submit_concurrent_pool_creation(self):
+        """Calls submitted concurrently before the thread pool exists create only one pool."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        num_threads = 8
+        barrier = threading.Barrier(num_threads)
+        pools = []
+
+        def create_pool(*args, **kwargs):
+            time.sleep(0.05)
+            pool = ThreadPoolExecutor(*args, **kwargs)
+            pools.append(pool)
+            return pool
+
+        def submit():
+            barrier.wait()
+            results.append(fetch.submit(pow, 2, 3).result(1))
+
+        results = []
+        with patch.object(fetch, '_executor', None), \
+                patch('resources.lib.fetch.futures.ThreadPoolExecutor', side_effect=create_pool):
+            threads = [threading.Thread(target=submit) for _ in range(num_threads)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join(5)
+        for pool in pools:
+            pool.shutdown()
+        self.assertEqual(1, len(pools))
+        self.assertListEqual([8] * num_threads, results)
+
+
 class PostJson(TestCase):
     @patch("resources.lib.fetch.web_request", return_value=HttpResponse(content=b'{"a": 1}'))
     def test_post_json_plain_with_response(self, mocked_req):
@@ -141,6 +814,12 @@ class GetJson(TestCase):
         mocked_req.assert_called_once_with('GET', URL, {'Accept': 'application/json'})
         self.assertIsNone(resp)
 
+    @patch("resources.lib.fetch.web_request", return_value=HttpResponse(status_code=304))
+    def test_get_json_not_modified(self, mocked_req):
+        resp = fetch.get_json(URL, validators={'ETag': '"abc"'})
+        self.assertDictEqual({'ETag': '"abc"'}, mocked_req.call_args[1]['validators'])
+        self.assertIsNone(resp)
+
     @patch("resources.lib.fetch.web_request", return_value=HttpResponse(content=b'{"a": 1}'))
     # noinspection PyMethodMayBeStatic
     def test_get_json_adds_extra_headers(self, mocked_req):
@@ -199,6 +878,32 @@ class GetDocument(TestCase):
         self.assertEqual('', resp)
 
 
+class GetNextData(TestCase):
+    def test_get_next_data(self):
+        page = b'<html><script id="__NEXT_DATA__" type="application/json">{"a": 1}</script></html>'
+        resp = HttpResponse(content=page)
+        with patch("resources.lib.fetch.web_request", return_value=resp) as p_req, \
+                patch("resources.lib.fetch.close_stream") as p_close:
+            result = fetch.get_next_data(URL, {'MyHeader': 'myval'})
+        self.assertIs(resp, result[0])
+        self.assertEqual('{"a": 1}', result[1])
+        p_req.assert_called_once_with('GET', URL, {'MyHeader': 'myval'}, stream=True)
+        p_close.assert_called_once_with(resp)
+
+    def test_get_next_data_not_modified(self):
+        resp = HttpResponse(status_code=304)
+        with patch("resources.lib.fetch.web_request", return_value=resp) as p_req, \
+                patch("resources.lib.fetch.close_stream") as p_close:
+            result = fetch.get_next_data(URL, validators={'ETag': '"abc"'})
+        self.assertEqual((resp, None), result)
+        self.assertDictEqual({'ETag': '"abc"'}, p_req.call_args[1]['validators'])
+        p_close.assert_called_once_with(resp)
+
+    @patch("resources.lib.fetch.web_request", return_value=HttpResponse(content=b'<html></html>'))
+    def test_get_next_data_without_data(self, _):
+        self.assertIsNone(fetch.get_next_data(URL)[1])
+
+
 class AccountMock:
     access_token = '123abc'
 
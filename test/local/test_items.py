@@ -0,0 +1,107 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022. Dimitri Kroon
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+from test.support import fixtures
+fixtures.global_setup()
+
+import pickle
+from unittest import TestCase
+
+from resources.lib import items
+from resources.lib import parsex
+from resources.lib import cache
+
+from test.support.testutils import open_json
+from test.support.object_checks import is_li_compatible_dict
+
+
+setUpModule = fixtures.setup_local_tests
+tearDownModule = fixtures.tear_down_local_tests
+
+IMG_TEMPLATE = open_json('html/category_films.json')['programmes'][0]['imageTemplate']
+
+
+class Programme(TestCase):
+    def test_to_dict(self):
+        item = items.Programme(True, 'My Film', 'https://www.itv.com/watch/my-film/10a1234', IMG_TEMPLATE,
+                               art_types=items.ART_FILM, title='My Film', plot='A film', sort_title='my film',
+                               duration=5400)
+        item_dict = item.to_dict()
+        is_li_compatible_dict(self, item_dict)
+        self.assertDictEqual({'thumb': parsex.image_url(IMG_TEMPLATE, 'thumb'),
+                              'fanart': parsex.image_url(IMG_TEMPLATE, 'fanart'),
+                              'poster': parsex.image_url(IMG_TEMPLATE, 'poster')},
+                             item_dict['art'])
+        self.assertDictEqual({'title': 'My Film', 'plot': 'A film', 'sorttitle': 'my film', 'duration': 5400},
+                             item_dict['info'])
+        self.assertDictEqual({'url': 'https://www.itv.com/watch/my-film/10a1234'}, item_dict['params'])
+
+    def test_default_art(self):
+        item = items.Programme(True, 'News', 'https://www.itv.com/watch/news/a', IMG_TEMPLATE, plot='news')
+        item_dict = item.to_dict()
+        is_li_compatible_dict(self, item_dict)
+        self.assertListEqual(['thumb'], list(item_dict['art']))
+
+    def test_compare_and_pickle(self):
+        item = items.Programme(False, 'My Show', 'https://www.itv.com/watch/my-show/10a1234', IMG_TEMPLATE)
+        same = items.Programme(False, 'My Show', 'https://www.itv.com/watch/my-show/10a1234', IMG_TEMPLATE)
+        self.assertEqual(item, same)
+        same.plot = 'other'
+        self.assertNotEqual(item, same)
+        self.assertEqual(item, pickle.loads(pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)))
+        self.assertIn("label='My Show'", repr(item))
+        self.assertRaises(AttributeError, setattr, item, 'unknown', 1)
+
+
+class Episode(TestCase):
+    def test_to_dict(self):
+        episode = items.Episode('Episode 1', 'https://magni.itv.com/playlist/itvonline/ITV/1_2345_0001.001',
+                                IMG_TEMPLATE, 'https://www.itv.com/fanart.jpg', title='1. Episode 1',
+                                date='2022-11-24T20:00:00Z', episode=1, season=None)
+        item_dict = episode.to_dict()
+        is_li_compatible_dict(self, item_dict)
+        self.assertEqual('https://www.itv.com/fanart.jpg', item_dict['art']['fanart'])
+        self.assertEqual('2022-11-24T20:00:00Z', item_dict['info']['date'])
+        self.assertEqual(1, item_dict['info']['episode'])
+        self.assertIsNone(item_dict['info']['season'])
+        self.assertEqual('Episode 1', item_dict['params']['name'])
+
+
+class Series(TestCase):
+    def test_to_dict(self):
+        series = items.Series('Series 4', 'https://www.itv.com/watch/midsomer-murders/Ya1096', 4, IMG_TEMPLATE,
+                              title='[B]Midsomer Murders - Series 4[/B]', plot='Murders')
+        self.assertIsNone(series.episodes)
+        item_dict = series.to_dict()
+        is_li_compatible_dict(self, item_dict)
+        self.assertDictEqual({'url': 'https://www.itv.com/watch/midsomer-murders/Ya1096', 'series_idx': 4},
+                             item_dict['params'])
+
+
+class LiveChannel(TestCase):
+    def test_to_dict(self):
+        programmes = [items.LiveProgramme('Emmerdale', '19:30', orig_start='2022-11-24T19:30:00'),
+                      items.LiveProgramme('Coronation Street', '20:00', details='Coronation Street: Ep 1')]
+        channel = items.LiveChannel('ITV1', 'https://simulcast.itv.com/playlist/itvonline/ITV',
+                                    'https://www.itv.com/logo.png', 'https://www.itv.com/backdrop.jpg', programmes)
+        self.assertIs(programmes[0], channel.now_on)
+        item_dict = channel.to_dict()
+        self.assertEqual('ITV1    [COLOR orange]Emmerdale[/COLOR]', item_dict['label'])
+        self.assertEqual('19:30 - Emmerdale\n20:00 - Coronation Street: Ep 1', item_dict['info']['plot'])
+        self.assertDictEqual({'channel': 'ITV1', 'url': 'https://simulcast.itv.com/playlist/itvonline/ITV',
+                              'title': 'Emmerdale', 'start_time': '2022-11-24T19:30:00'},
+                             item_dict['params'])
+
+
+class Size(TestCase):
+    def test_items_are_smaller_than_dicts(self):
+        shows = open_json('html/collection_just-in_data.json')['collection']['shows']
+        programmes = [parsex.parse_collection_item(show) for show in shows]
+        as_dicts = [{'playable': prog.playable, 'show': prog.to_dict()} for prog in programmes]
+        items_size = cache.estimate_size(programmes)
+        self.assertGreater(items_size, sum(len(prog.plot) for prog in programmes))
+        self.assertLess(items_size, cache.estimate_size(as_dicts) / 2)
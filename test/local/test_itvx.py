@@ -13,50 +13,131 @@ from unittest import TestCase
 from unittest.mock import MagicMock, patch
 import types
 
-from test.support.testutils import open_json, open_doc
+from test.support.testutils import open_json, open_doc, HttpResponse
 from test.support.object_checks import has_keys
 
 from resources.lib import itvx
+from resources.lib import cache
+from resources.lib import errors
+from resources.lib import parsex
+from resources.lib.items import Programme, Series, Episode, LiveChannel
 
 setUpModule = fixtures.setup_local_tests
 tearDownModule = fixtures.tear_down_local_tests
 
 
+class GetPageData(TestCase):
+    def setUp(self):
+        cache.purge()
+
+    @patch('resources.lib.fetch.web_request', return_value=HttpResponse(text=open_doc('html/index.html')()))
+    def test_get_page_data_without_cache(self, p_req):
+        data = itvx.get_page_data('https://www.itv.com')
+        self.assertIs(True, p_req.call_args[1]['stream'])
+        has_keys(data, 'heroContent', 'editorialSliders')
+        self.assertIsNone(cache.get_item('https://www.itv.com'))
+
+    def test_get_page_data_revalidates_expired_data(self):
+        page = open_doc('html/index.html')()
+        with patch('resources.lib.fetch.web_request',
+                   return_value=HttpResponse(text=page, headers={'ETag': '"abc"'})) as p_req:
+            data = itvx.get_page_data('https://www.itv.com', cache_time=3600)
+            self.assertIsNone(p_req.call_args[1]['validators'])
+        self.assertIs(data, cache.get_item('https://www.itv.com'))
+
+        # Expire the cached item
+        cache.set_item('https://www.itv.com', data, -10, {'ETag': '"abc"'})
+        with patch('resources.lib.fetch.web_request', return_value=HttpResponse(status_code=304)) as p_req, \
+                patch('resources.lib.parsex.parse_next_data') as p_parse:
+            new_data = itvx.get_page_data('https://www.itv.com', cache_time=3600, max_stale=0)
+            self.assertDictEqual({'ETag': '"abc"'}, p_req.call_args[1]['validators'])
+            p_parse.assert_not_called()
+        self.assertIs(data, new_data)
+        self.assertIs(data, cache.get_item('https://www.itv.com'))
+
+    def test_get_page_data_returns_stale_data(self):
+        cache.set_item('https://www.itv.com', {'a': 1}, -10)
+        with patch('resources.lib.itvx.refresh_page_data') as p_refresh:
+            data = itvx.get_page_data('https://www.itv.com', cache_time=3600, max_stale=60)
+            self.assertDictEqual({'a': 1}, data)
+            p_refresh.assert_called_once_with('https://www.itv.com', 3600, None)
+        # Data that has been expired for longer than max_stale is not used
+        with patch('resources.lib.itvx.refresh_page_data') as p_refresh, \
+                patch('resources.lib.itvx._load_page_data', return_value={'b': 2}) as p_load:
+            data = itvx.get_page_data('https://www.itv.com', cache_time=3600, max_stale=5)
+            self.assertDictEqual({'b': 2}, data)
+            p_refresh.assert_not_called()
+            p_load.assert_called_once()
+
+    def test_get_page_data_serves_stale_data_on_errors(self):
+        cache.set_item('https://www.itv.com', {'a': 1}, -7200)
+        for error in (errors.FetchError('timeout'), errors.HttpError(503, 'Service unavailable')):
+            with patch('resources.lib.itvx._load_page_data', side_effect=error):
+                data = itvx.get_page_data('https://www.itv.com', cache_time=3600, max_stale=60)
+                self.assertDictEqual({'a': 1}, data)
+        # Client errors are not hidden
+        with patch('resources.lib.itvx._load_page_data', side_effect=errors.HttpError(404, 'Not found')):
+            self.assertRaises(errors.HttpError, itvx.get_page_data, 'https://www.itv.com', cache_time=3600, max_stale=60)
+        cache.purge()
+        with patch('resources.lib.itvx._load_page_data', side_effect=errors.FetchError('timeout')):
+            self.assertRaises(errors.FetchError, itvx.get_page_data, 'https://www.itv.com', cache_time=3600)
+
+    def test_refresh_page_data_once_at_a_time(self):
+        import threading
+        evt = threading.Event()
+        done = threading.Event()
+
+        def load_page(*_):
+            evt.wait(2)
+            done.set()
+
+        with patch('resources.lib.itvx._load_page_data', side_effect=load_page) as p_load:
+            itvx.refresh_page_data('https://www.itv.com', 3600)
+            itvx.refresh_page_data('https://www.itv.com', 3600)
+            evt.set()
+            done.wait(2)
+            p_load.assert_called_once_with('https://www.itv.com', 3600, None)
+
+
 class MainPageItem(TestCase):
-    @patch('resources.lib.fetch.get_document', new=open_doc('html/index.html'))
     def test_list_main_page_items(self):
-        items = list(itvx.main_page_items())
-        pass
+        cache.purge()
+        with patch('resources.lib.fetch.web_request', return_value=HttpResponse(text=open_doc('html/index.html')())):
+            items = list(itvx.main_page_items())
+        self.assertGreater(len(items), 2)
 
 
 class Collections(TestCase):
+    def setUp(self):
+        cache.purge()
+
     @patch('resources.lib.itvx.get_page_data', return_value=open_json('html/index-data.json'))
     def test_collection_news(self, _):
         items = list(itvx.collection_content(slider='newsShortformSliderContent'))
         self.assertGreater(len(items), 10)
         for item in items:
-            has_keys(item, 'playable', 'show')
+            self.assertIsInstance(item, Programme)
 
     @patch('resources.lib.itvx.get_page_data', return_value=open_json('html/index-data.json'))
     def test_collection_trending(self, _):
         items = list(itvx.collection_content(slider='trendingSliderContent'))
         self.assertGreater(len(items), 10)
         for item in items:
-            has_keys(item, 'playable', 'show')
+            self.assertIsInstance(item, Programme)
 
     @patch('resources.lib.itvx.get_page_data', return_value=open_json('html/index-data.json'))
     def test_collection_from_main_page(self, _):
         items = list(itvx.collection_content(slider='editorialRailSlot1'))
         self.assertGreater(len(items), 10)
         for item in items:
-            has_keys(item, 'playable', 'show')
+            self.assertIsInstance(item, Programme)
 
     @patch('resources.lib.itvx.get_page_data', return_value=open_json('html/collection_just-in_data.json'))
     def test_collection_from_collection_page(self, _):
         items = list(itvx.collection_content(url='collection_top_picks'))
         self.assertGreater(len(items), 10)
         for item in items:
-            has_keys(item, 'playable', 'show')
+            self.assertIsInstance(item, Programme)
 
     @patch('resources.lib.itvx.get_page_data', side_effect=(open_json('html/collection_the-costume-collection.json'),
                                                             open_json('html/collection_the-costume-collection.json')))
@@ -70,6 +151,9 @@ class Collections(TestCase):
 
 
 class Categories(TestCase):
+    def setUp(self):
+        cache.purge()
+
     @patch('resources.lib.itvx.get_page_data', return_value=open_json('html/categories_data.json'))
     def test_get_categories(self, _):
         cat_list = list(itvx.categories())
@@ -84,8 +168,8 @@ class Categories(TestCase):
             self.assertGreater(len(program_list), 10)
             playables = 0
             for progr in program_list:
-                has_keys(progr['show'], 'label', 'info', 'art', 'params')
-                if progr['playable']:
+                has_keys(progr.to_dict(), 'label', 'info', 'art', 'params')
+                if progr.playable:
                     playables +=1
             self.assertGreater(playables, 0)
             self.assertLess(playables, len(program_list) / 2)
@@ -96,18 +180,156 @@ class Categories(TestCase):
         program_list = list(itvx.category_content('asdgf'))
         self.assertGreater(len(program_list), 10)
         for progr in program_list:
-            has_keys(progr['show'], 'label', 'info', 'art', 'params')
-            self.assertTrue(progr['playable'])
+            has_keys(progr.to_dict(), 'label', 'info', 'art', 'params')
+            self.assertIn('poster', progr.to_dict()['art'])
+            self.assertTrue(progr.playable)
         free_list = list(itvx.category_content('asdgf', hide_paid=True))
         self.assertLess(len(free_list), len(program_list))
 
 
+class GetListing(TestCase):
+    def setUp(self):
+        cache.purge()
+
+    def tearDown(self):
+        cache.purge()
+
+    @patch('resources.lib.fetch.web_request', return_value=HttpResponse(text=open_doc('html/index.html')()))
+    def test_listing_is_reused(self, p_req):
+        items = itvx.collection_content(slider='editorialRailSlot1')
+        self.assertGreater(len(items), 10)
+        # The page has been released from memory, but not from the disk cache
+        self.assertNotIn('https://www.itv.com', cache.__cache__)
+        self.assertGreater(cache.expires_in('https://www.itv.com'), 3000)
+        with patch('resources.lib.parsex.parse_collection_item') as p_parse:
+            self.assertListEqual(items, itvx.collection_content(slider='editorialRailSlot1'))
+            p_parse.assert_not_called()
+        p_req.assert_called_once()
+        # Other listings of the same page use the cached page data
+        self.assertGreater(len(itvx.collection_content(slider='trendingSliderContent')), 10)
+        p_req.assert_called_once()
+
+    def test_listing_depends_on_hide_paid(self):
+        url = '/watch/collections/the-costume-collection'
+        cache.set_item('https://www.itv.com/watch/collections/the-costume-collection#collection.shows',
+                       open_json('html/collection_the-costume-collection.json'), 3600)
+        self.assertEqual(19, len(itvx.collection_content(url=url)))
+        with patch('resources.lib.itvx.get_page_data') as p_get:
+            self.assertEqual(19, len(itvx.collection_content(url=url)))
+            p_get.assert_not_called()
+        self.assertEqual(16, len(itvx.collection_content(url=url, hide_paid=True)))
+        self.assertEqual(19, len(itvx.collection_content(url=url)))
+
+    def test_listing_expires_with_page(self):
+        parse = MagicMock(side_effect=lambda data: [data['a']])
+        cache.set_item('https://www.itv.com/page', {'a': 1}, 100)
+        self.assertListEqual([1], itvx.get_listing('test', '/page', 3600, None, (), parse))
+        self.assertListEqual([1], itvx.get_listing('test', '/page', 3600, None, (), parse))
+        parse.assert_called_once()
+        listing_key = next(key for key in cache.__cache__ if key.startswith('listing#'))
+        self.assertIn('https://www.itv.com/page', listing_key)
+        self.assertAlmostEqual(cache.expires_in('https://www.itv.com/page'), cache.expires_in(listing_key), delta=1)
+        # A refreshed page is parsed again
+        cache.set_item(listing_key, [1], -1)
+        cache.set_item('https://www.itv.com/page', {'a': 2}, 100)
+        self.assertListEqual([2], itvx.get_listing('test', '/page', 3600, None, (), parse))
+
+    def test_listing_of_stale_page_is_not_cached(self):
+        parse = MagicMock(side_effect=lambda data: [data['a']])
+        cache.set_item('https://www.itv.com/page', {'a': 1}, -10)
+        with patch('resources.lib.itvx.refresh_page_data'):
+            self.assertListEqual([1], itvx.get_listing('test', '/page', 3600, None, (), parse))
+            self.assertListEqual([1], itvx.get_listing('test', '/page', 3600, None, (), parse))
+        self.assertEqual(2, parse.call_count)
+
+
 class Episodes(TestCase):
-    @patch('resources.lib.fetch.get_document', new=open_doc('html/series_miss-marple.html'))
-    def test_episodes_marple(self):
+    def setUp(self):
+        cache.purge()
+
+    def tearDown(self):
+        cache.purge()
+
+    @patch('resources.lib.fetch.web_request',
+           return_value=HttpResponse(text=open_doc('html/series_miss-marple.html')()))
+    def test_episodes_marple(self, _):
         series_listing = itvx.episodes('asd')
         self.assertIsInstance(series_listing, dict)
         self.assertEqual(len(series_listing), 6)
+        for series in series_listing.values():
+            self.assertIsInstance(series, Series)
+            # Series folders have the brand's image
+            self.assertTrue(series.to_dict()['art']['thumb'].startswith('https://'))
+            # No series has been opened, so no episodes are parsed.
+            self.assertIsNone(series.episodes)
+
+    @patch('resources.lib.itvx.get_page_data', return_value=open_json('html/series_midsummer-murders.json'))
+    def test_only_episodes_of_opened_series_are_parsed(self, _):
+        with patch('resources.lib.parsex.parse_episode_title', wraps=parsex.parse_episode_title) as p_parse:
+            series_listing = itvx.episodes('https://www.itv.com/watch/midsomer-murders/Ya1096', 4)
+        # Both series numbered 4 are merged
+        self.assertEqual(6, len(series_listing[4].episodes))
+        self.assertEqual(6, p_parse.call_count)
+        self.assertIsInstance(series_listing[4].episodes[0], Episode)
+        for idx, series in series_listing.items():
+            if idx != 4:
+                self.assertIsNone(series.episodes)
+
+    @patch('resources.lib.itvx.get_page_data', return_value=open_json('html/series_miss-marple_data.json'))
+    def test_episodes_of_single_series(self, p_get):
+        data = p_get.return_value
+        del data['title']['brand']['series'][1:]
+        series_listing = itvx.episodes('asd', series_idx=12)
+        self.assertEqual(1, len(series_listing))
+        self.assertEqual(4, len(list(series_listing.values())[0].episodes))
+
+    def test_parsed_episodes_are_cached(self):
+        data = open_json('html/series_midsummer-murders.json')
+        with patch('resources.lib.itvx.get_page_data', return_value=data):
+            first = itvx.episodes('https://www.itv.com/watch/midsomer-murders/Ya1096', 4)[4].episodes
+            with patch('resources.lib.parsex.parse_episode_title') as p_parse:
+                second = itvx.episodes('https://www.itv.com/watch/midsomer-murders/Ya1096', 4)[4].episodes
+                p_parse.assert_not_called()
+            self.assertListEqual(first, second)
+
+            # A new episode invalidates the cached episodes
+            series_4 = data['title']['brand']['series'][3]
+            new_episode = dict(series_4['episodes'][0], productionId='new/episode')
+            series_4['episodes'].append(new_episode)
+            third = itvx.episodes('https://www.itv.com/watch/midsomer-murders/Ya1096', 4)[4].episodes
+            self.assertEqual(len(first) + 1, len(third))
+
+
+class LiveChannels(TestCase):
+    @staticmethod
+    def get_json(url, *args, **kwargs):
+        if 'nownext' in url:
+            return open_json('schedule/now_next.json')
+        else:
+            return open_json('schedule/live_4hrs.json')
+
+    def test_get_live_channels(self):
+        with patch('resources.lib.fetch.get_json', new=self.get_json):
+            channels = itvx.get_live_channels()
+        self.assertGreater(len(channels), 10)
+        for chan in channels:
+            self.assertIsInstance(chan, LiveChannel)
+            self.assertGreater(len(chan.programmes), 1)
+        # The main channels have the full schedule and can be played from the start
+        self.assertTrue(channels[0].now_on.orig_start)
+
+    def test_get_live_channels_without_schedule(self):
+        with patch('resources.lib.itvx.get_live_schedule', side_effect=errors.FetchError), \
+                patch('resources.lib.fetch.get_json', return_value=open_json('schedule/now_next.json')):
+            channels = itvx.get_live_channels()
+        self.assertGreater(len(channels), 10)
+        for chan in channels:
+            self.assertEqual(2, len(chan.programmes))
+            self.assertIsNone(chan.now_on.orig_start)
+
+    def test_get_live_channels_fails(self):
+        with patch('resources.lib.fetch.get_json', side_effect=errors.HttpError(500, 'server error')):
+            self.assertRaises(errors.HttpError, itvx.get_live_channels)
 
 
 class Search(TestCase):
@@ -33,10 +33,17 @@ class MainMenu(TestCase):
             self.assertIsInstance(item, Listitem)
 
 
-@patch('resources.lib.fetch.get_json', side_effect=(open_json('schedule/now_next.json'),
-                                                    open_json('schedule/live_4hrs.json')))
+def get_live_json(url, *args, **kwargs):
+    # Now/next and the schedule are requested concurrently, so the order of calls is not fixed.
+    if 'nownext' in url:
+        return open_json('schedule/now_next.json')
+    else:
+        return open_json('schedule/live_4hrs.json')
+
+
+@patch('resources.lib.fetch.get_json', new=get_live_json)
 class LiveChannels(TestCase):
-    def test_liste_live_channels(self, _):
+    def test_liste_live_channels(self):
         chans = main.sub_menu_live(MagicMock())
         self.assertIsInstance(chans, types.GeneratorType)
         chan_list = list(chans)
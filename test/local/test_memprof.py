@@ -0,0 +1,104 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022. Dimitri Kroon
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+from test.support import fixtures
+fixtures.global_setup()
+
+import os
+import json
+import shutil
+import tempfile
+import tracemalloc
+from unittest import TestCase
+from unittest.mock import patch
+
+from resources.lib import memprof
+from resources.lib import parsex
+from resources.lib import utils
+
+from test.support.testutils import open_doc
+
+
+setUpModule = fixtures.setup_local_tests
+tearDownModule = fixtures.tear_down_local_tests
+
+ROUTE_URL = 'plugin://plugin.video.itvhub/resources/lib/main/list_category/'
+
+retained_data = []
+
+
+class ModuleOf(TestCase):
+    def test_module_of(self):
+        self.assertEqual('resources.lib.parsex',
+                         memprof.module_of('/home/me/.kodi/addons/plugin.video.itvhub/resources/lib/parsex.py'))
+        self.assertEqual('codequick.listing',
+                         memprof.module_of('/home/me/.kodi/addons/script.module.codequick/lib/codequick/listing.py'))
+        self.assertEqual('requests', memprof.module_of('/usr/lib/python3/dist-packages/requests/models.py'))
+        self.assertEqual('codequick.route',
+                         memprof.module_of('C:\\Python\\Lib\\site-packages\\codequick\\route.py'))
+        self.assertEqual('decoder', memprof.module_of('/usr/lib/python3.10/json/decoder.py'))
+
+
+class Profile(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        patcher = patch.dict(memprof.utils.addon_info, {'profile': self.tmp_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        memprof._start_snapshot = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        retained_data.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def start_profile(self, enabled=True):
+        with patch.object(utils.addon_data, 'getSettingBool', create=True, return_value=enabled):
+            memprof.start_profile(ROUTE_URL)
+
+    def test_disabled(self):
+        self.start_profile(False)
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertIsNone(memprof.stop_profile())
+        self.assertListEqual([], os.listdir(self.tmp_dir))
+
+    def test_disabling_stops_tracing(self):
+        self.start_profile()
+        self.assertTrue(tracemalloc.is_tracing())
+        self.start_profile(False)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_profile(self):
+        page = open_doc('html/index.html')()
+        self.start_profile()
+        retained_data.append(parsex.scrape_json(page))
+        report = memprof.stop_profile()
+        self.assertEqual(ROUTE_URL, report['route'])
+        self.assertGreater(report['retained'], 500_000)
+        self.assertGreaterEqual(report['peak'], report['retained'])
+        # Allocations by json are attributed to the module that parsed the json.
+        self.assertEqual('resources.lib.parsex', next(iter(report['modules'])))
+        self.assertEqual('resources.lib.parsex', report['sites'][0]['owner'])
+        # Tracing continues between routes
+        self.assertTrue(tracemalloc.is_tracing())
+
+        with open(os.path.join(self.tmp_dir, memprof.REPORT_FILE)) as f:
+            reports = json.load(f)
+        self.assertListEqual([report], reports)
+
+    def test_reports_are_added(self):
+        for _ in range(3):
+            self.start_profile()
+            memprof.stop_profile()
+        with open(os.path.join(self.tmp_dir, memprof.REPORT_FILE)) as f:
+            self.assertEqual(3, len(json.load(f)))
+        with patch.object(memprof, 'MAX_REPORTS', 2):
+            self.start_profile()
+            memprof.stop_profile()
+        with open(os.path.join(self.tmp_dir, memprof.REPORT_FILE)) as f:
+            self.assertEqual(2, len(json.load(f)))
@@ -0,0 +1,221 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022. Dimitri Kroon
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+from test.support import fixtures
+fixtures.global_setup()
+
+import os
+import json
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from resources.lib import metrics
+from resources.lib import fetch
+from resources.lib import cache
+from resources.lib import settings
+from resources.lib import utils
+
+from test.support.testutils import HttpResponse
+
+
+setUpModule = fixtures.setup_local_tests
+tearDownModule = fixtures.tear_down_local_tests
+
+
+class Histogram(TestCase):
+    def test_add(self):
+        hist = metrics.Histogram((10, 100))
+        for value in (5, 10, 11, 50, 1000):
+            hist.add(value)
+        self.assertListEqual([2, 2, 1], hist.counts)
+        self.assertEqual(5, hist.count)
+        self.assertEqual(1076, hist.total)
+        self.assertEqual(5, hist.min)
+        self.assertEqual(1000, hist.max)
+
+    def test_percentile(self):
+        hist = metrics.Histogram((10, 100))
+        self.assertIsNone(hist.percentile(50))
+        for value in (1, 2, 3, 50, 500):
+            hist.add(value)
+        self.assertEqual(10, hist.percentile(50))
+        self.assertEqual(100, hist.percentile(80))
+        self.assertEqual(500, hist.percentile(90))
+        # Not larger than the maximum value
+        hist = metrics.Histogram((10, 100))
+        hist.add(20)
+        self.assertEqual(20, hist.percentile(50))
+
+    def test_to_and_from_dict(self):
+        hist = metrics.Histogram((10, 100))
+        hist.add(20)
+        hist.add(200)
+        data = json.loads(json.dumps(hist.to_dict()))
+        new_hist = metrics.Histogram.from_dict(data)
+        self.assertDictEqual(hist.to_dict(), new_hist.to_dict())
+
+
+class Metrics(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        patcher = patch.dict(metrics.utils.addon_info, {'profile': self.tmp_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        metrics._metrics = None
+        metrics._changed = False
+        metrics.current_route = None
+        self.enable_metrics(True)
+
+    def tearDown(self):
+        metrics._metrics = None
+        metrics.current_route = None
+        metrics.enabled = False
+        shutil.rmtree(self.tmp_dir)
+
+    def enable_metrics(self, enabled):
+        """Enable or disable the collection of metrics in the settings."""
+        patcher = patch.object(utils.addon_data, 'getSettingBool', create=True, return_value=enabled)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_start_route(self):
+        metrics.start_route('plugin://plugin.video.itvhub/resources/lib/main/sub_menu_live/')
+        self.assertEqual('main/sub_menu_live', metrics.current_route)
+        self.assertTrue(metrics.enabled)
+        metrics.start_route('plugin://plugin.video.itvhub/')
+        self.assertEqual('root', metrics.current_route)
+
+    def test_metrics_disabled(self):
+        self.enable_metrics(False)
+        metrics.start_route('plugin://plugin.video.itvhub/resources/lib/main/sub_menu_live/')
+        self.assertFalse(metrics.enabled)
+        metrics.record('ttfb', 40, 'www.itv.com')
+        metrics.count('cache_hit')
+        with metrics.timer('json_parse', 'myhost'):
+            pass
+        # Nothing is loaded from, or written to file.
+        self.assertIsNone(metrics._metrics)
+        metrics.write_report()
+        self.assertListEqual([], os.listdir(self.tmp_dir))
+
+    def test_record_and_count(self):
+        metrics.enabled = True
+        metrics.record('ttfb', 25, 'www.itv.com')
+        self.assertDictEqual({}, metrics.get_report()['routes'])
+        metrics.start_route('plugin://plugin.video.itvhub/resources/lib/main/sub_menu_live/')
+        metrics.record('ttfb', 40, 'www.itv.com')
+        metrics.record('wire_bytes', 2000, 'www.itv.com')
+        metrics.count('cache_hit')
+        report = metrics.get_report()
+        host_metrics = report['hosts']['www.itv.com']
+        self.assertEqual(2, host_metrics['histograms']['ttfb']['count'])
+        self.assertListEqual(list(metrics.SIZE_BUCKETS), host_metrics['histograms']['wire_bytes']['bounds'])
+        self.assertDictEqual({}, host_metrics['counters'])
+        route_metrics = report['routes']['main/sub_menu_live']
+        self.assertEqual(1, route_metrics['histograms']['ttfb']['count'])
+        self.assertDictEqual({'cache_hit': 1}, route_metrics['counters'])
+
+    def test_timer(self):
+        metrics.enabled = True
+        with metrics.timer('json_parse', 'myhost'):
+            pass
+        hist = metrics.get_report()['hosts']['myhost']['histograms']['json_parse']
+        self.assertEqual(1, hist['count'])
+        self.assertLess(hist['max'], 10)
+
+    def test_write_and_load_report(self):
+        metrics.start_route('plugin://plugin.video.itvhub/resources/lib/main/sub_menu_live/')
+        metrics.record('ttfb', 40, 'www.itv.com')
+        metrics.count('requests', 'www.itv.com')
+        report_file = metrics.write_report()
+        self.assertEqual(os.path.join(self.tmp_dir, metrics.REPORT_FILE), report_file)
+        self.assertListEqual([metrics.REPORT_FILE], os.listdir(self.tmp_dir))
+        report = metrics.get_report()
+        metrics._metrics = None
+        self.assertDictEqual(report, metrics.get_report())
+        # Metrics recorded in a next run are added to those of previous runs
+        metrics.record('ttfb', 60, 'www.itv.com')
+        self.assertEqual(2, metrics.get_report()['hosts']['www.itv.com']['histograms']['ttfb']['count'])
+
+    def test_load_invalid_report(self):
+        with open(os.path.join(self.tmp_dir, metrics.REPORT_FILE), 'w') as f:
+            f.write('{"hosts": ')
+        self.assertDictEqual({'hosts': {}, 'routes': {}}, metrics.get_report())
+
+    def test_format_report(self):
+        metrics.start_route('plugin://plugin.video.itvhub/resources/lib/main/sub_menu_live/')
+        metrics.record('ttfb', 40, 'www.itv.com')
+        metrics.count('cache_miss')
+        report = metrics.format_report()
+        self.assertIn('www.itv.com', report)
+        self.assertIn('main/sub_menu_live', report)
+        self.assertIn('ttfb', report)
+        self.assertIn('cache_miss: 1', report)
+
+    def test_reset(self):
+        metrics.enabled = True
+        metrics.record('ttfb', 40, 'www.itv.com')
+        metrics.reset()
+        self.assertDictEqual({'hosts': {}, 'routes': {}}, metrics.get_report())
+
+
+class Instrumentation(TestCase):
+    def setUp(self):
+        metrics._metrics = {'hosts': {}, 'routes': {}}
+        metrics.current_route = 'test_route'
+        metrics.enabled = True
+
+    def tearDown(self):
+        metrics._metrics = None
+        metrics.current_route = None
+        metrics.enabled = False
+
+    def test_adapter_uses_timed_connections(self):
+        adapter = fetch.KeepAliveAdapter()
+        pool = adapter.poolmanager.connection_from_url('https://www.itv.com')
+        self.assertIs(fetch.TimedHTTPSConnection, pool.ConnectionCls)
+        pool = adapter.poolmanager.connection_from_url('http://www.itv.com')
+        self.assertIs(fetch.TimedHTTPConnection, pool.ConnectionCls)
+
+    def test_response_metrics(self):
+        resp = HttpResponse(content=b'0123456789')
+        resp.elapsed = timedelta(seconds=0.2)
+        fetch._record_response_metrics(resp, 'myhost', 0.5, False)
+        host_metrics = metrics.get_report()['hosts']['myhost']
+        self.assertEqual(200, host_metrics['histograms']['ttfb']['sum'])
+        self.assertAlmostEqual(300, host_metrics['histograms']['download']['sum'])
+        self.assertEqual(10, host_metrics['histograms']['decoded_bytes']['sum'])
+        self.assertDictEqual({'requests': 1}, host_metrics['counters'])
+        # Streamed responses have not been downloaded yet.
+        fetch._record_response_metrics(resp, 'myhost', 0.5, True)
+        host_metrics = metrics.get_report()['hosts']['myhost']
+        self.assertEqual(2, host_metrics['histograms']['ttfb']['count'])
+        self.assertEqual(1, host_metrics['histograms']['download']['count'])
+        # Invalid responses do not raise
+        fetch._record_response_metrics(MagicMock(), 'myhost', 0.5, False)
+
+    def test_cache_counters(self):
+        cache.purge()
+        cache.get_item('my_key')
+        cache.set_item('my_key', {'a': 1})
+        cache.get_item('my_key')
+        cache.renew('my_key')
+        self.assertDictEqual({'cache_miss': 1, 'cache_hit': 1, 'cache_revalidated': 1},
+                             metrics.get_report()['routes']['test_route']['counters'])
+        cache.purge()
+
+    @patch('resources.lib.kodi_utils.show_request_metrics')
+    def test_settings_show_request_metrics(self, p_show):
+        self.assertTrue(hasattr(settings.show_request_metrics, 'route'))
+        with patch('resources.lib.metrics.write_report', return_value='/my/file') as p_write:
+            settings.show_request_metrics(MagicMock())
+            p_write.assert_called_once()
+        p_show.assert_called_once()
+        self.assertEqual('/my/file', p_show.call_args[0][1])
@@ -10,11 +10,11 @@ from test.support import fixtures
 fixtures.global_setup()
 
 import unittest
-from unittest.mock import MagicMock, patch
 
 from support.testutils import open_doc, open_json
-from support.object_checks import has_keys, is_url, is_li_compatible_dict
+from support.object_checks import has_keys, is_li_compatible_dict
 from resources.lib import parsex
+from resources.lib import items
 from resources.lib import errors
 
 setUpModule = fixtures.setup_local_tests
@@ -36,6 +36,66 @@ class TestScrapeJson(unittest.TestCase):
                           '<script id="__NEXT_DATA__" type="application/json">{data=[1,2]}</script>')
 
 
+    def test_scrape_json_from_chunks(self):
+        page = open_doc('html/index.html')()
+        expected = parsex.scrape_json(page)
+        page_bytes = page.encode('utf8')
+        for chunk_size in (10, 1000, 65536, len(page_bytes)):
+            chunks = (page_bytes[i:i + chunk_size] for i in range(0, len(page_bytes), chunk_size))
+            self.assertDictEqual(expected, parsex.scrape_json(chunks))
+        self.assertDictEqual(expected, parsex.scrape_json(page_bytes))
+
+    def test_extract_next_data_stops_at_end_tag(self):
+        chunks = iter((b'<html><script id="__NEXT_DATA__" type="appli', b'cation/json">{"a": 1}</scr',
+                       b'ipt>', b'<p>more data</p>', b'</html>'))
+        self.assertEqual('{"a": 1}', parsex.extract_next_data(chunks))
+        # Remaining chunks have not been consumed
+        self.assertEqual(b'<p>more data</p>', next(chunks))
+        self.assertIsNone(parsex.extract_next_data(iter((b'<html>', b'</html>'))))
+        self.assertIsNone(parsex.extract_next_data('<html></html>'))
+
+
+    def test_scrape_json_with_paths(self):
+        page = open_doc('html/series_miss-marple.html')()
+        full_data = parsex.scrape_json(page)
+        data = parsex.scrape_json(page, paths=('title.brand', ))
+        self.assertListEqual(['title'], list(data.keys()))
+        self.assertListEqual(['brand'], list(data['title'].keys()))
+        self.assertDictEqual(full_data['title']['brand'], data['title']['brand'])
+
+
+class SelectJson(unittest.TestCase):
+    doc = '{"a": {"b": [1, 2], "c": {"d": "x}", "e": null}}, "f" : true, "g": {"h": 1.5}, "i": "{[\\"]"}'
+
+    def test_select_json(self):
+        import json
+        full = json.loads(self.doc)
+        self.assertDictEqual(full, parsex.select_json(self.doc, ['a', 'f', 'g', 'i']))
+        self.assertDictEqual({'a': {'c': {'d': 'x}'}}}, parsex.select_json(self.doc, ['a.c.d']))
+        self.assertDictEqual({'a': {'b': [1, 2]}, 'i': '{["]'}, parsex.select_json(self.doc, ['a.b', 'i']))
+        # A path that includes another selects the whole parent.
+        self.assertDictEqual({'a': full['a']}, parsex.select_json(self.doc, ['a.b', 'a']))
+        self.assertDictEqual({'a': full['a']}, parsex.select_json(self.doc, ['a', 'a.b']))
+        # Paths that do not exist
+        self.assertDictEqual({'a': {}}, parsex.select_json(self.doc, ['a.x']))
+        self.assertDictEqual({'f': True}, parsex.select_json(self.doc, ['f.x']))
+        self.assertDictEqual({}, parsex.select_json('{}', ['a']))
+
+    def test_select_json_from_page_data(self):
+        data = open_json('html/category_films.json')
+        import json
+        doc = json.dumps(data, indent=2)
+        selection = parsex.select_json(doc, ['category.pathSegment', 'programmes'])
+        self.assertDictEqual({'category': {'pathSegment': data['category']['pathSegment']},
+                              'programmes': data['programmes']},
+                             selection)
+
+    def test_select_json_invalid_document(self):
+        import json
+        for doc in ('{"a": 1', '{"a" 1}', '{"a": 1 "b": 2}', '{a: 1}', '{"a": [1, 2}'):
+            self.assertRaises(json.JSONDecodeError, parsex.select_json, doc, ['b'])
+
+
 class Generic(unittest.TestCase):
     def test_build_url(self):
         url = parsex.build_url('Astrid and Lily Save the World', '10a2921')
@@ -49,6 +109,23 @@ class Generic(unittest.TestCase):
         url = parsex.build_url('#50/50-heroes?', '10a1511')
         self.assertEqual('https://www.itv.com/watch/5050-heroes/10a1511', url)
 
+    def test_image_url(self):
+        programmes = open_json('html/category_films.json')['programmes']
+        for prog in programmes[:20]:
+            template = prog['imageTemplate']
+            for profile, props in parsex.IMG_PROFILES.items():
+                self.assertEqual(template.format(**props), parsex.image_url(template, profile))
+        self.assertEqual('https://www.itv.com/img.jpg', parsex.image_url('https://www.itv.com/img.jpg', 'thumb'))
+        self.assertRaises(KeyError, parsex.image_url, 'https://www.itv.com/{unknown}.jpg', 'thumb')
+
+    def test_image_art(self):
+        template = open_json('html/category_films.json')['programmes'][0]['imageTemplate']
+        self.assertDictEqual({'thumb': parsex.image_url(template, 'thumb'),
+                              'poster': parsex.image_url(template, 'poster')},
+                             parsex.image_art(template, ('thumb', 'poster')))
+        self.assertDictEqual({'thumb': 'https://www.itv.com/img.jpg', 'fanart': 'https://www.itv.com/img.jpg'},
+                             parsex.image_art('https://www.itv.com/img.jpg', ('thumb', 'fanart')))
+
     def test_parse_hero(self):
         data = open_json('html/index-data.json')
         for item_data in data['heroContent']:
@@ -67,42 +144,45 @@ class Generic(unittest.TestCase):
         data = open_json('html/collection_just-in_data.json')['collection']['shows']
         # film The Hulk
         item = parsex.parse_collection_item(data[0])
-        has_keys(item, 'playable', 'show')
-        is_li_compatible_dict(self, item['show'])
+        self.assertIsInstance(item, items.Programme)
+        self.assertTrue(item.playable)
+        is_li_compatible_dict(self, item.to_dict())
+        self.assertIn('poster', item.to_dict()['art'])
         # series
         item = parsex.parse_collection_item(data[1])
-        has_keys(item, 'playable', 'show')
-        is_li_compatible_dict(self, item['show'])
+        self.assertFalse(item.playable)
+        is_li_compatible_dict(self, item.to_dict())
 
     def test_parse_collection_title_from_main_page(self):
         data = open_json('html/index-data.json')['editorialSliders']['editorialRailSlot1']['collection']['shows']
         item = parsex.parse_collection_item(data[0])
-        has_keys(item, 'playable', 'show')
-        is_li_compatible_dict(self, item['show'])
+        self.assertIsInstance(item, items.Programme)
+        is_li_compatible_dict(self, item.to_dict())
 
     def test_parse_news_collection_item(self):
         data = open_json('html/index-data.json')['newsShortformSliderContent']['items']
         tz_uk = pytz.timezone('Europe/London')
         item = parsex.parse_news_collection_item(data[1], tz_uk, "%H-%M-%S")
-        has_keys(item, 'playable', 'show')
-        is_li_compatible_dict(self, item['show'])
+        self.assertIsInstance(item, items.Programme)
+        is_li_compatible_dict(self, item.to_dict())
 
     def test_parse_trending_collection_item(self):
         data = open_json('html/index-data.json')['trendingSliderContent']['items']
         item = parsex.parse_trending_collection_item(data[1])
-        has_keys(item, 'playable', 'show')
-        is_li_compatible_dict(self, item['show'])
+        self.assertIsInstance(item, items.Programme)
+        is_li_compatible_dict(self, item.to_dict())
 
     def test_parse_episode_title(self):
         data = open_json('html/series_miss-marple_data.json')
         item = parsex.parse_episode_title(data['title'])
-        is_li_compatible_dict(self, item)
+        self.assertIsInstance(item, items.Episode)
+        is_li_compatible_dict(self, item.to_dict())
 
         # Episodes where field episodeTitle = None
         data = open_json('html/series_bad-girls_data.json')
         title_obj = data['title']['brand']['series'][6]['episodes'][0]
         item = parsex.parse_episode_title(title_obj)
-        is_li_compatible_dict(self, item)
+        is_li_compatible_dict(self, item.to_dict())
 
         # Episode where field seriesNumber is not a number, but 'other episodes'.
         data = open_json('html/series_midsummer-murders.json')
@@ -110,18 +190,18 @@ class Generic(unittest.TestCase):
         self.assertEqual('Other Episodes', series['title'])
         title_obj = series['episodes'][0]
         item = parsex.parse_episode_title(title_obj)
-        is_li_compatible_dict(self, item)
+        is_li_compatible_dict(self, item.to_dict())
 
         # Although not seen in the wild, check a title with a non-integer field 'episodeNumber'
         title_obj['episodeNumber'] = 'abvc'
         item = parsex.parse_episode_title(title_obj)
-        is_li_compatible_dict(self, item)
+        is_li_compatible_dict(self, item.to_dict())
 
         # Paid episode
         title_obj['tier'] = ['PAID']
         item = parsex.parse_episode_title(title_obj)
-        is_li_compatible_dict(self, item)
-        self.assertTrue('premium' in item['info']['plot'].lower())
+        is_li_compatible_dict(self, item.to_dict())
+        self.assertTrue('premium' in item.plot.lower())
 
     def test_parse_search_result(self):
         # These files contain programmes, episodes, films and specials both and without a specialProgramm field.
@@ -129,8 +209,8 @@ class Generic(unittest.TestCase):
             data = open_json(file)
             for result_item in data['results']:
                 item = parsex.parse_search_result(result_item)
-                has_keys(item, 'playable', 'show')
-                is_li_compatible_dict(self, item['show'])
+                self.assertIsInstance(item, items.Programme)
+                is_li_compatible_dict(self, item.to_dict())
 
         # unknown entity type
         search_result = data['results'][0]
@@ -0,0 +1,166 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022. Dimitri Kroon
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+from test.support import fixtures
+fixtures.global_setup()
+
+import time
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from codequick import Listitem
+
+from resources.lib import fetch
+from resources.lib import itvx
+from resources.lib import itv
+from resources.lib import cache
+from resources.lib import main
+from resources.lib import errors
+
+from test.support.stand_in_server import StandInServer, Faults
+
+
+# These tests run the real HTTP stack against a local server, so real web requests
+# are not blocked, like in other local tests.
+server = None
+
+
+def setUpModule():
+    global server
+    server = StandInServer().start()
+    server.install()
+
+
+def tearDownModule():
+    server.stop()
+
+
+class StandInTest(TestCase):
+    def setUp(self):
+        server.faults = Faults()
+        server.requests.clear()
+        cache.purge()
+        fetch._latencies = {}
+        fetch._breakers.clear()
+
+    def tearDown(self):
+        cache.purge()
+
+
+class Pages(StandInTest):
+    def test_main_page(self):
+        doc = fetch.get_document('https://www.itv.com')
+        self.assertIn('__NEXT_DATA__', doc)
+        req = server.requests[0]
+        self.assertEqual('www.itv.com', req['host'])
+        self.assertEqual(200, req['status'])
+        # HttpSession sends its cookies to the stand-in
+        self.assertIn('Itv.Cid', req['headers']['Cookie'])
+
+    def test_page_data_is_revalidated(self):
+        # _load_page_data() always makes a request, using the validators of the cached data.
+        data = itvx._load_page_data('https://www.itv.com/watch/categories/films', 3600)
+        self.assertGreater(len(data['programmes']), 100)
+        data = itvx._load_page_data('https://www.itv.com/watch/categories/films', 3600)
+        self.assertGreater(len(data['programmes']), 100)
+        self.assertListEqual([200, 304], [req['status'] for req in server.requests])
+
+    def test_unknown_page(self):
+        with self.assertRaises(errors.HttpError) as cm:
+            fetch.get_document('https://www.itv.com/watch/no-such-programme/123')
+        self.assertEqual(404, cm.exception.code)
+
+    def test_episode_page(self):
+        url, _ = itvx.get_playlist_url_from_episode_page('https://www.itv.com/watch/some-title/10a1234/10a1234a0001')
+        self.assertEqual('https://magni.itv.com/playlist/itvonline/ITV/10a1234a0001', url)
+
+
+class Services(StandInTest):
+    def test_live_channels(self):
+        channels = itvx.get_live_channels()
+        self.assertGreater(len(channels), 10)
+        hosts = {req['host'] for req in server.requests}
+        self.assertSetEqual({'nownext.oasvc.itv.com', 'scheduled.oasvc.itv.com'}, hosts)
+
+    def test_search(self):
+        results = list(itvx.search('the chase'))
+        self.assertGreater(len(results), 1)
+        self.assertIsNone(itvx.search('nothing to be found'))
+
+    def test_playlists(self):
+        with patch('resources.lib.itv_account.itv_session', return_value=MagicMock(access_token='my-token')):
+            dash_url, key_service, _ = itv.get_live_urls('ITV')
+            self.assertTrue(dash_url.startswith('https://'))
+            dash_url, key_service, subtitles = itv.get_catchup_urls(
+                'https://magni.itv.com/playlist/itvonline/ITV/1_7317_0057.001')
+            self.assertTrue(dash_url.endswith('.mpd'))
+
+    def test_playlists_without_token(self):
+        with self.assertRaises(errors.AuthenticationError):
+            fetch.post_json('https://simulcast.itv.com/playlist/itvonline/ITV', {'user': {'token': ''}})
+
+    def test_auth(self):
+        tokens = fetch.post_json('https://auth.prd.user.itv.com/auth', {'username': 'me', 'password': 'secret'})
+        self.assertTrue(tokens['access_token'])
+        new_tokens = fetch.get_json('https://auth.prd.user.itv.com/token?grant_type=refresh_token&'
+                                    'token=content_token refresh_token&refresh=' + tokens['refresh_token'])
+        self.assertNotEqual(tokens['access_token'], new_tokens['access_token'])
+
+    def test_consent(self):
+        jar = fetch.RequestsCookieJar()
+        self.assertTrue(fetch.update_consent(jar))
+        self.assertEqual(3, len(jar))
+
+
+class Routes(StandInTest):
+    def test_routes(self):
+        addon = MagicMock()
+        addon.setting.get_boolean.return_value = False
+        for route, kwargs in ((main.root, {}),
+                              (main.sub_menu_live, {}),
+                              (main.list_collections, {}),
+                              (main.list_categories, {}),
+                              (main.list_category, {'path': '/watch/categories/films'}),
+                              (main.list_collection_content, {'slider': 'trendingSliderContent'}),
+                              (main.list_productions, {'url': 'https://www.itv.com/watch/midsomer-murders/Ya1096'}),
+                              (main.do_search, {'search_query': 'the chase'})):
+            with self.subTest(route.__name__):
+                items = list(route(addon, **kwargs))
+                self.assertGreater(len(items), 1)
+                for item in items:
+                    self.assertIsInstance(item, Listitem)
+
+
+class FaultInjection(StandInTest):
+    def test_latency(self):
+        server.faults = Faults(latency=0.2)
+        start = time.monotonic()
+        fetch.get_json('https://nownext.oasvc.itv.com/channels')
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_bandwidth(self):
+        server.faults = Faults(bandwidth=100_000)
+        start = time.monotonic()
+        # now_next.json is about 60kB
+        fetch.get_json('https://nownext.oasvc.itv.com/channels')
+        self.assertGreater(time.monotonic() - start, 0.5)
+
+    @patch.dict(fetch.HOST_POLICIES['*'], backoff=0)
+    def test_errors(self):
+        server.faults = Faults(error_rate=1, hosts=('www.itv.com',))
+        with self.assertRaises(errors.HttpError) as cm:
+            fetch.get_document('https://www.itv.com/watch/categories')
+        self.assertEqual(503, cm.exception.code)
+        # The request has been retried
+        self.assertGreater(len(server.requests), 1)
+        # Other hosts are not affected
+        fetch.get_json('https://nownext.oasvc.itv.com/channels')
+
+    @patch.dict(fetch.HOST_POLICIES['*'], backoff=0)
+    def test_connection_reset(self):
+        server.faults = Faults(reset_rate=1)
+        self.assertRaises(errors.FetchError, fetch.get_document, 'https://www.itv.com/watch/categories')
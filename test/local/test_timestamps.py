@@ -0,0 +1,91 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022 Dimitri Kroon.
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+from test.support import fixtures
+fixtures.global_setup()
+
+import time
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+
+from resources.lib import timestamps
+
+from test.support.testutils import open_json
+
+
+setUpModule = fixtures.setup_local_tests
+tearDownModule = fixtures.tear_down_local_tests
+
+
+class ParseIso(TestCase):
+    def test_parse_iso(self):
+        self.assertEqual(datetime(2022, 11, 24, 19, 30), timestamps.parse_iso('2022-11-24T19:30Z'))
+        self.assertEqual(datetime(2022, 11, 24, 19, 30), timestamps.parse_iso('2022-11-24T19:30'))
+        self.assertEqual(datetime(2022, 11, 24, 22, 30, 5), timestamps.parse_iso('2022-11-24T22:30:05Z'))
+        self.assertEqual(datetime(2022, 11, 24, 22, 30, 5), timestamps.parse_iso('2022-11-24T22:30:05.123Z'))
+        self.assertEqual(datetime(2022, 11, 24, 22, 30, 5), timestamps.parse_iso('2022-11-24T22:30:05'))
+        for invalid in ('', '2022-13-24T19:30Z', 'Thu, 24 Nov 2022 19:30'):
+            self.assertRaises(ValueError, timestamps.parse_iso, invalid)
+
+    def test_parse_live_schedule(self):
+        schedule = open_json('schedule/live_4hrs.json')['_embedded']['schedule']
+        for channel in schedule:
+            for programme in channel['_embedded']['slot']:
+                self.assertEqual(datetime(*time.strptime(programme['startTime'], '%Y-%m-%dT%H:%MZ')[0:6]),
+                                 timestamps.parse_iso(programme['startTime']))
+                self.assertEqual(datetime(*time.strptime(programme['onAirTimeUTC'], '%Y-%m-%dT%H:%M:%SZ')[0:6]),
+                                 timestamps.parse_iso(programme['onAirTimeUTC']))
+
+
+class Strptime(TestCase):
+    def test_fixed_formats(self):
+        for dt_str, fmt in (('2012-09-14T18:32:45Z', '%Y-%m-%dT%H:%M:%SZ'),
+                            ('2012-09-14T18:32:45', '%Y-%m-%dT%H:%M:%S'),
+                            ('2012-09-14T18:32Z', '%Y-%m-%dT%H:%MZ'),
+                            ('2012-09-14T18:32', '%Y-%m-%dT%H:%M')):
+            self.assertEqual(datetime(*time.strptime(dt_str, fmt)[0:6]), timestamps.strptime(dt_str, fmt))
+
+    def test_invalid_timestamps(self):
+        for dt_str, fmt in (('2012-09-14T18:32:45', '%Y-%m-%dT%H:%M:%SZ'),
+                            ('2012-09-14T18:32:45Z', '%Y-%m-%dT%H:%M:%S'),
+                            ('2012-09-14 18:32:45', '%Y-%m-%dT%H:%M:%S'),
+                            ('2012-09-14T18:32:4x', '%Y-%m-%dT%H:%M:%S'),
+                            ('2012-09-14T18:32+1', '%Y-%m-%dT%H:%M:%S'),
+                            ('2012-09-14T25:32', '%Y-%m-%dT%H:%M')):
+            self.assertRaises(ValueError, timestamps.strptime, dt_str, fmt)
+
+    def test_other_formats(self):
+        self.assertEqual(datetime(2022, 11, 24, 19, 30), timestamps.strptime('24.11.2022 19:30', '%d.%m.%Y %H:%M'))
+
+
+class Timezones(TestCase):
+    def test_get_timezone(self):
+        uk_tz = timestamps.get_timezone('Europe/London')
+        self.assertEqual('Europe/London', str(uk_tz))
+        self.assertIs(uk_tz, timestamps.get_timezone('Europe/London'))
+
+    def test_to_uk_time(self):
+        uk_tz = timestamps.get_timezone('Europe/London')
+        self.assertEqual(datetime(2022, 11, 24, 19, 30), timestamps.to_local(datetime(2022, 11, 24, 19, 30), uk_tz))
+        self.assertEqual(datetime(2022, 7, 24, 20, 30), timestamps.to_local(datetime(2022, 7, 24, 19, 30), uk_tz))
+        # Start and end of summer time
+        self.assertEqual(datetime(2022, 3, 27, 0, 59), timestamps.to_local(datetime(2022, 3, 27, 0, 59), uk_tz))
+        self.assertEqual(datetime(2022, 3, 27, 2, 0), timestamps.to_local(datetime(2022, 3, 27, 1, 0), uk_tz))
+        self.assertEqual(datetime(2022, 10, 30, 1, 59), timestamps.to_local(datetime(2022, 10, 30, 0, 59), uk_tz))
+        self.assertEqual(datetime(2022, 10, 30, 1, 0), timestamps.to_local(datetime(2022, 10, 30, 1, 0), uk_tz))
+
+    def test_to_local_time(self):
+        utc_dt = datetime(2022, 11, 24, 19, 30, 15)
+        for days in (0, 60, 120, 180, 240):
+            dt = utc_dt + timedelta(days=days)
+            expected = dt.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+            self.assertEqual(expected, timestamps.to_local(dt))
+
+    def test_utc_offset(self):
+        uk_tz = timestamps.get_timezone('Europe/London')
+        self.assertEqual(timedelta(0), timestamps.utc_offset(datetime(2022, 11, 24, 19, 30), uk_tz))
+        self.assertEqual(timedelta(hours=1), timestamps.utc_offset(datetime(2022, 7, 24, 19, 30), uk_tz))
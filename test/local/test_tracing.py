@@ -0,0 +1,152 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022. Dimitri Kroon
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+from test.support import fixtures
+fixtures.global_setup()
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+from codequick import Route, Resolver, Listitem
+
+from resources.lib import tracing
+from resources.lib import parsex
+from resources.lib import cc_patch
+from resources.lib import utils
+
+from test.support.testutils import open_json
+
+
+setUpModule = fixtures.setup_local_tests
+tearDownModule = fixtures.tear_down_local_tests
+
+ROUTE_URL = 'plugin://plugin.video.itvhub/resources/lib/main/list_category/'
+
+
+@tracing.traced
+def traced_function(x):
+    return x * 2
+
+
+class Tracing(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        patcher = patch.dict(tracing.utils.addon_info, {'profile': self.tmp_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        tracing._events = None
+        shutil.rmtree(self.tmp_dir)
+
+    def start_trace(self, enabled=True):
+        with patch.object(utils.addon_data, 'getSettingBool', create=True, return_value=enabled):
+            tracing.start_trace(ROUTE_URL)
+
+    def test_disabled(self):
+        self.start_trace(False)
+        with tracing.span('my_span'):
+            pass
+        self.assertEqual(4, traced_function(2))
+        self.assertIsNone(tracing._events)
+        self.assertIsNone(tracing.stop_trace())
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, tracing.TRACE_DIR)))
+
+    def test_spans(self):
+        self.start_trace()
+        with tracing.span('outer', 'route', url='my_url'):
+            with tracing.span('inner'):
+                self.assertEqual(4, traced_function(2))
+        thread = threading.Thread(target=traced_function, args=(1,), name='worker')
+        thread.start()
+        thread.join()
+
+        events = tracing._events
+        self.assertListEqual(['traced_function', 'inner', 'outer', 'traced_function'], [e['name'] for e in events])
+        outer, inner = events[2], events[1]
+        self.assertEqual('X', outer['ph'])
+        self.assertEqual('route', outer['cat'])
+        self.assertDictEqual({'url': 'my_url'}, outer['args'])
+        self.assertNotIn('args', inner)
+        self.assertLessEqual(outer['ts'], inner['ts'])
+        self.assertGreaterEqual(outer['ts'] + outer['dur'], inner['ts'] + inner['dur'])
+        self.assertNotEqual(events[0]['tid'], events[3]['tid'])
+
+    def test_span_records_on_exception(self):
+        self.start_trace()
+        with self.assertRaises(ValueError):
+            with tracing.span('failing'):
+                raise ValueError
+        self.assertEqual('failing', tracing._events[0]['name'])
+
+    def test_stop_trace_writes_file(self):
+        self.start_trace()
+        with tracing.span('my_span'):
+            pass
+        trace_file = tracing.stop_trace()
+        self.assertIsNone(tracing._events)
+        self.assertEqual(os.path.join(self.tmp_dir, tracing.TRACE_DIR), os.path.dirname(trace_file))
+        self.assertTrue(os.path.basename(trace_file).endswith('main.list_category.json'))
+        with open(trace_file) as f:
+            trace = json.load(f)
+        events = trace['traceEvents']
+        # The first event spans the whole invocation
+        self.assertEqual(ROUTE_URL, events[0]['name'])
+        self.assertEqual('my_span', events[1]['name'])
+        self.assertEqual('M', events[2]['ph'])
+        self.assertEqual('MainThread', events[2]['args']['name'])
+
+    def test_old_traces_are_removed(self):
+        trace_dir = os.path.join(self.tmp_dir, tracing.TRACE_DIR)
+        os.makedirs(trace_dir)
+        for i in range(tracing.MAX_TRACE_FILES):
+            open(os.path.join(trace_dir, 'trace-2022010{}-000000-root.json'.format(i)), 'w').close()
+        self.start_trace()
+        trace_file = tracing.stop_trace()
+        trace_files = os.listdir(trace_dir)
+        self.assertEqual(tracing.MAX_TRACE_FILES, len(trace_files))
+        self.assertIn(os.path.basename(trace_file), trace_files)
+        self.assertNotIn('trace-20220100-000000-root.json', trace_files)
+
+    def test_trace_parsing(self):
+        self.start_trace()
+        data = open_json('html/index-data.json')
+        for slider in data['editorialSliders'].items():
+            parsex.parse_slider(*slider)
+        names = set(e['name'] for e in tracing._events)
+        self.assertSetEqual({'parse_slider'}, names)
+
+
+class PatchTracing(TestCase):
+    def setUp(self):
+        # Restore codequick's original functions after the test.
+        for obj, name in ((Route, '__call__'), (Resolver, '__call__'), (Listitem, 'from_dict')):
+            patcher = patch.object(obj, name, new=obj.__dict__[name])
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        tracing._events = None
+
+    def test_patch_tracing_twice(self):
+        # Like addon.py being run on two successive invocations.
+        cc_patch.patch_tracing()
+        cc_patch.patch_tracing()
+        with patch.object(utils.addon_data, 'getSettingBool', create=True, return_value=True):
+            tracing.start_trace(ROUTE_URL)
+        route = type('Route', (), {'path': '/resources/lib/main/list_category'})()
+        Route.__call__(Route(), route, (), {})
+        Resolver.__call__(Resolver(), route, (), {})
+        Listitem.from_dict(lambda: None, label='My item')
+        self.assertListEqual(['/resources/lib/main/list_category', '/resources/lib/main/list_category', 'from_dict'],
+                             [e['name'] for e in tracing._events])
+        self.assertListEqual(['route', 'resolver', 'listitem'], [e['cat'] for e in tracing._events])
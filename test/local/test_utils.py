@@ -10,13 +10,17 @@
 from test.support import fixtures
 fixtures.global_setup()
 
+import os
+import shutil
+import tempfile
 from datetime import datetime
 from unittest import TestCase
+from unittest.mock import patch
 
-import resources.lib
 from resources.lib import utils
 
-from test.support.testutils import doc_path
+from test.support.testutils import doc_path, open_doc
+from resources.lib import errors
 
 
 setUpModule = fixtures.setup_local_tests
@@ -60,11 +64,68 @@ class Generic(TestCase):
         self.assertEqual(utils.reformat_date('1982-05-02T14:38:32Z', '%Y-%m-%dT%H:%M:%SZ', '%d.%m.%y %H:%M'),
                          '02.05.82 14:38')
 
+    def test_get_json_from_html(self):
+        data = utils.get_json_from_html(open_doc('html/watch-itv1.html')())
+        self.assertIsInstance(data['props']['pageProps'], dict)
+        self.assertRaises(errors.ParseError, utils.get_json_from_html, '<html></html>')
+
     def test_strptime(self):
         self.assertEqual(datetime(2012, 9, 14, 18, 32, 45),
                          utils.strptime('2012-09-14T18:32:45Z', '%Y-%m-%dT%H:%M:%SZ'))
 
 
+class Settings(TestCase):
+    def test_setting_enabled(self):
+        with patch.object(utils.addon_data, 'getSettingBool', create=True, return_value=True) as p_get:
+            self.assertIs(True, utils.setting_enabled('my-setting'))
+            p_get.assert_called_once_with('my-setting')
+        with patch.object(utils.addon_data, 'getSettingBool', create=True, return_value=False):
+            self.assertIs(False, utils.setting_enabled('my-setting'))
+
+    def test_setting_that_cannot_be_read(self):
+        with patch.object(utils.addon_data, 'getSettingBool', create=True, side_effect=TypeError):
+            self.assertIs(False, utils.setting_enabled('my-setting'))
+
+
+class Files(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_atomic_write(self):
+        path = os.path.join(self.tmp_dir, 'my_file')
+        utils.atomic_write(path, 'some text')
+        with open(path) as f:
+            self.assertEqual('some text', f.read())
+        utils.atomic_write(path, b'some bytes')
+        with open(path, 'rb') as f:
+            self.assertEqual(b'some bytes', f.read())
+        self.assertListEqual(['my_file'], os.listdir(self.tmp_dir))
+
+    def test_atomic_write_failure(self):
+        """A failed write leaves the original file and no temporary file behind."""
+        path = os.path.join(self.tmp_dir, 'my_file')
+        utils.atomic_write(path, 'original')
+        with patch('os.replace', side_effect=PermissionError):
+            self.assertRaises(OSError, utils.atomic_write, path, 'new')
+        self.assertRaises(TypeError, utils.atomic_write, path, 123)
+        with open(path) as f:
+            self.assertEqual('original', f.read())
+        self.assertListEqual(['my_file'], os.listdir(self.tmp_dir))
+        self.assertRaises(OSError, utils.atomic_write, os.path.join(self.tmp_dir, 'no_dir', 'my_file'), 'text')
+
+    def test_remove_old_files(self):
+        for i in range(5):
+            open(os.path.join(self.tmp_dir, 'trace-{}'.format(i)), 'w').close()
+        open(os.path.join(self.tmp_dir, 'other'), 'w').close()
+        utils.remove_old_files(self.tmp_dir, 'trace-', 2)
+        self.assertListEqual(['other', 'trace-3', 'trace-4'], sorted(os.listdir(self.tmp_dir)))
+        utils.remove_old_files(self.tmp_dir, 'trace-', 2)
+        self.assertEqual(3, len(os.listdir(self.tmp_dir)))
+
+
 # noinspection PyMethodMayBeStatic
 class VttToSrt(TestCase):
     def test_1_cue_timestamps(self):
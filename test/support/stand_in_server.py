@@ -0,0 +1,480 @@
+# ---------------------------------------------------------------------------------------------------------------------
+#  Copyright (c) 2022. Dimitri Kroon
+#
+#  SPDX-License-Identifier: GPL-2.0-or-later
+#  This file is part of plugin.video.itvx
+# ---------------------------------------------------------------------------------------------------------------------
+
+"""
+A local stand-in for the ITV web services.
+
+The server replays the documents in test_docs on the paths of the real services, so the
+addon's complete HTTP stack - HttpSession, its adapter, cookies, retries, caching and
+revalidation - can be run, load-tested and profiled on a machine without network access.
+
+Requests are dispatched on their Host header. StandInServer.install() redirects all
+requests made by any requests.Session to the server, keeping the original host in
+the Host header, so the addon can use the real urls unaltered:
+
+    with StandInServer(Faults(latency=0.05, bandwidth=500_000)) as server:
+        server.install()
+        itvx.get_live_channels()
+
+Responses of services for which test_docs has no documents, like playlists and
+authentication tokens, are generated. Latency, bandwidth and errors can be injected
+through a Faults object, which may be changed while the server runs.
+
+The server can also be run on its own, e.g. to be used with a proxy or curl:
+
+    python -m test.support.stand_in_server --port 8080 --latency 0.1
+    curl -H 'Host: nownext.oasvc.itv.com' http://localhost:8080/channels
+"""
+
+from test.support import fixtures
+fixtures.global_setup()
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, urlunsplit, parse_qs
+from unittest.mock import patch
+
+from resources.lib.fetch import KeepAliveAdapter
+
+from test.support.testutils import doc_path
+
+
+logger = logging.getLogger('stand_in_server')
+
+# Chunk size used to write response bodies when bandwidth is limited.
+WRITE_CHUNK_SIZE = 8192
+
+# Slugs used in urls of which the document in test_docs has a different name.
+SLUG_ALIASES = {
+    'midsomer-murders': 'midsummer-murders',
+    'agatha-christies-marple': 'miss-marple',
+}
+
+NEXT_DATA_PAGE = ('<!DOCTYPE html><html><head><title>ITVX</title></head><body><div id="__next"></div>'
+                  '<script id="__NEXT_DATA__" type="application/json">{}</script></body></html>')
+
+
+class Faults:
+    """Faults injected into responses.
+
+    :param latency: Seconds to wait before a response is sent.
+    :param jitter: Maximum number of seconds randomly added to latency.
+    :param bandwidth: Maximum speed in bytes per second at which response bodies are sent,
+        or None for unlimited.
+    :param error_rate: Fraction of requests that get an error response of status `error_status`.
+    :param reset_rate: Fraction of requests of which the connection is closed without a response.
+    :param hosts: Hosts to which faults apply, or None for all hosts.
+    :param seed: Seed of the random number generator, to make faults reproducible.
+
+    """
+    def __init__(self, latency=0, jitter=0, bandwidth=None, error_rate=0, error_status=503,
+                 reset_rate=0, hosts=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.reset_rate = reset_rate
+        self.hosts = hosts
+        self.random = random.Random(seed)
+
+    def applies_to(self, host):
+        return self.hosts is None or host in self.hosts
+
+    def delay(self):
+        return self.latency + self.random.uniform(0, self.jitter) if self.jitter else self.latency
+
+
+class Reply:
+    def __init__(self, status=200, body=b'', content_type='application/json', headers=None):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+
+
+def _json_reply(data, status=200):
+    return Reply(status, json.dumps(data).encode('utf8'))
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+#   Documents
+# ---------------------------------------------------------------------------------------------------------------------
+
+_docs = {}
+_docs_lock = threading.Lock()
+
+
+def load_doc(doc, page_props=False):
+    """Return the contents of `doc` in test_docs as bytes, or None if it does not exist.
+    If `page_props` is True the document is json data that is embedded in an HTML page,
+    like www.itv.com does with the pageProps of its pages.
+
+    """
+    key = (doc, page_props)
+    with _docs_lock:
+        if key in _docs:
+            return _docs[key]
+    try:
+        with open(doc_path(doc), 'rb') as f:
+            content = f.read()
+    except FileNotFoundError:
+        content = None
+    else:
+        if page_props:
+            next_data = '{{"props":{{"pageProps":{}}},"page":"/"}}'.format(content.decode('utf8'))
+            content = NEXT_DATA_PAGE.format(next_data).encode('utf8')
+    with _docs_lock:
+        _docs[key] = content
+    return content
+
+
+def _find_page(*candidates):
+    """Return a Reply with the first of `candidates` that exists in test_docs.
+    Candidates ending in '.json' are pageProps embedded in an HTML page.
+
+    """
+    for doc in candidates:
+        content = load_doc(doc, page_props=doc.endswith('.json'))
+        if content is not None:
+            return Reply(body=content, content_type='text/html; charset=utf-8')
+    return Reply(404, b'<html><body>Not Found</body></html>', 'text/html')
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+#   Handlers
+#   Each handler is called with the request and the match of the route's path pattern and returns a Reply.
+# ---------------------------------------------------------------------------------------------------------------------
+
+def main_page(request, match):
+    return _find_page('html/index.html')
+
+
+def categories_page(request, match):
+    return _find_page('html/categories_data.json')
+
+
+def category_page(request, match):
+    return _find_page('html/category_{}.json'.format(match['category']))
+
+
+def collection_page(request, match):
+    slug = match['slug']
+    return _find_page('html/collection_{}_data.json'.format(slug), 'html/collection_{}.json'.format(slug))
+
+
+def tv_guide_page(request, match):
+    return _find_page('html/tv_guide.html')
+
+
+def programme_page(request, match):
+    slug = SLUG_ALIASES.get(match['slug'], match['slug'])
+    return _find_page('html/series_{}.html'.format(slug),
+                      'html/series_{}_data.json'.format(slug),
+                      'html/series_{}.json'.format(slug),
+                      'html/paid_series_{}.json'.format(slug),
+                      'html/film_{}.html'.format(slug))
+
+
+def episode_page(request, match):
+    """Episode pages are only used to obtain the episode's playlist url."""
+    playlist_url = 'https://magni.itv.com/playlist/itvonline/ITV/' + match['episode_id']
+    body = '<html><body><div data-video-id="{}"></div></body></html>'.format(playlist_url)
+    return Reply(body=body.encode('utf8'), content_type='text/html; charset=utf-8')
+
+
+def now_next(request, match):
+    return Reply(body=load_doc('schedule/now_next.json'))
+
+
+def schedule(request, match):
+    return Reply(body=load_doc('schedule/live_4hrs.json'))
+
+
+def search(request, match):
+    """Return search results from test_docs/search/<query>.json, or 204 No Content when
+    there are no results, like the real service often does.
+
+    """
+    query = request.query.get('query', [''])[0].lower().replace(' ', '_')
+    content = load_doc('search/{}.json'.format(query)) if re.fullmatch(r'\w+', query) else None
+    if content is None:
+        return Reply(204)
+    return Reply(body=content)
+
+
+def _check_token(request):
+    try:
+        return bool(request.json()['user']['token'])
+    except (ValueError, KeyError, TypeError):
+        return False
+
+
+def live_playlist(request, match):
+    if not _check_token(request):
+        return _json_reply({'Message': 'Unauthorized'}, 401)
+    channel = match['channel']
+    base = 'https://itv1simadotcom.cdn1.content.itv.com/playout/pc01/{}/cenc.isml'.format(channel)
+    return _json_reply({'Playlist': {'Video': {'VideoLocations': [{
+        'Url': base + '/.mpd',
+        'StartAgainUrl': base + '/.mpd?t={START_TIME}',
+        'KeyServiceUrl': 'https://itvpnp.live.ott.irdeto.com/Widevine/getlicense?contentId=' + channel}]}}})
+
+
+def catchup_playlist(request, match):
+    if not _check_token(request):
+        return _json_reply({'Message': 'Unauthorized'}, 401)
+    production_id = match['production_id']
+    return _json_reply({'Playlist': {'Video': {
+        'Base': 'https://itvpnpdotcom.cdn.itv.com/{}/'.format(production_id.replace('/', '_')),
+        'MediaFiles': [{'Href': 'index.mpd',
+                        'KeyServiceUrl': 'https://itvpnp.live.ott.irdeto.com/Widevine/getlicense'}],
+        'Subtitles': None}}})
+
+
+def _new_tokens():
+    token = hashlib.sha1(os.urandom(16)).hexdigest()
+    return {'access_token': 'access-' + token, 'refresh_token': 'refresh-' + token,
+            'token_type': 'bearer', 'expires_in': 3600}
+
+
+def auth(request, match):
+    try:
+        req_data = request.json()
+        credentials_ok = req_data['username'] and req_data['password']
+    except (ValueError, KeyError, TypeError):
+        credentials_ok = False
+    if not credentials_ok:
+        return _json_reply({'error': 'invalid_grant', 'error_description': 'Invalid username or password'}, 400)
+    return _json_reply(_new_tokens())
+
+
+def refresh_token(request, match):
+    if not request.query.get('refresh'):
+        return _json_reply({'error': 'invalid_request'}, 400)
+    return _json_reply(_new_tokens())
+
+
+def save_consent(request, match):
+    consent = {'SyrenisGuid_{}'.format(i): hashlib.md5(str(i).encode()).hexdigest() for i in range(3)}
+    return _json_reply({'CassieConsent': json.dumps(consent)})
+
+
+# Routes as (host, method, path pattern, handler).
+ROUTES = [
+    ('www.itv.com', 'GET', r'/?', main_page),
+    ('www.itv.com', 'GET', r'/watch/categories/?', categories_page),
+    ('www.itv.com', 'GET', r'/watch/categories/(?P<category>[\w-]+)', category_page),
+    ('www.itv.com', 'GET', r'/watch/collections/(?P<slug>[\w-]+)/\w+', collection_page),
+    ('www.itv.com', 'GET', r'/watch/tv-guide(/[\w-]+)?', tv_guide_page),
+    ('www.itv.com', 'GET', r'/watch/(?P<slug>[\w-]+)/(?P<programme_id>\w+)', programme_page),
+    ('www.itv.com', 'GET', r'/watch/(?P<slug>[\w-]+)/(?P<programme_id>\w+)/(?P<episode_id>\w+)', episode_page),
+    ('nownext.oasvc.itv.com', 'GET', r'/channels', now_next),
+    ('scheduled.oasvc.itv.com', 'GET', r'/scheduled/itvonline/schedules', schedule),
+    ('textsearch.prd.oasvc.itv.com', 'GET', r'/search', search),
+    ('simulcast.itv.com', 'POST', r'/playlist/itvonline/(?P<channel>[\w-]+)', live_playlist),
+    ('magni.itv.com', 'POST', r'/playlist/itvonline/(?P<production_id>[\w./-]+)', catchup_playlist),
+    ('auth.prd.user.itv.com', 'POST', r'/auth', auth),
+    ('auth.prd.user.itv.com', 'GET', r'/token', refresh_token),
+    ('identityservice.syrenis.com', 'GET', r'/Home/SaveConsent', save_consent),
+]
+
+
+def find_route(host, method, path):
+    """Return the handler and the match of the path pattern of the route of a request.
+    Return None if there is no route for the request.
+
+    """
+    for route_host, route_method, pattern, handler in ROUTES:
+        if route_host == host and route_method == method:
+            match = re.fullmatch(pattern, path)
+            if match:
+                return handler, match
+    return None
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+#   Server
+# ---------------------------------------------------------------------------------------------------------------------
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'ITVStandIn/1.0'
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def json(self):
+        return json.loads(self.body)
+
+    def handle_request(self, method):
+        url = urlsplit(self.path)
+        host = self.headers.get('Host', '').split(':')[0]
+        self.query = parse_qs(url.query)
+        self.body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        faults = self.server.faults
+        has_faults = faults.applies_to(host)
+
+        if has_faults:
+            delay = faults.delay()
+            if delay:
+                time.sleep(delay)
+            if faults.reset_rate and faults.random.random() < faults.reset_rate:
+                self.server.log_request_data(method, host, url.path, None, self.headers)
+                self.close_connection = True
+                return
+        if has_faults and faults.error_rate and faults.random.random() < faults.error_rate:
+            reply = Reply(faults.error_status, b'<html><body>Service Unavailable</body></html>', 'text/html')
+        else:
+            route = find_route(host, method, url.path)
+            if route is None:
+                reply = Reply(404, b'<html><body>Not Found</body></html>', 'text/html')
+            else:
+                handler, match = route
+                reply = handler(self, match)
+
+        if reply.status == 200 and reply.body and method == 'GET':
+            etag = '"{}"'.format(hashlib.md5(reply.body).hexdigest())
+            reply.headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                reply = Reply(304, headers={'ETag': etag})
+
+        self.server.log_request_data(method, host, url.path, reply.status, self.headers)
+        self.send_response(reply.status)
+        for name, value in reply.headers.items():
+            self.send_header(name, value)
+        if reply.body:
+            self.send_header('Content-Type', reply.content_type)
+        self.send_header('Content-Length', str(len(reply.body)))
+        self.end_headers()
+        self.write_body(reply.body, faults.bandwidth if has_faults else None)
+
+    def write_body(self, body, bandwidth):
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        for pos in range(0, len(body), WRITE_CHUNK_SIZE):
+            chunk = body[pos: pos + WRITE_CHUNK_SIZE]
+            self.wfile.write(chunk)
+            time.sleep(len(chunk) / bandwidth)
+
+
+class StandInServer(ThreadingHTTPServer):
+    """HTTP server that stands in for the ITV web services.
+
+    Runs in a background thread between start() and stop(), or as context manager.
+    All requests handled are logged in `requests` as a dict with keys 'method', 'host',
+    'path', 'status' and 'headers'. Status is None if the connection has been reset.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, faults=None, port=0):
+        super().__init__(('127.0.0.1', port), RequestHandler)
+        self.faults = faults or Faults()
+        self.requests = []
+        self._requests_lock = threading.Lock()
+        self._thread = None
+        self._patcher = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def log_request_data(self, method, host, path, status, headers):
+        with self._requests_lock:
+            self.requests.append({'method': method, 'host': host, 'path': path,
+                                  'status': status, 'headers': dict(headers)})
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='stand-in-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.uninstall()
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def install(self):
+        """Redirect the requests of all requests.Session objects to this server."""
+        adapter = StandInAdapter(self.server_address)
+        self._patcher = patch('requests.sessions.Session.get_adapter', new=lambda session, url: adapter)
+        self._patcher.start()
+
+    def uninstall(self):
+        if self._patcher:
+            self._patcher.stop()
+            self._patcher = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class StandInAdapter(KeepAliveAdapter):
+    """Adapter that sends requests to the stand-in server, with the original host in the Host header.
+    Responses appear to come from the original url.
+
+    """
+    def __init__(self, address, **kwargs):
+        self.address = address
+        super().__init__(**kwargs)
+
+    def send(self, request, *args, **kwargs):
+        url = urlsplit(request.url)
+        local_request = request.copy()
+        local_request.url = urlunsplit(('http', '{}:{}'.format(*self.address), url.path, url.query, ''))
+        local_request.headers['Host'] = url.netloc
+        resp = super().send(local_request, *args, **kwargs)
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Serve the documents in test_docs as the ITV web services.")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0, help="seconds before each response")
+    parser.add_argument('--jitter', type=float, default=0, help="maximum random seconds added to latency")
+    parser.add_argument('--bandwidth', type=int, default=None, help="bytes per second")
+    parser.add_argument('--error-rate', type=float, default=0, help="fraction of requests that fail")
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--reset-rate', type=float, default=0, help="fraction of connections reset")
+    opts = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.DEBUG, stream=sys.stdout)
+    faults = Faults(opts.latency, opts.jitter, opts.bandwidth, opts.error_rate, opts.error_status, opts.reset_rate)
+    server = StandInServer(faults, opts.port)
+    print("Serving on http://127.0.0.1:{}".format(server.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()